@@ -19,15 +19,37 @@ for now just return python objects. The transformation to JSON should
 be pretty straightforward.
 """
 import re
+import time
 import logging
 from google.appengine.ext import db
 from google.appengine.api import users
-from model import Domain, Task, TaskIndex, Context, User
+from google.appengine.api import memcache
+from appengine_utilities.cache import Cache
+from appengine_utilities.rotmodel import retry
+from model import Domain, Task, TaskIndex, Context, User, DomainStatistics
 import workers
 
 # Regexp for all valid domain identifiers
 VALID_DOMAIN_IDENTIFIER = r'[a-z][a-z0-9-]{1,100}'
 
+# Number of seconds the admins of a domain are cached
+DOMAIN_ADMINS_CACHE_TTL = 3600
+
+# Number of seconds the entity of a logged in user is cached
+USER_CACHE_TTL = 600
+
+# Number of seconds the statistics of a domain are cached
+DOMAIN_STATISTICS_CACHE_TTL = 600
+
+# Number of seconds the version of a domain is kept, which bounds how
+# long a version that could not be changed is used
+DOMAIN_VERSION_TTL = 600
+
+# Caches values in memcache and the datastore. The in-process tier is
+# disabled: invalidating a value only clears it on the current instance,
+# so other instances would keep using a changed user or admin list.
+_cache = Cache(local_timeout=0)
+
 
 
 def member_of_domain(domain, user, *args):
@@ -49,9 +71,12 @@ def member_of_domain(domain, user, *args):
     return True
 
 
-def admin_of_domain(domain_identifier, user):
+def is_admin(domain_identifier, user):
     """Returns true iff the user is a member and admin of the domain.
 
+    The admins of the domain are cached, so this does not load the
+    domain on a warm instance.
+
     Args:
         domain: The domain identifier
         user: Instance of the user model
@@ -61,12 +86,47 @@ def admin_of_domain(domain_identifier, user):
     """
     if not member_of_domain(domain_identifier, user):
         return False
-    query = Domain.all(keys_only=True).\
-        filter('__key__ =', Domain.key_from_name(domain_identifier)).\
-        filter('admins =', user.identifier())
-    if not query.fetch(1):
-        return False
-    return True
+    return user.identifier() in get_domain_admins(domain_identifier)
+
+
+def get_domain_admins(domain_identifier):
+    """
+    Returns the identifiers of the admins of a domain. The identifiers
+    are cached in memcache, and are only read from the domain entity
+    when they are not cached.
+
+    Args:
+        domain_identifier: The domain identifier string
+
+    Returns:
+        A list of user identifier strings. The list is empty if the
+        domain does not exist.
+    """
+    def admins():
+        domain = retry(Domain.get_by_key_name, domain_identifier)
+        if not domain:
+            return []
+        return list(domain.admins)
+    return _cache.get_or_compute(_domain_admins_cache_key(domain_identifier),
+                                 admins,
+                                 ttl=DOMAIN_ADMINS_CACHE_TTL)
+
+
+def invalidate_domain_admins(domain_identifier):
+    """
+    Removes the cached admins of a domain, so they are read from the
+    datastore again. Must be called after the admins of a domain have
+    been changed.
+
+    Args:
+        domain_identifier: The domain identifier string
+    """
+    _cache.delete(_domain_admins_cache_key(domain_identifier))
+
+
+def _domain_admins_cache_key(domain_identifier):
+    """Returns the cache key of the admins of a domain."""
+    return 'domain-admins:%s' % domain_identifier
 
 
 def get_logged_in_user():
@@ -76,6 +136,10 @@ def get_logged_in_user():
     separate entities. If the user does not have an entity, one will
     be created using the information in his Google account.
 
+    The user entity is cached in memcache, as an encoded protocol
+    buffer, so each call returns a new instance. Functions that change a
+    user entity must call invalidate_user().
+
     Returns:
         An instance of the User model, or None if the user is not
         logged in.
@@ -83,11 +147,33 @@ def get_logged_in_user():
     guser = users.get_current_user()
     if not guser:
         return None
-    user = User.get_by_key_name(guser.user_id())
-    if not user:
-        user = User(key_name=guser.user_id(), name=guser.nickname())
-        user.put()
-    return user
+    user_identifier = guser.user_id()
+    def encoded_user():
+        user = retry(User.get_by_key_name, user_identifier)
+        if not user:
+            user = User(key_name=user_identifier, name=guser.nickname())
+            retry(user.put)
+        return db.model_to_protobuf(user).Encode()
+    encoded = _cache.get_or_compute(_user_cache_key(user_identifier),
+                                    encoded_user,
+                                    ttl=USER_CACHE_TTL)
+    return db.model_from_protobuf(encoded)
+
+
+def invalidate_user(user_identifier):
+    """
+    Removes the cached entity of a user, so it is read from the datastore
+    again by get_logged_in_user().
+
+    Args:
+        user_identifier: The user identifier string
+    """
+    _cache.delete(_user_cache_key(user_identifier))
+
+
+def _user_cache_key(user_identifier):
+    """Returns the cache key of the entity of a user."""
+    return 'user:%s' % user_identifier
 
 
 def get_user(user_identifier):
@@ -151,7 +237,7 @@ def get_all_domains_for_user(user):
     """
     keys = [db.Key.from_path('Domain', domain)
             for domain in user.domains]
-    return Domain.get(keys)
+    return retry(Domain.get, keys)
 
 
 def get_task(domain_identifier, task_identifier):
@@ -213,28 +299,21 @@ def can_assign_to_self(task, user):
     return can_assign_task(task, user, user)
 
 
-def can_edit_task(domain, task, user):
+def can_edit_task(task, user):
     """
     Returns true if the user can edit the given task. This function
     returns true iff the user created the task, or if the user is
     an admin in the domain of the task.
 
     Args:
-       domain: An instance of the Domain model. Must be the
-           domain of the task.
        task: An instance of the Task model
        user: An instance of the User model
 
     Returns:
         True iff the user can edit the task.
-
-    Raises:
-        ValueError: If the domain and task do not match.
     """
-    if domain.identifier() != task.domain_identifier():
-        raise ValueError("Task is not in the domain '%s'" % domain.identifier())
-    return (task.user_identifier == user.identifier()
-            or user.identifier() in domain.admins)
+    return (task.user_identifier() == user.identifier()
+            or is_admin(task.domain_identifier(), user))
 
 
 def can_assign_task(task, user, assignee):
@@ -318,6 +397,7 @@ def create_task(domain_identifier,
     def txn():
         task = Task(parent=Domain.key_from_name(domain_identifier),
                     description=description,
+                    derived_title=Task.title_from_description(description),
                     user=user,
                     context=user.default_context_key())
         # TODO(tijmen): This get is redundant, the key can
@@ -334,6 +414,7 @@ def create_task(domain_identifier,
         return task
 
     task = db.run_in_transaction(txn)
+    bump_domain_version(domain_identifier)
     if assignee:
         assign_task(domain_identifier, task.identifier(), user, user)
     return task
@@ -376,7 +457,9 @@ def assign_task(domain_identifier, task_identifier, user, assignee):
         task.put()
         return task
 
-    return db.run_in_transaction(txn)
+    task = db.run_in_transaction(txn)
+    bump_domain_version(domain_identifier)
+    return task
 
 
 def set_task_completed(domain_identifier, user, task_identifier, completed):
@@ -411,7 +494,9 @@ def set_task_completed(domain_identifier, user, task_identifier, completed):
         task.put()
         return task
 
-    return db.run_in_transaction(txn)
+    task = db.run_in_transaction(txn)
+    bump_domain_version(domain_identifier)
+    return task
 
 
 def change_task_description(domain_identifier,
@@ -442,14 +527,15 @@ def change_task_description(domain_identifier,
 
     def txn():
         task = get_task(domain_identifier, task_identifier)
-        domain = get_domain(task.domain_identifier())
-        if not can_edit_task(domain, task, user):
+        if not can_edit_task(task, user):
             raise ValueError("User '%s' can not edit task '%s'", (user, task))
-        task.description = description
+        task.set_description(description)
         task.put()
         return task
 
-    return db.run_in_transaction(txn)
+    task = db.run_in_transaction(txn)
+    bump_domain_version(domain_identifier)
+    return task
 
 
 def change_task_parent(domain_identifier,
@@ -483,7 +569,7 @@ def change_task_parent(domain_identifier,
     if not member_of_domain(domain_identifier, user):
         raise ValueError("User is not a member of the domain")
 
-    user_is_admin = admin_of_domain(domain_identifier, user)
+    user_is_admin = is_admin(domain_identifier, user)
 
     def txn():
         task = get_task(domain_identifier, task_identifier)
@@ -514,7 +600,9 @@ def change_task_parent(domain_identifier,
                                             transactional=True)
         return task
 
-    return db.run_in_transaction(txn)
+    task = db.run_in_transaction(txn)
+    bump_domain_version(domain_identifier)
+    return task
 
 
 def create_domain(domain, domain_title, user):
@@ -543,19 +631,21 @@ def create_domain(domain, domain_title, user):
     if (not re.match(VALID_DOMAIN_IDENTIFIER, domain) or
         not domain_title):
         return None
-    existing = Domain.get_by_key_name(domain)
+    existing = retry(Domain.get_by_key_name, domain)
     if existing:
         return None
     new_domain = Domain(key_name=domain,
                         name=domain_title,
                         admins=[user.key().name()])
-    new_domain.put()
+    retry(new_domain.put)
+    invalidate_domain_admins(domain)
     def txn(user_key):
         txn_user = User.get(user_key)
         if not domain in txn_user.domains:
             txn_user.domains.append(domain)
             txn_user.put()
     db.run_in_transaction(txn, user.key())
+    invalidate_user(user.identifier())
     return new_domain
 
 
@@ -677,11 +767,150 @@ def get_all_direct_subtasks(domain_identifier,
     query = Task.all().\
         ancestor(Domain.key_from_name(domain_identifier)).\
         filter('parent_task = ', root_task)
-    tasks = query.fetch(limit)
+    tasks = retry(query.fetch, limit)
     _sort_tasks(tasks, user_identifier=user_identifier)
     return tasks
 
 
+def get_domain_statistics(domain_identifier, user_identifier=None):
+    """
+    Returns the task statistics of a domain, or of a single user in
+    the domain. Only atomic tasks are counted. The statistics are read
+    from memcache, or otherwise from the shards of the statistics with
+    a single batch get.
+
+    Args:
+        domain_identifier: The domain identifier string
+        user_identifier: Optional user identifier string. If provided,
+            only the tasks assigned to that user are counted.
+
+    Returns:
+        A dictionary with an integer value for each of the counters
+        in DomainStatistics.COUNTERS.
+    """
+    cache_key = _domain_statistics_cache_key(domain_identifier,
+                                             user_identifier)
+    statistics = memcache.get(cache_key)
+    if statistics is not None:
+        return statistics
+    statistics = dict((counter, 0) for counter in DomainStatistics.COUNTERS)
+    shards = retry(DomainStatistics.get,
+                   DomainStatistics.shard_keys(domain_identifier,
+                                               user_identifier))
+    for shard in shards:
+        if not shard:
+            continue
+        for counter in DomainStatistics.COUNTERS:
+            statistics[counter] += getattr(shard, counter)
+    memcache.set(cache_key, statistics, time=DOMAIN_STATISTICS_CACHE_TTL)
+    return statistics
+
+
+def invalidate_domain_statistics(domain_identifier, user_identifier=None):
+    """
+    Removes the cached statistics of a domain, or of a single user in
+    the domain, so they are read from the datastore again.
+
+    Args:
+        domain_identifier: The domain identifier string
+        user_identifier: Optional user identifier string
+    """
+    memcache.delete(_domain_statistics_cache_key(domain_identifier,
+                                                 user_identifier))
+
+
+def _domain_statistics_cache_key(domain_identifier, user_identifier):
+    """Returns the memcache key of the statistics of a domain or user."""
+    return 'domain-statistics:%s/%s' % (domain_identifier,
+                                         user_identifier or '')
+
+
+def get_domain_version(domain_identifier):
+    """
+    Returns the version of the tasks in a domain. The version changes
+    each time a task in the domain is changed, so it can be used to
+    check if pages of the domain have to be rendered again. The version
+    is kept in memcache only. If it is evicted or expires, a new
+    version is started from the current time, so it never returns to an
+    earlier value.
+
+    Args:
+        domain_identifier: The domain identifier string
+
+    Returns:
+        The version as a string, or None if memcache is not available,
+        in which case the pages can't be validated by their version.
+    """
+    cache_key = _domain_version_cache_key(domain_identifier)
+    version = memcache.get(cache_key)
+    if version is None:
+        memcache.add(cache_key, int(time.time() * 1000),
+                     time=DOMAIN_VERSION_TTL)
+        version = memcache.get(cache_key)
+        if version is None:
+            return None
+    return str(version)
+
+
+def bump_domain_version(domain_identifier):
+    """
+    Changes the version of the tasks in a domain. Must be called after
+    each change to a task in the domain, once the change is stored.
+
+    If the version can't be incremented, it is removed, so the next
+    version is started from the current time.
+
+    Args:
+        domain_identifier: The domain identifier string
+    """
+    cache_key = _domain_version_cache_key(domain_identifier)
+    if memcache.incr(cache_key) is None:
+        if memcache.delete(cache_key) == memcache.DELETE_NETWORK_FAILURE:
+            logging.error("Could not change the version of domain %s",
+                          domain_identifier)
+
+
+def _domain_version_cache_key(domain_identifier):
+    """Returns the memcache key of the version of a domain."""
+    return 'domain-version:%s' % domain_identifier
+
+
+def find_tasks_by_title(domain_identifier, prefix, limit=20):
+    """
+    Returns the tasks in a domain of which the title starts with the
+    given |prefix|. The comparison ignores case. Only the titles of
+    the tasks are fetched, through a projection query, so neither the
+    descriptions nor the derived properties of the tasks are loaded.
+
+    Tasks that were stored before the title was stored separately are
+    only found after the "Migrate task descriptions" mapper has run.
+
+    Args:
+        domain_identifier: The domain identifier string
+        prefix: The string prefix of the titles
+        limit: The maximum number of tasks to return.
+
+    Returns:
+        A list of at most |limit| (task identifier, title) tuples,
+        sorted on title. If the prefix is empty, the list is empty.
+
+    Raises:
+        ValueError: The limit is not a positive integer.
+    """
+    if limit <= 0:
+        raise ValueError("Invalid limit %d" % limit)
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+    query = db.Query(Task, projection=('derived_title',)).\
+        ancestor(Domain.key_from_name(domain_identifier)).\
+        filter('derived_title_lower >=', prefix).\
+        filter('derived_title_lower <', prefix + u'\ufffd').\
+        order('derived_title_lower')
+    return [(task.identifier(), task.title())
+            for task in retry(query.fetch, limit)]
+
+
 @db.transactional
 def _check_for_cycle(task, new_parent):
     """
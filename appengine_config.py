@@ -20,5 +20,7 @@ use_library('django', '1.2')
 
 def webapp_add_wsgi_middleware(app):
     from google.appengine.ext.appstats import recording
+    from appengine_utilities.rotmodel import RequestDeadlineMiddleware
     app = recording.appstats_wsgi_middleware(app)
+    app = RequestDeadlineMiddleware(app)
     return app
@@ -31,6 +31,7 @@ import datetime
 import pickle
 import random
 import sys
+import time
 
 # google appengine import
 from google.appengine.ext import db
@@ -47,11 +48,124 @@ except:
     settings = settings_default
     
 class _AppEngineUtilities_Cache(db.Model):
+    # Entities are stored with the key name 'cache-<cachekey>', so they
+    # can be fetched by key.
     cachekey = db.StringProperty()
     createTime = db.DateTimeProperty(auto_now_add=True)
     timeout = db.DateTimeProperty()
     value = db.BlobProperty()
 
+    @staticmethod
+    def key_name(key):
+        """
+        Returns the datastore key name of the entity for a cache key.
+        """
+        return 'cache-%s' % (key)
+
+
+class _Missing(object):
+    """
+    Stored in memcache and the local cache for keys that are known not to
+    be in the cache, so repeated misses don't reach the datastore.
+    """
+    pass
+
+
+class _LocalCache(object):
+    """
+    A bounded in-process cache of the most recently used items, each with
+    its own expiry time. Items live as long as the instance, so this saves
+    the memcache calls of repeated gets on a warm instance.
+
+    The items are kept in a dictionary, and in a doubly linked list in
+    order of use, so get and set don't depend on the size of the cache.
+    """
+
+    # indexes in the list of a linked list node
+    PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+    def __init__(self, size):
+        """
+        Initializer
+
+        Args:
+            size: the maximum number of items, 0 disables the cache
+        """
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        """
+        Removes all items.
+        """
+        self.items = {}
+        self.root = [None, None, None, None, None]
+        self.root[self.PREV] = self.root[self.NEXT] = self.root
+
+    def _unlink(self, node):
+        node[self.PREV][self.NEXT] = node[self.NEXT]
+        node[self.NEXT][self.PREV] = node[self.PREV]
+
+    def _link(self, node):
+        last = self.root[self.PREV]
+        node[self.PREV] = last
+        node[self.NEXT] = self.root
+        last[self.NEXT] = self.root[self.PREV] = node
+
+    def get(self, key):
+        """
+        Returns the value of key, or None if it is not cached or expired.
+        """
+        node = self.items.get(key)
+        if node is None:
+            return None
+        if node[self.EXPIRES] <= time.time():
+            self.delete(key)
+            return None
+        self._unlink(node)
+        self._link(node)
+        return node[self.VALUE]
+
+    def set(self, key, value, seconds):
+        """
+        Caches value for key during seconds, and removes the least
+        recently used item if the cache is full.
+        """
+        if self.size <= 0 or seconds <= 0:
+            return
+        self.delete(key)
+        node = [None, None, key, value, time.time() + seconds]
+        self._link(node)
+        self.items[key] = node
+        if len(self.items) > self.size:
+            self.delete(self.root[self.NEXT][self.KEY])
+
+    def delete(self, key):
+        """
+        Removes key from the cache, if present.
+        """
+        node = self.items.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+
+
+# shared by all Cache objects, so it lasts as long as the instance
+_local_cache = _LocalCache(settings.cache["LOCAL_CACHE_SIZE"])
+
+
+def _fire_event(event):
+    if 'AEU_Events' in sys.modules['__main__'].__dict__:
+        sys.modules['__main__'].AEU_Events.fire_event(event)
+
+
+def _seconds_until(timeout):
+    """
+    Returns the number of whole seconds until the datetime timeout, at
+    least 1, as memcache takes a timeout of 0 as never expiring.
+    """
+    delta = timeout - datetime.datetime.now()
+    return max(delta.days * 86400 + delta.seconds, 1)
+
 
 class Cache(object):
     """
@@ -66,11 +180,29 @@ class Cache(object):
     to store data in both memcache, and the datastore. However, should a
     datastore write fail, it will not try again. This is for performance
     reasons.
+
+    Reads go through three tiers: a bounded in-process cache that is
+    shared by all Cache objects of the instance, memcache and the
+    datastore. Items are kept in the in-process cache for at most
+    local_timeout seconds, so a change made on another instance can take
+    that long to show up. Keys that are not in the cache are remembered
+    as missing for negative_timeout seconds, so repeated misses don't
+    reach the datastore. get_many and set_many use a single memcache
+    call and a single datastore call for all keys.
+
+    Values that are expensive to compute can be cached with
+    get_or_compute, which lets a single request recompute an expired
+    value while the others keep using the previous one.
     """
 
     def __init__(self, clean_check_percent = settings.cache["CLEAN_CHECK_PERCENT"],
       max_hits_to_clean = settings.cache["MAX_HITS_TO_CLEAN"],
-        default_timeout = settings.cache["DEFAULT_TIMEOUT"]):
+        default_timeout = settings.cache["DEFAULT_TIMEOUT"],
+        local_timeout = settings.cache["LOCAL_TIMEOUT"],
+        negative_timeout = settings.cache["NEGATIVE_TIMEOUT"],
+        stale_timeout = settings.cache["STALE_TIMEOUT"],
+        lease_timeout = settings.cache["LEASE_TIMEOUT"],
+        lease_wait = settings.cache["LEASE_WAIT"]):
         """
         Initializer
 
@@ -79,19 +211,34 @@ class Cache(object):
                 run the cache cleanup
             max_hits_to_clean: maximum number of stale hits to clean
             default_timeout: default length a cache item is good for
+            local_timeout: maximum number of seconds an item is kept in
+                the in-process cache, 0 disables it
+            negative_timeout: number of seconds a key that is not in the
+                cache is remembered as missing, 0 disables it
+            stale_timeout: number of seconds get_or_compute returns an
+                expired value while another request recomputes it
+            lease_timeout: number of seconds get_or_compute lets one
+                request recompute a value before another may take over
+            lease_wait: number of seconds get_or_compute waits for another
+                request to recompute a value it has no stale value of
         """
         self.clean_check_percent = clean_check_percent
         self.max_hits_to_clean = max_hits_to_clean
         self.default_timeout = default_timeout
-
-        if random.randint(1, 100) < self.clean_check_percent:
+        self.local_timeout = local_timeout
+        self.negative_timeout = negative_timeout
+        self.stale_timeout = stale_timeout
+        self.lease_timeout = lease_timeout
+        self.lease_wait = lease_wait
+
+        if (self.clean_check_percent and
+            random.randint(1, 100) < self.clean_check_percent):
             try:
                 self._clean_cache()
             except:
                 pass
 
-        if 'AEU_Events' in sys.modules['__main__'].__dict__:
-            sys.modules['__main__'].AEU_Events.fire_event('cacheInitialized')
+        _fire_event('cacheInitialized')
 
     def _clean_cache(self):
         """
@@ -113,6 +260,38 @@ class Cache(object):
 
         return True
 
+    @classmethod
+    def delete_expired(cls, batch_size=100, cursor=None):
+        """
+        Deletes a batch of expired cache items from the datastore.
+
+        This is meant to be called from a scheduled batch job, so the
+        CLEAN_CHECK_PERCENT cleanup does not have to run inline in user
+        requests. Only keys are queried, and the batch is deleted with a
+        single delete call. Memcache expires the items on its own.
+
+        Args:
+            batch_size: The maximum number of items to delete.
+            cursor: The cursor returned by the previous call, or None to
+                start at the first expired item.
+
+        Returns a tuple of the number of deleted items and the cursor
+        for the next batch, which is None if there are no more expired
+        items.
+        """
+        query = _AppEngineUtilities_Cache.all(keys_only=True)
+        query.filter('timeout < ', datetime.datetime.now())
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(batch_size)
+        if not keys:
+            return 0, None
+        next_cursor = query.cursor()
+        db.delete(keys)
+        if len(keys) < batch_size:
+            next_cursor = None
+        return len(keys), next_cursor
+
     def _validate_key(self, key):
         """
         Internal method for key validation. This can be used by a superclass
@@ -164,6 +343,36 @@ class Cache(object):
 
         return timeout
 
+    def _new_entry(self, key, value, timeout):
+        """
+        Internal method that returns a new, unsaved cache entity.
+        """
+        return _AppEngineUtilities_Cache(
+            key_name=_AppEngineUtilities_Cache.key_name(key),
+            cachekey=key, value=pickle.dumps(value), timeout=timeout)
+
+    def _cache_locally(self, key, value, seconds):
+        """
+        Internal method that stores a value in the in-process cache for
+        at most local_timeout seconds.
+        """
+        _local_cache.set(key, value, min(seconds, self.local_timeout))
+
+    def _cache_missing(self, keys):
+        """
+        Internal method that remembers keys as missing in memcache and
+        the in-process cache. Uses add, so a value that was stored
+        concurrently isn't replaced by the marker.
+        """
+        if not keys or self.negative_timeout <= 0:
+            return
+        missing = _Missing()
+        not_added = memcache.add_multi(dict([(key, missing) for key in keys]),
+            self.negative_timeout, key_prefix='cache-')
+        for key in keys:
+            if key not in not_added:
+                self._cache_locally(key, missing, self.negative_timeout)
+
     def add(self, key = None, value = None, timeout = None):
         """
         Adds an entry to the cache, if one does not already exist. If they key
@@ -183,10 +392,25 @@ class Cache(object):
         if key in self:
             raise KeyError
 
-        cacheEntry = _AppEngineUtilities_Cache()
-        cacheEntry.cachekey = key
-        cacheEntry.value = pickle.dumps(value)
-        cacheEntry.timeout = timeout
+        self.set(key, value, timeout)
+        _fire_event('cacheAdded')
+        return value
+
+    def set(self, key = None, value = None, timeout = None):
+        """
+        Sets an entry to the cache, overwriting an existing value
+        if one already exists.
+
+        Args:
+            key: Key name of the cache object
+            value: Value of the cache object
+            timeout: timeout value for the cache object.
+
+        Returns the cache object.
+        """
+        self._validate_key(key)
+        self._validate_value(value)
+        timeout = self._validate_timeout(timeout)
 
         # try to put the entry, if it fails silently pass
         # failures may happen due to timeouts, the datastore being read
@@ -194,53 +418,48 @@ class Cache(object):
         # not being able to write to the datastore should not
         # break the application
         try:
-            cacheEntry.put()
+            self._new_entry(key, value, timeout).put()
         except:
             pass
 
-        memcache_timeout = timeout - datetime.datetime.now()
-        memcache.set('cache-%s' % (key), value, int(memcache_timeout.seconds))
+        seconds = _seconds_until(timeout)
+        memcache.set('cache-%s' % (key), value, seconds)
+        self._cache_locally(key, value, seconds)
 
-        if 'AEU_Events' in sys.modules['__main__'].__dict__:
-            sys.modules['__main__'].AEU_Events.fire_event('cacheAdded')
+        _fire_event('cacheSet')
 
-        return self.get(key)
+        return value
 
-    def set(self, key = None, value = None, timeout = None):
+    def set_many(self, mapping, timeout = None):
         """
-        Sets an entry to the cache, overwriting an existing value
-        if one already exists.
+        Sets all entries of a dictionary with a single memcache call and a
+        single datastore put, overwriting existing values.
 
         Args:
-            key: Key name of the cache object
-            value: Value of the cache object
-            timeout: timeout value for the cache object.
+            mapping: A dictionary of key/value pairs.
+            timeout: timeout value for the cache objects.
 
-        Returns the cache object.
+        Returns the mapping.
         """
-        self._validate_key(key)
-        self._validate_value(value)
+        for key, value in mapping.items():
+            self._validate_key(key)
+            self._validate_value(value)
         timeout = self._validate_timeout(timeout)
 
-        cacheEntry = self._read(key)
-        if not cacheEntry:
-            cacheEntry = _AppEngineUtilities_Cache()
-            cacheEntry.cachekey = key
-        cacheEntry.value = pickle.dumps(value)
-        cacheEntry.timeout = timeout
-
         try:
-            cacheEntry.put()
+            db.put([self._new_entry(key, value, timeout)
+                    for key, value in mapping.items()])
         except:
             pass
 
-        memcache_timeout = timeout - datetime.datetime.now()
-        memcache.set('cache-%s' % (key), value, int(memcache_timeout.seconds))
+        seconds = _seconds_until(timeout)
+        memcache.set_multi(mapping, seconds, key_prefix='cache-')
+        for key, value in mapping.items():
+            self._cache_locally(key, value, seconds)
 
-        if 'AEU_Events' in sys.modules['__main__'].__dict__:
-            sys.modules['__main__'].AEU_Events.fire_event('cacheSet')
+        _fire_event('cacheSet')
 
-        return value
+        return mapping
 
     def _read(self, key = None):
         """
@@ -253,19 +472,15 @@ class Cache(object):
 
         Returns the cache entity
         """
-        query = _AppEngineUtilities_Cache.all()
-        query.filter('cachekey', key)
-        query.filter('timeout > ', datetime.datetime.now())
-        results = query.fetch(1)
-        if len(results) is 0:
+        result = _AppEngineUtilities_Cache.get_by_key_name(
+            _AppEngineUtilities_Cache.key_name(key))
+        if result is None or result.timeout <= datetime.datetime.now():
             return None
 
-        if 'AEU_Events' in sys.modules['__main__'].__dict__:
-            sys.modules['__main__'].AEU_Events.fire_event('cacheReadFromDatastore')
-        if 'AEU_Events' in sys.modules['__main__'].__dict__:
-            sys.modules['__main__'].AEU_Events.fire_event('cacheRead')
+        _fire_event('cacheReadFromDatastore')
+        _fire_event('cacheRead')
 
-        return results[0]
+        return result
 
     def delete(self, key = None):
         """
@@ -276,12 +491,14 @@ class Cache(object):
 
         Returns True.
         """
-        memcache.delete('cache-%s' % (key))
-        result = self._read(key)
-        if result:
-            if 'AEU_Events' in sys.modules['__main__'].__dict__:
-                sys.modules['__main__'].AEU_Events.fire_event('cacheDeleted')
-            result.delete()
+        memcache.delete_multi(['cache-%s' % (key), 'cache-stale-%s' % (key)])
+        _local_cache.delete(key)
+        try:
+            db.delete(db.Key.from_path(_AppEngineUtilities_Cache.kind(),
+                _AppEngineUtilities_Cache.key_name(key)))
+        except:
+            pass
+        _fire_event('cacheDeleted')
         return True
 
     def get(self, key):
@@ -293,41 +510,141 @@ class Cache(object):
 
         Returns the value of the cache item.
         """
-        mc = memcache.get('cache-%s' % (key))
-        if mc:
-            if 'AEU_Events' in sys.modules['__main__'].__dict__:
-                sys.modules['__main__'].AEU_Events.fire_event('cacheReadFromMemcache')
-            if 'AEU_Events' in sys.modules['__main__'].__dict__:
-                sys.modules['__main__'].AEU_Events.fire_event('cacheRead')
-            return mc
-        result = self._read(key)
-        if result:
-            timeout = result.timeout - datetime.datetime.now()
-            memcache.set('cache-%s' % (key), pickle.loads(result.value),
-               int(timeout.seconds))
-            if 'AEU_Events' in sys.modules['__main__'].__dict__:
-                sys.modules['__main__'].AEU_Events.fire_event('cacheRead')
-            return pickle.loads(result.value)
-        else:
+        value = self.get_many([key]).get(key)
+        if value is None:
             raise KeyError
+        return value
 
     def get_many(self, keys):
         """
         Returns a dict mapping each key in keys to its value. If the given
         key is missing, it will be missing from the response dict.
 
+        Keys that are not in the in-process cache are read with a single
+        memcache call, and the rest with a single datastore get.
+
         Args:
             keys: A list of keys to retrieve.
 
         Returns a dictionary of key/value pairs.
         """
+        return self._get_many(keys)
+
+    def _get_many(self, keys, from_datastore=True):
+        """
+        Internal method that implements get_many. Reads only the
+        in-process cache and memcache if from_datastore is False, in which
+        case misses are not remembered either.
+        """
         dict = {}
+        remaining = []
         for key in keys:
-            value = self.get(key)
-            if value is not None:
+            value = _local_cache.get(key)
+            if value is None:
+                remaining.append(key)
+            elif not isinstance(value, _Missing):
                 dict[key] = value
+        if not remaining:
+            return dict
+
+        mc = memcache.get_multi(remaining, key_prefix='cache-')
+        keys = remaining
+        remaining = []
+        for key in keys:
+            if key not in mc:
+                remaining.append(key)
+            elif isinstance(mc[key], _Missing):
+                self._cache_locally(key, mc[key], self.negative_timeout)
+            else:
+                self._cache_locally(key, mc[key], self.local_timeout)
+                dict[key] = mc[key]
+                _fire_event('cacheReadFromMemcache')
+                _fire_event('cacheRead')
+        if not remaining or not from_datastore:
+            return dict
+
+        results = _AppEngineUtilities_Cache.get_by_key_name(
+            [_AppEngineUtilities_Cache.key_name(key) for key in remaining])
+        now = datetime.datetime.now()
+        found = {}
+        missing = []
+        for key, result in zip(remaining, results):
+            if result is None or result.timeout <= now:
+                missing.append(key)
+                continue
+            value = pickle.loads(result.value)
+            seconds = _seconds_until(result.timeout)
+            # memcache.set_multi takes a single timeout, so group by it
+            found.setdefault(seconds, {})[key] = value
+            self._cache_locally(key, value, seconds)
+            dict[key] = value
+            _fire_event('cacheReadFromDatastore')
+            _fire_event('cacheRead')
+        for seconds, mapping in found.items():
+            memcache.set_multi(mapping, seconds, key_prefix='cache-')
+        self._cache_missing(missing)
         return dict
 
+    def get_or_compute(self, key, fn, ttl = None, persist = False):
+        """
+        Returns the cached value of key, or computes it by calling fn() and
+        caches the result for ttl seconds.
+
+        When the value expires, only one request recomputes it. That
+        request takes a lease on the key in memcache, and other requests
+        return the previous value for up to stale_timeout seconds after
+        it expired. Requests that find no previous value wait up to
+        lease_wait seconds for the lease holder, and then compute the
+        value themselves.
+
+        Args:
+            key: The key of the value.
+            fn: Called without arguments to compute the value, which may
+                not be None.
+            ttl: Number of seconds the value is fresh, or None for the
+                default timeout.
+            persist: Also store the value in the datastore. By default
+                computed values are only kept in memcache and in-process,
+                since they can be recomputed.
+
+        Returns the value.
+        """
+        self._validate_key(key)
+        if ttl is None:
+            ttl = self.default_timeout
+        value = self._get_many([key], from_datastore=persist).get(key)
+        if value is not None:
+            return value
+
+        stale_key = 'cache-stale-%s' % (key)
+        lease_key = 'cache-lease-%s' % (key)
+        leased = memcache.add(lease_key, 1, self.lease_timeout)
+        if not leased:
+            value = memcache.get(stale_key)
+            if value is not None:
+                _fire_event('cacheReadStale')
+                return value
+            deadline = time.time() + self.lease_wait
+            while time.time() < deadline:
+                time.sleep(0.05)
+                value = self._get_many([key], from_datastore=False).get(key)
+                if value is not None:
+                    return value
+
+        try:
+            value = fn()
+            self._validate_value(value)
+            if persist:
+                self.set(key, value, ttl)
+            else:
+                memcache.set('cache-%s' % (key), value, ttl)
+                self._cache_locally(key, value, ttl)
+            memcache.set(stale_key, value, ttl + self.stale_timeout)
+        finally:
+            if leased:
+                memcache.delete(lease_key)
+        return value
+
     def __getitem__(self, key):
         """
         __getitem__ is necessary for this object to emulate a container.
@@ -64,5 +64,6 @@ class SessionMiddleware(object):
 
     def process_response(self, request, response):
         if hasattr(request, "session"):
+            request.session.commit()
             response.cookies= request.session.output_cookie
         return response
@@ -25,6 +25,8 @@ ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import logging
+import random
 import time
 from google.appengine.api import datastore
 from google.appengine.ext import db
@@ -39,6 +41,148 @@ try:
 except:
     settings = settings_default
 
+# The datastore errors that are worth retrying
+RETRY_ERRORS = (db.Timeout, db.InternalError)
+
+# The time at which retries of the current request must have
+# finished, set by start_request()
+_request_deadline = None
+
+# Retry counters of this instance: the number of calls made through
+# retry(), the number of retries, the number of calls that gave up and
+# the total number of seconds slept between retries.
+retry_stats = {
+    'calls': 0,
+    'retries': 0,
+    'failures': 0,
+    'sleep_sec': 0.0,
+}
+
+
+def start_request(task=False):
+    """
+    Records the start of a request, so retries give up before the
+    deadline of the request. Called by RequestDeadlineMiddleware.
+
+    Args:
+        task: True if the request is a task queue request, which has a
+            longer deadline than a user request.
+    """
+    global _request_deadline
+    if task:
+        deadline = settings.rotmodel["TASK_DEADLINE"]
+    else:
+        deadline = settings.rotmodel["REQUEST_DEADLINE"]
+    _request_deadline = (time.time() + deadline -
+                         settings.rotmodel["DEADLINE_MARGIN"])
+
+
+def request_deadline():
+    """
+    Returns the time in seconds since the epoch after which the
+    current request starts no retries, or None if no request was
+    started.
+    """
+    return _request_deadline
+
+
+class RequestDeadlineMiddleware(object):
+    """
+    WSGI middleware that calls start_request() at the start of each
+    request, so retry() is aware of the deadline of the request.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        start_request(task='HTTP_X_APPENGINE_QUEUENAME' in environ)
+        return self.app(environ, start_response)
+
+
+def retry(function, *args, **kwargs):
+    """
+    Calls function with the given arguments, and retries it when it
+    raises a datastore timeout, until the deadline of the current
+    request. See retry_until.
+
+    Returns the return value of function.
+    """
+    return retry_until(request_deadline(), function, *args, **kwargs)
+
+
+def put_multi(entities, deadline=None):
+    """
+    Puts the entities in batches of at most PUT_BATCH_SIZE entities,
+    one datastore call per batch. Each batch is retried as in
+    retry_until. The batches are idempotent, so a retry of a batch
+    whose put succeeded is harmless.
+
+    Args:
+        entities: A list of model instances.
+        deadline: Time in seconds since the epoch after which no retry
+            is started, or None to use the deadline of the current
+            request.
+
+    Returns a list with the keys of the entities.
+    """
+    if deadline is None:
+        deadline = request_deadline()
+    batch_size = settings.rotmodel["PUT_BATCH_SIZE"]
+    keys = []
+    for i in xrange(0, len(entities), batch_size):
+        keys.extend(retry_until(deadline, db.put,
+                                entities[i:i + batch_size]))
+    return keys
+
+
+def retry_until(deadline, function, *args, **kwargs):
+    """
+    Calls function with the given arguments, and retries it when it
+    raises one of RETRY_ERRORS, at most RETRY_ATTEMPTS times in total.
+
+    The time between attempts grows exponentially from RETRY_INTERVAL
+    up to RETRY_MAX_INTERVAL seconds, and a random part of it is used,
+    so requests that failed at the same time don't retry at the same
+    time. Inside a transaction the function is called only once, since
+    the transaction itself is retried.
+
+    Args:
+        deadline: Time in seconds since the epoch, as returned by
+            time.time(), after which no attempt is started, or None.
+        function: The function to call, for instance db.get or the
+            fetch method of a query.
+
+    Returns the return value of function.
+
+    Raises:
+        The last error raised by function, if all attempts failed or
+        the deadline does not leave time for another attempt.
+    """
+    retry_stats['calls'] += 1
+    if db.is_in_transaction():
+        return function(*args, **kwargs)
+    attempts = settings.rotmodel["RETRY_ATTEMPTS"]
+    count = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except RETRY_ERRORS:
+            count += 1
+            interval = min(settings.rotmodel["RETRY_MAX_INTERVAL"],
+                           settings.rotmodel["RETRY_INTERVAL"] * 2 ** (count - 1))
+            interval = random.uniform(0, interval)
+            if count >= attempts or \
+               (deadline is not None and time.time() + interval >= deadline):
+                retry_stats['failures'] += 1
+                logging.warning("Giving up on %s after %d attempts",
+                                getattr(function, '__name__', function),
+                                count)
+                raise
+            retry_stats['retries'] += 1
+            retry_stats['sleep_sec'] += interval
+            time.sleep(interval)
+
+
 class ROTModel(db.Model):
     """
     ROTModel overrides the db.Model functions, retrying each method each time
@@ -54,27 +198,11 @@ class ROTModel(db.Model):
 
     @classmethod
     def get(cls, keys):
-        count = 0
-        while count < settings.rotmodel["RETRY_ATTEMPTS"]:
-            try:
-                return db.Model.get(keys)
-            except db.Timeout:
-                count += 1
-                time.sleep(count * settings.rotmodel["RETRY_INTERVAL"])
-        else:
-            raise db.Timeout()
+        return retry(super(ROTModel, cls).get, keys)
 
     @classmethod
     def get_by_id(cls, ids, parent=None):
-        count = 0
-        while count < settings.rotmodel["RETRY_ATTEMPTS"]:
-            try:
-                return db.Model.get_by_id(ids, parent)
-            except db.Timeout:
-                count += 1
-                time.sleep(count * settings.rotmodel["RETRY_INTERVAL"])
-        else:
-            raise db.Timeout()
+        return retry(super(ROTModel, cls).get_by_id, ids, parent)
 
     @classmethod
     def get_by_key_name(cls, key_names, parent=None):
@@ -83,21 +211,10 @@ class ROTModel(db.Model):
         key_names, multiple = datastore.NormalizeAndTypeCheck(key_names, basestring)
         keys = [datastore.Key.from_path(cls.kind(), name, parent=parent)
                 for name in key_names]
-        count = 0
         if multiple:
-            while count < settings.rotmodel["RETRY_ATTEMPTS"]:
-                try:
-                    return db.get(keys)
-                except db.Timeout:
-                    count += 1
-                    time.sleep(count * settings.rotmodel["RETRY_INTERVAL"])
+            return retry(db.get, keys)
         else:
-            while count < settings.rotmodel["RETRY_ATTEMPTS"]:
-                try:
-                    return db.get(*keys)
-                except db.Timeout:
-                    count += 1
-                    time.sleep(count * settings.rotmodel["RETRY_INTERVAL"])
+            return retry(db.get, *keys)
 
     @classmethod
     def get_or_insert(cls, key_name, **kwargs):
@@ -110,25 +227,7 @@ class ROTModel(db.Model):
         return db.run_in_transaction(txn)
 
     def put(self):
-        count = 0
-        while count < settings.rotmodel["RETRY_ATTEMPTS"]:
-            try:
-                return db.Model.put(self)
-            except db.Timeout:
-                count += 1
-                time.sleep(count * settings.rotmodel["RETRY_INTERVAL"])
-        else:
-            raise db.Timeout()
+        return retry(db.Model.put, self)
 
     def delete(self):
-        count = 0
-        while count < settings.rotmodel["RETRY_ATTEMPTS"]:
-            try:
-                return db.Model.delete(self)
-            except db.Timeout:
-                count += 1
-                time.sleep(count * settings.rotmodel["RETRY_INTERVAL"])
-        else:
-            raise db.Timeout()
-
-
+        return retry(db.Model.delete, self)
@@ -34,6 +34,7 @@ import random
 import hashlib
 import Cookie
 import pickle
+import zlib
 import warnings
 import sys
 import logging
@@ -71,6 +72,124 @@ class _AppEngineUtilities_Session(db.Model):
     dirty = db.BooleanProperty(default=False)
     working = db.BooleanProperty(default=False)
     deleted = db.BooleanProperty(default=False)
+    # All items of the session as a single dictionary, encoded by
+    # set_data(). None for sessions that still store their items as
+    # separate _AppEngineUtilities_SessionData entities.
+    data = db.BlobProperty()
+
+    # The first byte of the encoded data. Data without a known version
+    # byte is a plain pickle, as written by earlier versions.
+    DATA_VERSION = '\x01'
+
+    def get_data(self):
+        """
+        Returns a dictionary with all items of the session.
+
+        Sessions that were stored with a _AppEngineUtilities_SessionData
+        entity per item are migrated: their items are read once and
+        stored in the data property, after which the old entities are
+        deleted.
+        """
+        if self.data is None:
+            return self._migrate_items()
+        if self.data[:1] == self.DATA_VERSION:
+            return pickle.loads(zlib.decompress(self.data[1:]))
+        return pickle.loads(self.data)
+
+    def set_data(self, items):
+        """
+        Stores all items of the session in the data property as a
+        compressed pickle, prefixed by DATA_VERSION. Does not put the
+        session.
+
+        Args:
+            items: a dictionary with all items of the session
+        """
+        self.data = db.Blob(self.DATA_VERSION + zlib.compress(
+            pickle.dumps(items, pickle.HIGHEST_PROTOCOL)))
+
+    def update_data(self, changed, deleted=(), replace=False):
+        """
+        Applies changes to the items of the session and writes them,
+        in a transaction that reads the stored items first, so
+        concurrent requests that change different items of the same
+        session don't overwrite each other's changes. Updates this
+        instance and memcache with the result.
+
+        Args:
+            changed: a dictionary with the items that were set
+            deleted: the keynames of the items that were deleted
+            replace: if True, the stored items are replaced by |changed|
+
+        Returns a dictionary with all items of the session.
+        """
+        # Items stored as separate entities are migrated first, as
+        # that can't be done in the transaction.
+        current = self.get_data()
+        if not self.is_saved():
+            self.put()
+        now = datetime.datetime.now()
+        def txn():
+            session = db.get(self.key())
+            if session is None or replace:
+                items = {}
+            else:
+                items = session.get_data()
+            items.update(changed)
+            for keyname in deleted:
+                items.pop(keyname, None)
+            self.set_data(items)
+            self.last_activity = now
+            self.dirty = False
+            db.Model.put(self)
+            return items
+        try:
+            items = db.run_in_transaction(txn)
+        except db.Error:
+            # same as put(): keep the changes in memcache, marked dirty
+            if replace:
+                current = {}
+            current.update(changed)
+            for keyname in deleted:
+                current.pop(keyname, None)
+            self.set_data(current)
+            self.put()
+            return current
+        memcache.set(u"_AppEngineUtilities_Session_%s" % \
+            (str(self.key())), self)
+        return items
+
+    def _migrate_items(self):
+        """
+        Moves the items stored as _AppEngineUtilities_SessionData
+        entities into the data property, puts the session and deletes
+        the old entities.
+
+        Returns a dictionary with all items of the session.
+        """
+        items = {}
+        if not self.is_saved():
+            return items
+        results = self.get_items_ds()
+        for result in results:
+            try:
+                if result.model != None:
+                    items[result.keyname] = result.model
+                else:
+                    items[result.keyname] = pickle.loads(result.content)
+            except:
+                logging.warning(u"Dropping unreadable session item %s" % \
+                    (result.keyname))
+        self.set_data(items)
+        self.put()
+        try:
+            db.delete(results)
+        except:
+            # left for delete_expired_sessions to clean up
+            pass
+        memcache.delete(u"_AppEngineUtilities_SessionData_%s" % \
+            (str(self.key())))
+        return items
 
     def put(self):
         """
@@ -151,8 +270,6 @@ class _AppEngineUtilities_Session(db.Model):
               return None
           memcache.set(u"_AppEngineUtilities_Session_%s" % \
               (str(session_key)), ds_session)
-          memcache.set(u"_AppEngineUtilities_SessionData_%s" % \
-              (str(session_key)), ds_session.get_items_ds())
         return ds_session
 
 
@@ -223,10 +340,11 @@ class _AppEngineUtilities_Session(db.Model):
         Returns True
         """
         try:
-            query = _AppEngineUtilities_SessionData.all()
-            query.filter(u"session = ", self)
-            results = query.fetch(1000)
-            db.delete(results)
+            if self.data is None:
+                # items are still stored as separate entities
+                query = _AppEngineUtilities_SessionData.all(keys_only=True)
+                query.filter(u"session = ", self)
+                db.delete(query.fetch(1000))
             db.delete(self)
             memcache.delete_multi([u"_AppEngineUtilities_Session_%s" % \
                 (str(self.key())), \
@@ -327,12 +445,17 @@ class _DatastoreWriter(object):
     def put(self, keyname, value, session):
         """
         Insert a keyname/value pair into the datastore for the session.
+        All items are stored in the session entity; the item is added to
+        the stored items in a transaction, see
+        _AppEngineUtilities_Session.update_data(). A db.Model value is
+        put if it isn't saved yet, and stored as a pickled snapshot of
+        the entity, not as a reference.
 
         Args:
             keyname: The keyname of the mapping.
             value: The value of the mapping.
 
-        Returns the model entity key
+        Returns the session entity key
         """
         keyname = session._validate_key(keyname)
         if value is None:
@@ -341,34 +464,40 @@ class _DatastoreWriter(object):
         # datestore write trumps cookie. If there is a cookie value
         # with this keyname, delete it so we don't have conflicting
         # entries.
-        if session.cookie_vals.has_key(keyname):
-            del(session.cookie_vals[keyname])
-            session.output_cookie["%s_data" % (session.cookie_name)] = \
-                simplejson.dumps(session.cookie_vals)
-            session.output_cookie["%s_data" % (session.cookie_name)]["path"] = \
-                session.cookie_path
-            if session.cookie_domain:
-                session.output_cookie["%s_data" % \
-                    (session.cookie_name)]["domain"] = session.cookie_domain
-            session.output_cookie_headers()
-
-        sessdata = session._get(keyname=keyname)
-        if sessdata is None:
-            sessdata = _AppEngineUtilities_SessionData()
-            # sessdata.session_key = session.session.key()
-            sessdata.keyname = keyname
-        try:
-            db.model_to_protobuf(value)
-            if not value.is_saved():
-                value.put()
-            sessdata.model = value
-        except:
-            sessdata.content = pickle.dumps(value)
-            sessdata.model = None
-        sessdata.session = session.session
+        session._remove_cookie_value(keyname)
+
+        if isinstance(value, db.Model) and not value.is_saved():
+            value.put()
+        session._get_data()[keyname] = value
+        session.cache[keyname] = value
+        return session._save_data({keyname: value})
+
+
+class _MemcacheWriter(object):
+
+    def put(self, keyname, value, session):
+        """
+        Insert a keyname/value pair into the session items. The items are
+        kept in the request until Session.commit() writes them to memcache
+        and the datastore as a single entity.
+
+        Args:
+            keyname: The keyname of the mapping.
+            value: The value of the mapping.
 
+        Returns True
+        """
+        keyname = session._validate_key(keyname)
+        if value is None:
+            raise ValueError(u"You must pass a value to put.")
+
+        # server side write trumps cookie, like the datastore writer
+        session._remove_cookie_value(keyname)
+
+        session._get_data()[keyname] = value
         session.cache[keyname] = value
-        return sessdata.put()
+        session._dirty = True
+        return True
 
 
 class _CookieWriter(object):
@@ -446,8 +575,29 @@ class Session(object):
         .appspot.com domain, and ssl requests are a finite resource. This is
         why such a thing is not currently implemented.
 
-        Session data objects are stored in the datastore pickled, so any
-        python object is valid for storage.
+        Session data objects are stored pickled, so any python object is
+        valid for storage. All items are kept as a single compressed
+        dictionary on the session entity, which is cached in memcache, so
+        a session is loaded with a single memcache get, or a single
+        datastore get by key on a cache miss. Each change is written in
+        a transaction on the session entity that applies it to the stored
+        items, so requests changing different items of the same session
+        don't lose each other's changes. Sessions that still store
+        their items as separate _AppEngineUtilities_SessionData entities
+        are migrated the first time their items are read.
+
+        db.Model instances are pickled along with the other items, so a
+        session item holds a snapshot of the entity as it was when it was
+        stored, not a reference to it: later changes to the entity are not
+        seen through the session. Store the key instead and get the entity
+        when it's needed if that matters. Items of migrated sessions that
+        used to be references become such snapshots as well.
+
+    Memcache Writer:
+        The memcache writer uses the same session token system and storage
+        as the datastore writer, but keeps changes in the request, and
+        writes them with a single put by calling commit() at the end of the
+        request. Nothing is written if the session did not change.
 
     Cookie Writer:
         Sessions using the cookie writer are stored entirely in the browser
@@ -528,6 +678,9 @@ class Session(object):
         self.last_activity_update = last_activity_update
         self.writer = writer
         self.wsgiref_headers = wsgiref_headers
+        # Session items and changes of the memcache writer
+        self._data = None
+        self._dirty = False
 
         if self.wsgiref_headers is None:
             warnings.warn('using Session without wsgiref_headers is deprecated (see <http://github.com/joerussbowman/gaeutilities/issues/#issue/12>)', DeprecationWarning, stacklevel = 2)
@@ -589,6 +742,7 @@ class Session(object):
                 else:
                     self.session.ip = None
                 self.session.sid = [self.sid]
+                self.session.set_data({})
                 # do put() here to get the session key
                 self.session.put()
             else:
@@ -621,7 +775,10 @@ class Session(object):
             self.cache[u"sid"] = self.sid
 
             if do_put:
-                if self.sid != None or self.sid != u"":
+                if self.writer == "memcache":
+                    # written at the end of the request by commit()
+                    self._dirty = True
+                elif self.sid != None or self.sid != u"":
                     self.session.put()
 
         # Only set the "_data" cookie if there is actual data
@@ -640,7 +797,7 @@ class Session(object):
 
         # randomly delete old stale sessions in the datastore (see
         # CLEAN_CHECK_PERCENT variable)
-        if random.randint(1, 100) < clean_check_percent:
+        if clean_check_percent and random.randint(1, 100) < clean_check_percent:
             self._clean_old_sessions()
 
     def new_sid(self):
@@ -658,28 +815,77 @@ class Session(object):
         #        unicode(random.random())).hexdigest()
         return sid
 
-    def _get(self, keyname=None):
+    def _get_data(self):
+        """
+        private method
+
+        Returns the dictionary with all items of a server side session.
+        The items are taken from the session entity on first use, which
+        does not need any extra memcache or datastore calls.
+        """
+        if self._data is None:
+            self._data = self.session.get_data()
+        return self._data
+
+    def _remove_cookie_value(self, keyname):
         """
         private method
 
-        Return all of the SessionData object data from the datastore only,
-        unless keyname is specified, in which case only that instance of
-        SessionData is returned.
+        Removes a value from the cookie data, if present, and outputs
+        the updated cookie.
+        """
+        if self.cookie_vals.has_key(keyname):
+            del(self.cookie_vals[keyname])
+            self.output_cookie["%s_data" % (self.cookie_name)] = \
+                simplejson.dumps(self.cookie_vals)
+            self.output_cookie["%s_data" % (self.cookie_name)]["path"] = \
+                self.cookie_path
+            if self.cookie_domain:
+                self.output_cookie["%s_data" % \
+                    (self.cookie_name)]["domain"] = self.cookie_domain
+            self.output_cookie_headers()
 
-        Important: This does not interact with memcache and pulls directly
-        from the datastore. This also does not get items from the cookie
-        store.
+    def commit(self):
+        """
+        Writes the session to memcache and the datastore with a single
+        put, if it changed during this request. The memcache writer only
+        writes changes when this is called, so call it at the end of each
+        request. Does nothing for the other writers, which write changes
+        immediately.
+
+        Returns True if the session was written.
+        """
+        if self.writer != "memcache" or not self._dirty or \
+           not hasattr(self, u"session"):
+            return False
+        if self._data is not None:
+            self.session.set_data(self._data)
+        self.session.put()
+        self._dirty = False
+        return True
+
+    def _save_data(self, changed=None, deleted=(), replace=False):
+        """
+        private method
+
+        Stores the changed items in the session entity. The datastore
+        writer applies the changes to the stored items right away, in a
+        transaction, the memcache writer leaves writing the whole session
+        to commit().
 
         Args:
-            keyname: The keyname of the value you are trying to retrieve.
+            changed: a dictionary with the items that were set
+            deleted: the keynames of the items that were deleted
+            replace: if True, all items are replaced by |changed|
 
-        Returns a list of datastore entities.
+        Returns the session entity, or True for the memcache writer.
         """
-        if hasattr(self, 'session'):
-            if keyname != None:
-                return self.session.get_item(keyname)
-            return self.session.get_items()
-        return None
+        if self.writer == "memcache":
+            self._dirty = True
+            return True
+        self._data = self.session.update_data(changed or {}, deleted,
+            replace)
+        return self.session
 
     def _validate_key(self, keyname):
         """
@@ -712,6 +918,8 @@ class Session(object):
         """
         if self.writer == "datastore":
             writer = _DatastoreWriter()
+        elif self.writer == "memcache":
+            writer = _MemcacheWriter()
         else:
             writer = _CookieWriter()
 
@@ -730,6 +938,8 @@ class Session(object):
             sys.modules['__main__'].AEU_Events.fire_event(u"preSessionDelete")
         if hasattr(self, u"session"):
             self.session.delete()
+        self._data = {}
+        self._dirty = False
         self.cookie_vals = {}
         self.cache = {}
         self.output_cookie["%s_data" % (self.cookie_name)] = \
@@ -823,6 +1033,111 @@ class Session(object):
             result.delete()
         return True
 
+    @classmethod
+    def delete_expired_sessions(cls, session_expire_time=settings.session["SESSION_EXPIRE_TIME"],
+            batch_size=100, cursor=None):
+        """
+        Delete a batch of expired sessions from the datastore, and their
+        cached sessions and items from memcache.
+
+        This is meant to be called from a scheduled batch job, so the
+        CLEAN_CHECK_PERCENT cleanup does not have to run inline in user
+        requests. Only keys are queried, and all sessions of the batch
+        are deleted with a single delete call. Items that are still
+        stored as separate entities are left for
+        delete_expired_session_data.
+
+        Args:
+          session_expire_time: The age in seconds to determine outdated
+                               sessions.
+          batch_size: The maximum number of sessions to delete.
+          cursor: The cursor returned by the previous call, or None to
+                  start at the first expired session.
+
+        Returns a tuple of the number of deleted sessions and the cursor
+        for the next batch, which is None if there are no more expired
+        sessions.
+        """
+        duration = datetime.timedelta(seconds=session_expire_time)
+        session_age = datetime.datetime.now() - duration
+        query = _AppEngineUtilities_Session.all(keys_only=True)
+        query.filter(u"last_activity <", session_age)
+        if cursor:
+            query.with_cursor(cursor)
+        session_keys = query.fetch(batch_size)
+        if not session_keys:
+            return 0, None
+        next_cursor = query.cursor()
+
+        memcache_keys = []
+        for session_key in session_keys:
+            memcache_keys.append(u"_AppEngineUtilities_Session_%s" % \
+                (str(session_key)))
+            memcache_keys.append(u"_AppEngineUtilities_SessionData_%s" % \
+                (str(session_key)))
+        db.delete(session_keys)
+        memcache.delete_multi(memcache_keys)
+
+        if len(session_keys) < batch_size:
+            next_cursor = None
+        return len(session_keys), next_cursor
+
+    @classmethod
+    def delete_expired_session_data(cls,
+            session_expire_time=settings.session["SESSION_EXPIRE_TIME"],
+            batch_size=100, cursor=None):
+        """
+        Delete a batch of session items that are stored as separate
+        _AppEngineUtilities_SessionData entities and are no longer used.
+
+        Items are only stored this way by sessions that were not migrated
+        to the data property yet, so there are few of them. The entities
+        are scanned in batches, and each batch takes one query, one batch
+        get of the sessions of the items and one delete call. Items are
+        deleted when their session was deleted, has expired or was
+        migrated.
+
+        Args:
+          session_expire_time: The age in seconds to determine outdated
+                               sessions.
+          batch_size: The maximum number of items to scan.
+          cursor: The cursor returned by the previous call, or None to
+                  start at the first item.
+
+        Returns a tuple of the number of deleted items and the cursor
+        for the next batch, which is None if all items were scanned.
+        """
+        duration = datetime.timedelta(seconds=session_expire_time)
+        session_age = datetime.datetime.now() - duration
+        query = _AppEngineUtilities_SessionData.all()
+        if cursor:
+            query.with_cursor(cursor)
+        items = query.fetch(batch_size)
+        if not items:
+            return 0, None
+        next_cursor = query.cursor()
+
+        session_property = _AppEngineUtilities_SessionData.session
+        session_keys = [session_property.get_value_for_datastore(item)
+                        for item in items]
+        sessions = {}
+        for session in db.get(list(set([k for k in session_keys if k]))):
+            if session:
+                sessions[session.key()] = session
+        keys = []
+        for item, session_key in zip(items, session_keys):
+            session = sessions.get(session_key)
+            if session is None or session.data is not None or \
+                    (session.last_activity and
+                     session.last_activity < session_age):
+                keys.append(item.key())
+        if keys:
+            db.delete(keys)
+
+        if len(items) < batch_size:
+            next_cursor = None
+        return len(keys), next_cursor
+
     def cycle_key(self):
         """
         Changes the session id/token.
@@ -889,11 +1204,9 @@ class Session(object):
 
         Returns True
         """
-        sessiondata = self._get()
-        # delete from datastore
-        if sessiondata is not None:
-            for sd in sessiondata:
-                sd.delete()
+        if hasattr(self, u"session") and self._get_data():
+            self._data = {}
+            self._save_data(replace=True)
         # delete from memcache
         self.cache = {}
         self.cookie_vals = {}
@@ -1062,23 +1375,10 @@ class Session(object):
         if keyname in self.cookie_vals:
             return self.cookie_vals[keyname]
         if hasattr(self, u"session"):
-            data = self._get(keyname)
-            if data:
-                # TODO: It's broke here, but I'm not sure why, it's
-                # returning a model object, but I can't seem to modify
-                # it.
-                try:
-                    if data.model != None:
-                        self.cache[keyname] = data.model
-                        return self.cache[keyname]
-                    else:
-                        self.cache[keyname] = pickle.loads(data.content)
-                        return self.cache[keyname]
-                except:
-                    self.delete_item(keyname)
-
-            else:
-                raise KeyError(unicode(keyname))
+            data = self._get_data()
+            if keyname in data:
+                self.cache[keyname] = data[keyname]
+                return self.cache[keyname]
         raise KeyError(unicode(keyname))
 
     def __setitem__(self, keyname, value):
@@ -1125,11 +1425,12 @@ class Session(object):
             keyname: The keyname of the object to delete.
         """
         bad_key = False
-        sessdata = self._get(keyname = keyname)
-        if sessdata is None:
-            bad_key = True
+        data = hasattr(self, u"session") and self._get_data() or {}
+        if keyname in data:
+            del data[keyname]
+            self._save_data(deleted=[keyname])
         else:
-            sessdata.delete()
+            bad_key = True
         if keyname in self.cookie_vals:
             del self.cookie_vals[keyname]
             bad_key = False
@@ -1151,13 +1452,8 @@ class Session(object):
         """
         Return size of session.
         """
-        # check memcache first
         if hasattr(self, u"session"):
-            results = self._get()
-            if results is not None:
-                return len(results) + len(self.cookie_vals)
-            else:
-                return 0
+            return len(self._get_data()) + len(self.cookie_vals)
         return len(self.cookie_vals)
 
     def __contains__(self, keyname):
@@ -1177,12 +1473,9 @@ class Session(object):
         """
         Iterate over the keys in the session data.
         """
-        # try memcache first
         if hasattr(self, u"session"):
-            vals = self._get()
-            if vals is not None:
-                for k in vals:
-                    yield k.keyname
+            for k in self._get_data().keys():
+                yield k
         for k in self.cookie_vals:
             yield k
 
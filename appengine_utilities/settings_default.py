@@ -41,10 +41,14 @@ session = {
     "INTEGRATE_FLASH": True,        # integrate functionality from flash module?
     "SET_COOKIE_EXPIRES": True,     # Set to True to add expiration field to
                                     # cookie
-    "WRITER":"datastore",           # Use the datastore writer by default. 
-                                    # cookie is the other option.
-    "CLEAN_CHECK_PERCENT": 50,      # By default, 50% of all requests will clean
-                                    # the datastore of expired sessions
+    "WRITER":"datastore",           # Use the datastore writer by default.
+                                    # memcache and cookie are the other
+                                    # options.
+    "CLEAN_CHECK_PERCENT": 0,       # Percentage of requests that will clean
+                                    # the datastore of expired sessions. 0
+                                    # disables it, expired sessions are then
+                                    # deleted by a scheduled batch job that
+                                    # calls Session.delete_expired_sessions
     "CHECK_IP": True,               # validate sessions by IP
     "CHECK_USER_AGENT": True,       # validate sessions by user agent
     "SESSION_TOKEN_TTL": 5,         # Number of seconds a session token is valid
@@ -56,8 +60,23 @@ session = {
 # Configuration settings for the cache class
 cache = {
     "DEFAULT_TIMEOUT": 3600, # cache expires after one hour (3600 sec)
-    "CLEAN_CHECK_PERCENT": 50, # 50% of all requests will clean the database
+    "CLEAN_CHECK_PERCENT": 0, # % of all requests that will clean the
+                              # database. 0 disables it, expired items are
+                              # then deleted by a scheduled batch job that
+                              # calls Cache.delete_expired
     "MAX_HITS_TO_CLEAN": 20, # the maximum number of cache hits to clean
+    "LOCAL_CACHE_SIZE": 1000, # the maximum number of items kept in the
+                              # in-process cache of each instance
+    "LOCAL_TIMEOUT": 60, # items are kept in the in-process cache for at
+                         # most 60 seconds, 0 disables it
+    "NEGATIVE_TIMEOUT": 60, # keys that are not in the cache are remembered
+                            # as missing for 60 seconds, 0 disables it
+    "STALE_TIMEOUT": 300, # get_or_compute returns expired values for up
+                          # to 300 seconds while they are recomputed
+    "LEASE_TIMEOUT": 10, # seconds one request may take to recompute a
+                         # value in get_or_compute
+    "LEASE_WAIT": 1, # seconds get_or_compute waits for a value another
+                     # request is computing, when there is no stale value
 }
 
 # Configuration settings for the flash class
@@ -74,7 +93,14 @@ paginator = {
 
 rotmodel = {
     "RETRY_ATTEMPTS": 3,
-    "RETRY_INTERVAL": .2,
+    "RETRY_INTERVAL": .2,       # the first retry waits up to .2 seconds,
+                                # doubling for each next retry
+    "RETRY_MAX_INTERVAL": 2,    # the maximum number of seconds to wait
+    "REQUEST_DEADLINE": 30,     # the deadline of user requests, and
+    "TASK_DEADLINE": 600,       # of task queue requests, in seconds
+    "DEADLINE_MARGIN": 5,       # no retry is started this many seconds
+                                # before the deadline of the request
+    "PUT_BATCH_SIZE": 500,      # the maximum number of entities per put
 }
 if __name__ == "__main__":
     print "Hello World";
@@ -13,43 +13,104 @@
 #  limitations under the License.
 
 import os
+import base64
+import hashlib
 import logging
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.ext import db
-from appengine_utilities.sessions import Session
+import simplejson as json
 
 from model import Task, Context, Domain, User
 import api
 
 
-def add_message(session, message):
-    """Adds a message to the current user's session.
-
-    Args:
-        session: a Session object, initialized with the request
-        message: a string message
-
-    The message is stored in the session, so it can be read in a later request.
+class Messages(object):
     """
-    if 'messages' not in session:
-        session['messages'] = []
-    session['messages'] = session['messages'] + [message]
-
-
-def get_and_delete_messages(session):
-    """Retrieves all messages in the current user's session, and clears them.
-
-    Args:
-        session: a Session object, initialized with the request
+    One-time messages for the user, such as 'Task created', which are
+    shown on the next page the user visits.
 
-    Returns:
-        A list of messages (strings)
+    The messages are carried between requests in a single cookie and
+    never touch the datastore. The cookie is only parsed when the
+    messages are used, and a Set-Cookie header is only written when
+    the messages actually change.
     """
-    messages = session.setdefault('messages', default=[])
-    del session['messages']
-    return messages
+    COOKIE_NAME = 'sps_messages'
+
+    def __init__(self, request, response):
+        """
+        Args:
+            request: The webapp request of the current handler
+            response: The webapp response of the current handler
+        """
+        self._request = request
+        self._response = response
+        self._messages = None   # Not parsed yet
+
+    def add(self, message):
+        """
+        Adds a message, to be shown on one of the next pages.
+
+        Args:
+            message: a string message
+        """
+        self._load()
+        self._messages.append(message)
+        self._write()
+
+    def has_messages(self):
+        """Returns true if there are messages to show."""
+        self._load()
+        return bool(self._messages)
+
+    def get_and_delete(self):
+        """
+        Retrieves all messages and clears them.
+
+        Returns:
+            A list of messages (strings)
+        """
+        self._load()
+        messages = self._messages
+        if messages:
+            self._messages = []
+            self._write()
+        return messages
+
+    def _load(self):
+        """Parses the cookie, if that has not been done yet."""
+        if self._messages is not None:
+            return
+        value = self._request.cookies.get(Messages.COOKIE_NAME)
+        self._messages = []
+        if value:
+            try:
+                messages = json.loads(base64.urlsafe_b64decode(str(value)))
+                if isinstance(messages, list):
+                    self._messages = messages
+            except (TypeError, ValueError):
+                logging.warning("Ignoring invalid messages cookie")
+
+    def _write(self):
+        """
+        Sets the cookie to the current messages, replacing any cookie
+        header that was set earlier in this response.
+        """
+        headers = self._response.headers
+        prefix = '%s=' % Messages.COOKIE_NAME
+        cookies = [cookie for cookie in headers.get_all('Set-Cookie')
+                   if not cookie.startswith(prefix)]
+        del headers['Set-Cookie']
+        for cookie in cookies:
+            headers.add_header('Set-Cookie', cookie)
+        if self._messages:
+            value = base64.urlsafe_b64encode(json.dumps(self._messages))
+            headers.add_header('Set-Cookie', '%s%s; Path=/' % (prefix, value))
+        else:
+            headers.add_header('Set-Cookie',
+                               '%s; Path=/; '
+                               'Expires=Thu, 01 Jan 1970 00:00:00 GMT' % prefix)
 
 
 def _task_template_values(tasks, user, level=0):
@@ -79,6 +140,50 @@ def _task_template_values(tasks, user, level=0):
             for task in tasks]
 
 
+def _not_modified(handler, domain_identifier, user, messages=None):
+    """
+    Sets the ETag of a page in a domain, and answers the request with
+    304 Not Modified if the client already has the current page.
+
+    The ETag is derived from the version of the domain, which changes
+    each time a task in the domain changes, and from the application
+    version, the user and the requested url. Checking it costs a single
+    memcache read, so it must be done before any tasks are loaded.
+    Pages with messages are always rendered, since the messages are
+    only shown once, as are all pages when the version of the domain
+    can't be read.
+
+    Args:
+        handler: The webapp request handler of the page
+        domain_identifier: The domain identifier string
+        user: A User model instance of the logged in user
+        messages: The Messages of the request, if the page shows them
+
+    Returns:
+        True if the 304 response has been set, in which case the page
+        must not be rendered.
+    """
+    if messages and messages.has_messages():
+        return False
+    version = api.get_domain_version(domain_identifier)
+    if version is None:
+        return False
+    parts = [version,
+             os.environ.get('CURRENT_VERSION_ID', ''),
+             user.identifier(),
+             user.name,
+             handler.request.path_qs]
+    etag = '"%s"' % hashlib.md5(
+        u'\n'.join(parts).encode('utf-8')).hexdigest()
+    handler.response.headers['ETag'] = etag
+    handler.response.headers['Cache-Control'] = 'private, no-cache'
+    if_none_match = handler.request.headers.get('If-None-Match', '')
+    if etag in [tag.strip() for tag in if_none_match.split(',')]:
+        handler.response.set_status(304)
+        return True
+    return False
+
+
 def render_template(file, template_values):
     """
     Renders the template specified through file passing the given
@@ -102,14 +207,22 @@ class Landing(webapp.RequestHandler):
     def get(self):
         user = api.get_logged_in_user()
         domains = api.get_all_domains_for_user(user)
-        session = Session(writer='cookie',
-                          wsgiref_headers=self.response.headers)
+        messages = Messages(self.request, self.response)
+        user_identifier = user.identifier()
+        domain_values = []
+        for domain in domains:
+            statistics = api.get_domain_statistics(domain.identifier())
+            user_statistics = api.get_domain_statistics(domain.identifier(),
+                                                        user_identifier)
+            domain_values.append({
+                    'identifier': domain.identifier(),
+                    'name': domain.name,
+                    'statistics': statistics,
+                    'user_statistics': user_statistics })
         template_values = {
             'username' : user.name,
-            'domains' : [{ 'identifier': domain.identifier(),
-                           'name': domain.name }
-                         for domain in domains],
-            'messages': get_and_delete_messages(session),
+            'domains' : domain_values,
+            'messages': messages.get_and_delete(),
             }
         path = os.path.join(os.path.dirname(__file__),
                         'templates/landing.html')
@@ -127,8 +240,9 @@ class Overview(webapp.RequestHandler):
         if not user:
             self.error(404)     # hides domain identifiers
             return
-        session = Session(writer='cookie',
-                          wsgiref_headers=self.response.headers)
+        messages = Messages(self.request, self.response)
+        if _not_modified(self, domain_identifier, user, messages):
+            return
         view = self.request.get('view', 'all')
         domain = api.get_domain(domain_identifier)
         if view == 'yours':
@@ -159,7 +273,7 @@ class Overview(webapp.RequestHandler):
             'domain_identifier': domain_identifier,
             'user_name': user.name,
             'user_identifier': user.identifier(),
-            'messages': get_and_delete_messages(session),
+            'messages': messages.get_and_delete(),
             'tasks': _task_template_values(tasks, user),
             'tasks_heading': tasks_heading,
             'no_tasks_message': no_tasks_message,
@@ -174,15 +288,18 @@ class TaskDetail(webapp.RequestHandler):
     Handler to show the full task details.
     """
     def get(self, domain_identifier, task_identifier):
-        task = api.get_task(domain_identifier, task_identifier)
         user = api.get_and_validate_user(domain_identifier)
+        if not user:
+            self.error(404)
+            return
+        messages = Messages(self.request, self.response)
+        if _not_modified(self, domain_identifier, user, messages):
+            return
+        task = api.get_task(domain_identifier, task_identifier)
         view = self.request.get('view', 'all')
-        if not task or not user:
+        if not task:
             self.error(404)
             return
-        session = Session(writer='cookie',
-                          wsgiref_headers=self.response.headers)
-        user = api.get_logged_in_user()
         domain = api.get_domain(domain_identifier)
         if view == 'yours':
             subtasks = api.get_assigned_tasks(domain_identifier,
@@ -216,14 +333,14 @@ class TaskDetail(webapp.RequestHandler):
             'view_mode': view,
             'user_name': user.name,
             'user_identifier': user.identifier(),
-            'messages': get_and_delete_messages(session),
+            'messages': messages.get_and_delete(),
             'task_title' : task.title(),
             'task_description': task.description_body(),
             'task_assignee': task.assignee_description(),
             'task_identifier': task.identifier(),
             'task_has_subtasks': not task.atomic(),
             'task_can_assign_to_self': api.can_assign_to_self(task, user),
-            'task_can_edit': api.can_edit_task(domain, task, user),
+            'task_can_edit': api.can_edit_task(task, user),
             'subtasks': _task_template_values(subtasks, user),
             'parent_identifier': parent_identifier,
             'parent_title': parent_title,
@@ -263,6 +380,8 @@ class GetSubTasks(webapp.RequestHandler):
         if not user:
             self.error(403)
             return
+        if _not_modified(self, domain_identifier, user):
+            return
 
         domain = api.get_domain(domain_identifier)
         task = api.get_task(domain_identifier, task_identifier)
@@ -295,6 +414,39 @@ class GetSubTasks(webapp.RequestHandler):
                                                 template_values))
 
 
+class FindTask(webapp.RequestHandler):
+    """
+    Handler to jump to a task by its title. The GET parameter q is the
+    prefix of the title of the task. If exactly one task matches, the
+    user is redirected to that task. Otherwise all matching tasks are
+    listed.
+    """
+    def get(self, domain_identifier):
+        user = api.get_and_validate_user(domain_identifier)
+        if not user:
+            self.error(404)
+            return
+        query = self.request.get('q', '')
+        matches = api.find_tasks_by_title(domain_identifier, query, limit=50)
+        if len(matches) == 1:
+            self.redirect('/d/%s/task/%s' % (domain_identifier, matches[0][0]))
+            return
+
+        domain = api.get_domain(domain_identifier)
+        template_values = {
+            'domain_name': domain.name,
+            'domain_identifier': domain_identifier,
+            'user_name': user.name,
+            'user_identifier': user.identifier(),
+            'view_mode': 'all',
+            'query': query,
+            'matches': [{ 'id': identifier, 'title': title }
+                        for identifier, title in matches],
+            }
+        self.response.out.write(render_template('templates/findtask.html',
+                                                template_values))
+
+
 class TaskEditView(webapp.RequestHandler):
     """
     Handler to show the edit task gui. It shows an editable
@@ -311,10 +463,9 @@ class TaskEditView(webapp.RequestHandler):
             self.error(404)
             return
 
-        session = Session(writer='cookie',
-                          wsgiref_headers=self.response.headers)
+        messages = Messages(self.request, self.response)
         domain = api.get_domain(domain_identifier)
-        if not api.can_edit_task(domain, task, user):
+        if not api.can_edit_task(task, user):
             self.error(403)
             return
 
@@ -331,7 +482,7 @@ class TaskEditView(webapp.RequestHandler):
             'domain_identifier': domain_identifier,
             'user_name': user.name,
             'user_identifier': user.identifier(),
-            'messages': get_and_delete_messages(session),
+            'messages': messages.get_and_delete(),
             'task_title' : task.title(),
             'task_description': task.description,
             'task_identifier': task.identifier(),
@@ -364,8 +515,7 @@ class CreateTask(webapp.RequestHandler):
         if not user:
             self.error(401)
             return
-        self.session = Session(writer='cookie',
-                               wsgiref_headers=self.response.headers)
+        self.messages = Messages(self.request, self.response)
         assignee = user if self_assign else None
         if not parent_identifier:
             parent_identifier = None
@@ -374,7 +524,7 @@ class CreateTask(webapp.RequestHandler):
                                description,
                                assignee=assignee,
                                parent_task_identifier=parent_identifier)
-        add_message(self.session, "Task '%s' created" % task.title())
+        self.messages.add("Task '%s' created" % task.title())
         if parent_identifier:
             self.redirect('/d/%s/task/%s' % (domain, parent_identifier))
         else:
@@ -396,8 +546,7 @@ class EditTask(webapp.RequestHandler):
         if not user:
             self.error(401)
             return
-        self.session = Session(writer='cookie',
-                               wsgiref_headers=self.response.headers)
+        self.messages = Messages(self.request, self.response)
         try:
             description = self.request.get('description')
             task = api.change_task_description(domain_identifier,
@@ -409,7 +558,7 @@ class EditTask(webapp.RequestHandler):
             self.response.out.write("Error while editing task: %s" % error)
             return
 
-        add_message(self.session, "Task '%s' edited" % task.title())
+        self.messages.add("Task '%s' edited" % task.title())
         self.redirect('/d/%s/task/%s' % (domain_identifier, task_identifier))
 
 
@@ -431,8 +580,7 @@ class MoveTask(webapp.RequestHandler):
         if not user:
             self.error(401)
             return
-        self.session = Session(writer='cookie',
-                               wsgiref_headers=self.response.headers)
+        self.messages = Messages(self.request, self.response)
         try:
             task = api.change_task_parent(domain_identifier,
                                           user,
@@ -443,7 +591,7 @@ class MoveTask(webapp.RequestHandler):
             self.response.out.write("Error while moving task: %s" % error)
             return
 
-        add_message(self.session, "Task '%s' moved" % task.title())
+        self.messages.add("Task '%s' moved" % task.title())
         self.redirect('/d/%s/task/%s' % (domain_identifier, task_identifier))
 
 
@@ -494,10 +642,9 @@ class AssignTask(webapp.RequestHandler):
             logging.error("No assignee")
             return
         task = api.assign_task(domain, task_id, user, assignee)
-        session = Session(writer='cookie',
-                          wsgiref_headers=self.response.headers)
-        add_message(session, "Task '%s' assigned to '%s'" %
-                                (task.title(), assignee.name))
+        messages = Messages(self.request, self.response)
+        messages.add("Task '%s' assigned to '%s'" %
+                     (task.title(), assignee.name))
         self.redirect(self.request.headers.get('referer'))
 
 
@@ -516,9 +663,8 @@ class CreateDomain(webapp.RequestHandler):
         if not domain:
             self.response.out.write("Could not create domain")
             return
-        session = Session(writer='cookie',
-                          wsgiref_headers=self.response.headers)
-        add_message(session, "Created domain '%s'" % domain.key().name())
+        messages = Messages(self.request, self.response)
+        messages.add("Created domain '%s'" % domain.key().name())
         self.redirect('/d/%s/' % domain.key().name())
 
 
@@ -529,6 +675,7 @@ _VALID_TASK_KEY_NAME = '[a-z0-9-]{1,100}'
 _DOMAIN_URL = '/d/(%s)/?' % _VALID_DOMAIN_KEY_NAME
 _DOMAIN_ALL = '/d/(%s)/all/?' % _VALID_DOMAIN_KEY_NAME
 _DOMAIN_OPEN = '/d/(%s)/open/?' % _VALID_DOMAIN_KEY_NAME
+_DOMAIN_FIND = '/d/(%s)/find/?' % _VALID_DOMAIN_KEY_NAME
 
 _TASK_URL = '%s/task/(%s)/?' % (_DOMAIN_URL, _VALID_TASK_KEY_NAME)
 _TASK_EDIT_URL = "%s/edit/?" % (_TASK_URL,)
@@ -545,6 +692,7 @@ application = webapp.WSGIApplication([('/create-task', CreateTask),
                                       (_DOMAIN_URL, Overview),
                                       (_DOMAIN_ALL, Overview),
                                       (_DOMAIN_OPEN, Overview),
+                                      (_DOMAIN_FIND, FindTask),
                                       (_TASK_EDIT_URL, TaskEditView),
                                       (_TASK_URL, TaskDetail),
                                       ('/', Landing)])
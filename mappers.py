@@ -14,42 +14,181 @@
 """
 Mappers, currently only used for schema migration etc.
 """
+import csv
 import logging
-from mapreduce import operation as op, context
+import StringIO
+from mapreduce import operation as op, context, util
 from google.appengine.ext import db
+from appengine_utilities.rotmodel import put_multi
 
-from model import Domain, Task, User, TaskIndex
+from model import Domain, Task, User, TaskIndex, DomainStatistics
 import workers
 import api
 
 
-def rebuild_hierarchy(task):
+@util.batch_handler
+def rebuild_hierarchy(tasks):
     """
     Rebuilds all derived properties and hierarchies. This includes the
     TaskIndexes. This operation will only create tasks, which will do
-    the actual work.
-    """
-    if task.root():
-        workers.UpdateTaskHierarchy.enqueue(task.domain_identifier(),
-                                            task.identifier())
-
-    domain_key = Domain.key_from_name(task.domain_identifier())
-    task_key = task.key()
-    logging.info("Domain_key %s" % domain_key)
-    def txn():
-        # Actual test in the datastore to see if the task is atomic,
-        # as it is a computed property.
-        query = Task.all().\
-            ancestor(domain_key).\
-            filter('parent_task =', task_key)
-        subtask = query.get()
-        if not subtask:         # atomic
-            workers.UpdateTaskCompletion.enqueue(task.domain_identifier(),
-                                                 task.identifier())
-    db.run_in_transaction(txn)
+    the actual work. Set the ancestor parameter of the job to the key
+    of a Domain to only rebuild the tasks in that domain.
+
+    This is a batch handler. The workers are added through the task
+    queue pool of the mapreduce, which adds them in batches.
+    """
+    queue_name = 'update-task-hierarchy'
+    atomic_task_keys = _atomic_task_keys(tasks)
+    for task in tasks:
+        domain_identifier = task.domain_identifier()
+        task_identifier = task.identifier()
+        if task.root():
+            worker = workers.UpdateTaskHierarchy.make_task(domain_identifier,
+                                                           task_identifier)
+            yield op.taskqueue.Add(worker, queue_name)
+        if task.key() in atomic_task_keys:
+            worker = workers.UpdateTaskCompletion.make_task(domain_identifier,
+                                                            task_identifier)
+            yield op.taskqueue.Add(worker, queue_name)
+
+
+def _atomic_task_keys(tasks):
+    """
+    Returns a set with the keys of the tasks that have no subtasks.
+
+    This is tested in the datastore, as the derived properties of the
+    tasks may be the ones that are being rebuilt. The mapper reads the
+    tasks in key order, so the tasks of a domain in the batch span a
+    small key range. The subtasks of all of them are found with a
+    single ancestor query per domain over that range of parent tasks,
+    which only fetches the parent_task property of the subtasks through
+    a projection.
+    """
+    domain_task_keys = {}
+    for task in tasks:
+        domain_task_keys.setdefault(task.domain_identifier(),
+                                    []).append(task.key())
+    atomic_task_keys = set()
+    for domain_identifier, task_keys in domain_task_keys.iteritems():
+        query = db.Query(Task, projection=('parent_task',)).\
+            ancestor(Domain.key_from_name(domain_identifier)).\
+            filter('parent_task >=', task_keys[0]).\
+            filter('parent_task <=', task_keys[-1])
+        parent_task_keys = set(subtask.parent_task_key()
+                               for subtask in query.run(batch_size=100))
+        atomic_task_keys.update(key for key in task_keys
+                                if key not in parent_task_keys)
+    return atomic_task_keys
 
 
 def migrate_user(user):
+    """
+    Adds the user to the sps domain. The user is put directly instead
+    of through the mutation pool, so the cached user is only
+    invalidated after the change is written.
+    """
     if not 'sps' in user.domains:
         user.domains.append('sps')
-    yield op.db.Put(user)
+        user.put()
+        api.invalidate_user(user.identifier())
+
+
+def migrate_derived_assignees(task):
+    """
+    Rewrites the task, so that its derived assignees are stored in the
+    compact encoding of the AssigneesProperty. Tasks that already use
+    that encoding are written back unchanged.
+    """
+    yield op.db.Put(task)
+
+
+def migrate_task_description(task):
+    """
+    Stores the title of the task in its own property, and compresses
+    the description if it is long enough. Tasks that are already
+    migrated are written back unchanged.
+    """
+    if task.derived_title is None:
+        task.set_description(task.description)
+    yield op.db.Put(task)
+
+
+def reset_domain_statistics(statistics):
+    """
+    Deletes a shard of the statistics of a domain or user. Run this
+    before the "Recount domain statistics" job, which only writes the
+    statistics of the domains and users that still have tasks, so the
+    counts of the others would otherwise be kept. The shard is deleted
+    directly instead of through the mutation pool, so the cached
+    statistics are only invalidated after it is deleted.
+    """
+    statistics.delete()
+    api.invalidate_domain_statistics(statistics.domain, statistics.user)
+
+
+def map_domain_statistics(task):
+    """
+    Emits the contribution of the task to the statistics of its
+    domain, keyed by domain and user. The values are summed by
+    reduce_domain_statistics.
+    """
+    domain_identifier = task.domain_identifier()
+    for user_identifier, deltas in workers.task_statistics(task).iteritems():
+        yield ('%s/%s' % (domain_identifier, user_identifier or ''), deltas)
+
+
+def reduce_domain_statistics(key, values):
+    """
+    Replaces the statistics of a domain, or of a single user in the
+    domain, with the sum of all counted tasks. This is also how the
+    statistics of existing tasks are counted for the first time.
+    Keys without any counted task are not reduced, so the existing
+    statistics must first be deleted by reset_domain_statistics. Tasks
+    should not change while the jobs run, as the updates of the
+    workers would be overwritten.
+
+    The shards are put directly instead of through the mutation pool,
+    so the cached statistics are only invalidated after they are
+    written.
+    """
+    domain_identifier, user_identifier = key.decode('utf-8').split('/', 1)
+    user_identifier = user_identifier or None
+    totals = dict((counter, 0) for counter in DomainStatistics.COUNTERS)
+    for deltas in values:
+        for counter, delta in deltas.iteritems():
+            totals[counter] += delta
+    shards = []
+    for shard in range(DomainStatistics.NUMBER_OF_SHARDS):
+        key_name = DomainStatistics.shard_key_name(domain_identifier,
+                                                   user_identifier,
+                                                   shard)
+        statistics = DomainStatistics(key_name=key_name,
+                                      domain=domain_identifier,
+                                      user=user_identifier)
+        if shard == 0:
+            for counter, total in totals.iteritems():
+                setattr(statistics, counter, total)
+        shards.append(statistics)
+    put_multi(shards)
+    api.invalidate_domain_statistics(domain_identifier, user_identifier)
+
+
+def export_task(task):
+    """
+    Yields a CSV line with the main properties of the task, for the
+    LineOutputWriter. Set the ancestor parameter of the job to the
+    key of a Domain to only export the tasks in that domain. The
+    columns are: domain, task, parent task, title, assignee,
+    completed and creation time.
+    """
+    row = [task.domain_identifier(),
+           task.identifier(),
+           task.parent_task_identifier() or '',
+           task.title(),
+           task.assignee_identifier() or '',
+           int(task.is_completed()),
+           task.time.isoformat()]
+    out = StringIO.StringIO()
+    csv.writer(out).writerow([unicode(value).encode('utf-8')
+                              for value in row])
+    yield out.getvalue().rstrip('\r\n')
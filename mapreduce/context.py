@@ -23,11 +23,16 @@ from handlers such as counters, log messages, mutation pools.
 
 
 
-__all__ = ["MAX_ENTITY_COUNT", "MAX_POOL_SIZE", "Context", "MutationPool",
-           "Counters", "ItemList", "EntityList", "get", "COUNTER_MAPPER_CALLS",
+__all__ = ["MAX_ENTITY_COUNT", "MAX_POOL_SIZE", "MAX_TASK_COUNT", "Context",
+           "MutationPool", "TaskQueuePool", "Counters", "ItemList",
+           "EntityList", "get", "COUNTER_MAPPER_CALLS", "COUNTER_REDUCER_CALLS",
            "DATASTORE_DEADLINE"]
 
+import logging
+
 from google.appengine.api import datastore
+from google.appengine.api.labs import taskqueue
+from google.appengine.datastore import datastore_rpc
 from google.appengine.ext import db
 from mapreduce import util
 
@@ -39,12 +44,19 @@ MAX_POOL_SIZE = 900 * 1000
 # Maximum number of items. Pool will be flushed when reaches this amount.
 MAX_ENTITY_COUNT = 500
 
+# Maximum number of tasks added to a queue in one taskqueue API call. Task
+# queue pool will be flushed when it reaches this amount for a queue.
+MAX_TASK_COUNT = 100
+
 # Deadline in seconds for mutation pool datastore operations.
 DATASTORE_DEADLINE = 15
 
 # The name of the counter which counts all mapper calls.
 COUNTER_MAPPER_CALLS = "mapper_calls"
 
+# The name of the counter which counts all reducer calls.
+COUNTER_REDUCER_CALLS = "reducer_calls"
+
 
 def _normalize_entity(value):
   """Return an entity from an entity or model instance."""
@@ -108,9 +120,19 @@ EntityList = ItemList
 class MutationPool(object):
   """Mutation pool accumulates datastore changes to perform them in batch.
 
+  Changes are written with asynchronous datastore calls, so the mapper can
+  continue while a full list is written. At most one call is in flight at a
+  time: a flush waits for the previous call before it starts the next one,
+  and flush() waits for all calls to finish. Errors of a call are raised
+  by the flush that waits for it.
+
+  Entities and keys are converted to protocol buffers when they are
+  registered. The buffers are used both to compute their size and for the
+  datastore call. Keys are not assigned to entities with incomplete keys.
+
   Properties:
-    puts: ItemList of entities to put to datastore.
-    deletes: ItemList of keys to delete from datastore.
+    puts: ItemList of entity protocol buffers to put to datastore.
+    deletes: ItemList of key protocol buffers to delete from datastore.
     max_pool_size: maximum single list pool size. List changes will be flushed
       when this size is reached.
   """
@@ -128,6 +150,11 @@ class MutationPool(object):
     self.max_entity_count = max_entity_count
     self.puts = ItemList()
     self.deletes = ItemList()
+    # The protocol buffers are passed to the datastore as they are.
+    self.__connection = datastore_rpc.Connection(
+        adapter=datastore_rpc.IdentityAdapter(),
+        config=datastore_rpc.Configuration(deadline=DATASTORE_DEADLINE))
+    self.__rpc = None
 
   def put(self, entity):
     """Registers entity to put to datastore.
@@ -135,12 +162,13 @@ class MutationPool(object):
     Args:
       entity: an entity or model instance to put.
     """
-    actual_entity = _normalize_entity(entity)
-    entity_size = len(actual_entity._ToPb().Encode())
+    # This is not very nice: we're calling two protected methods here...
+    entity_pb = _normalize_entity(entity)._ToPb()
+    entity_size = entity_pb.ByteSize()
     if (self.puts.length >= self.max_entity_count or
         (self.puts.size + entity_size) > self.max_pool_size):
       self.__flush_puts()
-    self.puts.append(actual_entity, entity_size)
+    self.puts.append(entity_pb, entity_size)
 
   def delete(self, entity):
     """Registers entity to delete from datastore.
@@ -148,39 +176,102 @@ class MutationPool(object):
     Args:
       entity: an entity, model instance, or key to delete.
     """
-    # This is not very nice: we're calling two protected methods here...
-    key = _normalize_key(entity)
-    key_size = len(key._ToPb().Encode())
+    key_pb = _normalize_key(entity)._ToPb()
+    key_size = key_pb.ByteSize()
     if (self.deletes.length >= self.max_entity_count or
         (self.deletes.size + key_size) > self.max_pool_size):
       self.__flush_deletes()
-    self.deletes.append(key, key_size)
+    self.deletes.append(key_pb, key_size)
 
   # TODO(user): some kind of error handling/retries is needed here.
   def flush(self):
     """Flush(apply) all changed to datastore."""
     self.__flush_puts()
     self.__flush_deletes()
+    self.__wait()
 
   def __flush_puts(self):
-    """Flush all puts to datastore."""
+    """Start writing all puts to datastore."""
     if self.puts.length:
-      datastore.Put(self.puts.items, rpc=self.__create_rpc())
+      self.__wait()
+      self.__rpc = self.__connection.async_put(None, self.puts.items)
     self.puts.clear()
 
   def __flush_deletes(self):
-    """Flush all deletes to datastore."""
+    """Start writing all deletes to datastore."""
     if self.deletes.length:
-      datastore.Delete(self.deletes.items, rpc=self.__create_rpc())
+      self.__wait()
+      self.__rpc = self.__connection.async_delete(None, self.deletes.items)
     self.deletes.clear()
 
-  def __create_rpc(self):
-    """Creates correctly configured RPC object for datastore calls.
+  def __wait(self):
+    """Wait for the datastore call in flight to finish."""
+    if self.__rpc is not None:
+      rpc = self.__rpc
+      self.__rpc = None
+      rpc.get_result()
 
-    Returns:
-      A UserRPC instance.
+
+class TaskQueuePool(object):
+  """Task queue pool accumulates tasks to add them to their queues in batch.
+
+  Properties:
+    tasks: dictionary of ItemList of tasks to add, by queue name.
+    max_pool_size: maximum payload size of the tasks for a single queue.
+      Tasks will be added when this size is reached.
+    max_task_count: maximum number of tasks for a single queue. Tasks will
+      be added when this number is reached.
+  """
+
+  def __init__(self,
+               max_pool_size=MAX_POOL_SIZE,
+               max_task_count=MAX_TASK_COUNT):
+    """Constructor.
+
+    Args:
+      max_pool_size: maximum payload size in bytes for a queue before adding
+        its tasks.
+      max_task_count: maximum number of tasks for a queue before adding them.
+    """
+    self.max_pool_size = max_pool_size
+    self.max_task_count = max_task_count
+    self.tasks = {}
+
+  def add(self, task, queue_name="default"):
+    """Registers task to add to a queue.
+
+    Args:
+      task: a taskqueue.Task instance.
+      queue_name: the name of the queue to add the task to.
     """
-    return datastore.CreateRPC(deadline=DATASTORE_DEADLINE)
+    task_size = len(task.url) + len(task.payload or "")
+    tasks = self.tasks.setdefault(queue_name, ItemList())
+    if (tasks.length >= self.max_task_count or
+        (tasks.size + task_size) > self.max_pool_size):
+      self.__flush_tasks(queue_name)
+    tasks.append(task, task_size)
+
+  def flush(self):
+    """Add all registered tasks to their queues."""
+    for queue_name in self.tasks:
+      self.__flush_tasks(queue_name)
+
+  def __flush_tasks(self, queue_name):
+    """Add the registered tasks of a queue."""
+    tasks = self.tasks[queue_name]
+    if tasks.length:
+      queue = taskqueue.Queue(queue_name)
+      try:
+        try:
+          queue.add(tasks.items)
+        except taskqueue.TransientError:
+          queue.add(tasks.items)
+      except (taskqueue.TaskAlreadyExistsError,
+              taskqueue.TombstonedTaskError), e:
+        # Named tasks from an earlier attempt of the slice.
+        logging.warning("Some tasks for queue %r already exist. %s: %s",
+                        queue_name, e.__class__, e)
+    tasks.clear()
 
 
 # This doesn't do much yet. In future it will play nicely with checkpoint/error
@@ -217,6 +308,7 @@ class Context(object):
     mapreduce_spec: current mapreduce specification as model.MapreduceSpec.
     shard_state: current shard state as model.ShardState.
     mutation_pool: current mutation pool as MutationPool.
+    taskqueue_pool: current task queue pool as TaskQueuePool.
     counters: counters object as Counters.
   """
 
@@ -248,10 +340,12 @@ class Context(object):
     self.mutation_pool = MutationPool(
         max_pool_size=(MAX_POOL_SIZE/(2**self.task_retry_count)),
         max_entity_count=(MAX_ENTITY_COUNT/(2**self.task_retry_count)))
+    self.taskqueue_pool = TaskQueuePool()
     self.counters = Counters(shard_state)
 
     self._pools = {}
     self.register_pool("mutation_pool", self.mutation_pool)
+    self.register_pool("taskqueue_pool", self.taskqueue_pool)
     self.register_pool("counters", self.counters)
 
   def flush(self):
@@ -42,7 +42,8 @@ def start_map(name,
               countdown=None,
               hooks_class_name=None,
               _app=None,
-              transactional=False):
+              transactional=False,
+              output_writer_spec=None):
   """Start a new, mapper-only mapreduce.
 
   Args:
@@ -65,12 +66,14 @@ def start_map(name,
     hooks_class_name: fully qualified name of a hooks.Hooks subclass.
     transactional: Specifies if job should be started as a part of already
       opened transaction.
+    output_writer_spec: fully qualified name of the output writer to use, or
+      None if the mapper has no output.
 
   Returns:
     mapreduce id as string.
   """
   mapper_spec = model.MapperSpec(handler_spec, reader_spec, reader_parameters,
-                                 shard_count)
+                                 shard_count, output_writer_spec)
 
   return handlers.StartJobHandler._start_map(
       name,
@@ -36,19 +36,51 @@ from mapreduce import base_handler
 from mapreduce import context
 from mapreduce import model
 from mapreduce import quota
+from mapreduce import shuffler
 from mapreduce import util
 
 
-# TODO(user): Make this a product of the reader or in quotas.py
+# Shards lease quota for this many seconds of processing at a time, at
+# their recent rate of handler calls, within the batch size bounds below.
+_QUOTA_LEASE_SEC = 2
 _QUOTA_BATCH_SIZE = 20
+_MAX_QUOTA_BATCH_SIZE = 1000
+
+# Shards can save up quota for this many seconds of processing at the
+# processing rate. Must be longer than the longest controller period.
+_QUOTA_BURST_SEC = 30
 
 # The amount of time to perform scanning in one slice. New slice will be
-# scheduled as soon as current one takes this long.
+# scheduled as soon as current one takes this long, or earlier when the next
+# handler call is expected to take longer than the time left.
 _SLICE_DURATION_SEC = 15
 
-# Delay between consecutive controller callback invocations.
+# Weight of the newest handler call in the moving average of the time spent
+# on one handler call.
+_ITEM_TIME_WEIGHT = 0.25
+
+# Shards are split to keep the initial number of shards busy until the total
+# number of shards reaches this many times the initial number.
+_MAX_SPLIT_FACTOR = 4
+
+# Initial delay between consecutive controller callback invocations.
 _CONTROLLER_PERIOD_SEC = 2
 
+# The delay between controller callback invocations grows by this factor
+# while the set of running shards doesn't change, up to the maximum delay.
+_CONTROLLER_PERIOD_GROWTH = 1.5
+_MAX_CONTROLLER_PERIOD_SEC = 10
+
+# Shard states are queried and aggregated at least this often. In between,
+# the controller only checks the markers of changed shards in memcache.
+_FULL_AGGREGATION_PERIOD_SEC = 30
+
+# Memcache namespace of the markers of changed shards.
+_PROGRESS_NAMESPACE = "mapreduce_progress"
+
+# Default number of inputs passed to a batch handler in one call.
+_HANDLER_BATCH_SIZE = 50
+
 
 class Error(Exception):
   """Base class for exceptions in this module."""
@@ -86,6 +118,11 @@ def _run_task_hook(hooks, method, task, queue_name):
   return False
 
 
+def _shard_changed_key(shard_id):
+  """Returns the memcache key set when a shard finished or was split."""
+  return "changed:%s" % shard_id
+
+
 class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
   """Callback handler for mapreduce worker task.
 
@@ -95,6 +132,9 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
     slice_id: id of the slice.
   """
 
+  # Path of the callback relative to the mapreduce base path.
+  _CALLBACK_PATH = "/worker_callback"
+
   def __init__(self, time_function=time.time):
     """Constructor.
 
@@ -115,9 +155,10 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
     logging.debug("post: shard=%s slice=%s headers=%s",
                   shard_id, self.slice_id(), self.request.headers)
 
-    shard_state, control = db.get([
+    shard_state, control, split_control = db.get([
         model.ShardState.get_key_by_shard_id(shard_id),
         model.MapreduceControl.get_key_by_job_id(spec.mapreduce_id),
+        model.MapreduceControl.get_key_by_shard_id(shard_id),
     ])
     if not shard_state:
       # We're letting this task to die. It's up to controller code to
@@ -133,46 +174,64 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
       shard_state.result_status = model.ShardState.RESULT_ABORTED
       shard_state.put(config=util.create_datastore_write_config(spec))
       model.MapreduceControl.abort(spec.mapreduce_id)
+      memcache.set(_shard_changed_key(shard_id), 1,
+                   namespace=_PROGRESS_NAMESPACE)
       return
 
     input_reader = self.input_reader(spec.mapper)
+    if split_control:
+      input_reader = self.split_shard(spec, shard_state, input_reader,
+                                      split_control)
+    self._item_time = shard_state.item_time_sec or 0.0
 
     if spec.mapper.params.get("enable_quota", True):
       quota_consumer = quota.QuotaConsumer(
           quota.QuotaManager(memcache.Client()),
           shard_id,
-          _QUOTA_BATCH_SIZE)
+          self.quota_batch_size())
     else:
       quota_consumer = None
 
     ctx = context.Context(spec, shard_state,
                           task_retry_count=self.task_retry_count())
+    if spec.has_reducer():
+      ctx.register_pool("shuffle_pool", shuffler.ShufflePool(
+          spec, shard_state, self.slice_id()))
+    elif spec.mapper.output_writer_spec:
+      ctx.register_pool("output_writer",
+                        spec.mapper.output_writer_class().for_slice(
+                            spec, shard_state, self.slice_id()))
     context.Context._set(ctx)
 
     try:
+      if not self.prepare_input(input_reader):
+        # Continue preparing in the next slice.
+        pass
       # consume quota ahead, because we do not want to run a datastore
       # query if there's not enough quota for the shard.
-      if not quota_consumer or quota_consumer.check():
+      elif not quota_consumer or quota_consumer.check():
         scan_aborted = False
         entity = None
+        self._item_start_time = self._time()
 
         # We shouldn't fetch an entity from the reader if there's not enough
         # quota to process it. Perform all quota checks proactively.
         if not quota_consumer or quota_consumer.consume():
-          for entity in input_reader:
-            if isinstance(entity, db.Model):
-              shard_state.last_work_item = repr(entity.key())
-            else:
-              shard_state.last_work_item = repr(entity)[:100]
-
-            scan_aborted = not self.process_entity(entity, ctx)
-
-            # Check if we've got enough quota for the next entity.
-            if (quota_consumer and not scan_aborted and
-                not quota_consumer.consume()):
-              scan_aborted = True
-            if scan_aborted:
-              break
+          if util.is_batch_handler(spec.mapper.handler):
+            scan_aborted = not self.process_batches(
+                input_reader, quota_consumer, shard_state, ctx)
+          else:
+            for entity in input_reader:
+              self._set_last_work_item(shard_state, entity)
+
+              scan_aborted = not self.process_entity(entity, ctx)
+
+              # Check if we've got enough quota for the next entity.
+              if (quota_consumer and not scan_aborted and
+                  not quota_consumer.consume()):
+                scan_aborted = True
+              if scan_aborted:
+                break
         else:
           scan_aborted = True
 
@@ -187,6 +246,7 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
           shard_state.active = False
           shard_state.result_status = model.ShardState.RESULT_SUCCESS
 
+      shard_state.item_time_sec = self._item_time
       # TODO(user): Mike said we don't want this happen in case of
       # exception while scanning. Figure out when it's appropriate to skip.
       ctx.flush()
@@ -195,34 +255,133 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
       if quota_consumer:
         quota_consumer.dispose()
 
+    if not shard_state.active or split_control:
+      # Makes the controller aggregate all shard states at the next poll.
+      memcache.set(_shard_changed_key(shard_id), 1,
+                   namespace=_PROGRESS_NAMESPACE)
+
     # Rescheduling work should always be the last statement. It shouldn't happen
-    # if there were any exceptions in code before it.
+    # if there were any exceptions in code before it. Only the split command
+    # is removed after it, so a retried slice repeats the split it saved.
     if shard_state.active:
       self.reschedule(spec, input_reader)
+    if split_control:
+      db.delete(split_control)
+
+  def quota_batch_size(self):
+    """Returns the amount of quota to lease at a time.
+
+    The amount covers _QUOTA_LEASE_SEC seconds of handler calls at the
+    average call time of the shard.
+    """
+    if not self._item_time:
+      return _QUOTA_BATCH_SIZE
+    return max(_QUOTA_BATCH_SIZE,
+               min(_MAX_QUOTA_BATCH_SIZE,
+                   int(_QUOTA_LEASE_SEC / self._item_time)))
+
+  def prepare_input(self, input_reader):
+    """Prepare the input reader before any input is read from it.
+
+    Args:
+      input_reader: the input reader of the shard.
+
+    Returns:
+      True if input can be read, False if preparing must continue in the
+      next slice.
+    """
+    return True
+
+  @staticmethod
+  def _set_last_work_item(shard_state, entity):
+    """Record the entity in the shard state as the last processed input."""
+    if isinstance(entity, db.Model):
+      shard_state.last_work_item = repr(entity.key())
+    else:
+      shard_state.last_work_item = repr(entity)[:100]
+
+  def process_batches(self, input_reader, quota_consumer, shard_state, ctx):
+    """Process the input in batches with a batch handler.
+
+    Inputs are collected into lists of up to 'handler_batch_size' (a mapper
+    parameter) inputs, and each list is passed to the mapper handler in one
+    call. As with single inputs, quota is consumed before each input is
+    read, and the scan is aborted after a batch once the slice takes too
+    long.
+
+    Args:
+      input_reader: the input reader of the shard.
+      quota_consumer: the quota.QuotaConsumer of the shard, or None.
+      shard_state: the model.ShardState of the shard.
+      ctx: current execution context.
+
+    Returns:
+      True if all input was processed, False if scan was aborted.
+    """
+    batch_size = int(ctx.mapreduce_spec.mapper.params.get(
+        "handler_batch_size", _HANDLER_BATCH_SIZE))
+    batch = []
+    for entity in input_reader:
+      batch.append(entity)
+      # Check if we've got enough quota for the next entity.
+      out_of_quota = quota_consumer and not quota_consumer.consume()
+      if len(batch) >= batch_size or out_of_quota:
+        self._set_last_work_item(shard_state, entity)
+        if not self.process_entity(batch, ctx) or out_of_quota:
+          return False
+        batch = []
+    if batch:
+      self._set_last_work_item(shard_state, batch[-1])
+      self.process_entity(batch, ctx)
+    return True
 
   def process_entity(self, entity, ctx):
     """Process a single entity.
 
-    Call mapper handler on the entity.
+    Call mapper handler on the entity. A batch handler is called with a
+    list of entities instead. In the reduce stage, the entity is a
+    (key, values) tuple and the reducer handler is called with the key and
+    the values.
+
+    Key/value tuples yielded by a mapper handler are collected for the
+    reduce stage. Without a reducer, other values yielded by the handler are
+    written by the output writer of the mapper.
 
     Args:
-      entity: an entity to process.
+      entity: an entity to process, or a list of entities for a batch
+        handler.
       ctx: current execution context.
 
     Returns:
       True if scan should be continued, False if scan should be aborted.
     """
-    ctx.counters.increment(context.COUNTER_MAPPER_CALLS)
-
     handler = ctx.mapreduce_spec.mapper.handler
+    if ctx.mapreduce_spec.is_reduce_stage():
+      ctx.counters.increment(context.COUNTER_REDUCER_CALLS)
+      args = entity
+    elif util.is_batch_handler(handler):
+      ctx.counters.increment(context.COUNTER_MAPPER_CALLS, len(entity))
+      args = (entity,)
+    else:
+      ctx.counters.increment(context.COUNTER_MAPPER_CALLS)
+      args = (entity,)
+
     if util.is_generator_function(handler):
-      for result in handler(entity):
+      shuffle_pool = ctx.get_pool("shuffle_pool")
+      output_writer = ctx.get_pool("output_writer")
+      for result in handler(*args):
         if callable(result):
           result(ctx)
+        elif output_writer:
+          output_writer.write(result, ctx)
         else:
           try:
             if len(result) == 2:
-              logging.error("Collectors not implemented yet")
+              if shuffle_pool:
+                shuffle_pool.append(result[0], result[1])
+              else:
+                logging.error("Handler yielded a key/value pair, but the "
+                              "mapreduce has no reducer")
             else:
               logging.error("Got bad output tuple of length %d", len(result))
           except TypeError:
@@ -230,14 +389,82 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
                 "Handler yielded type %s, expected a callable or a tuple",
                 result.__class__.__name__)
     else:
-      handler(entity)
-
-    if self._time() - self._start_time > _SLICE_DURATION_SEC:
-      logging.debug("Spent %s seconds. Rescheduling",
-                    self._time() - self._start_time)
+      handler(*args)
+
+    now = self._time()
+    self._item_time += _ITEM_TIME_WEIGHT * (
+        now - self._item_start_time - self._item_time)
+    self._item_start_time = now
+    if now - self._start_time + self._item_time > _SLICE_DURATION_SEC:
+      logging.debug("Spent %s seconds, %s seconds per call. Rescheduling",
+                    now - self._start_time, self._item_time)
       return False
     return True
 
+  def split_shard(self, spec, shard_state, input_reader, split_control):
+    """Moves part of the remaining input of the shard to a new shard.
+
+    Called at the start of a slice when the controller asked to split the
+    shard. If the input reader can split its remaining input, a new shard
+    is created to process the split off part.
+
+    The readers of both shards are saved in the split command before the
+    new shard is scheduled. A retried slice starts with the same reader,
+    and uses the saved readers instead of splitting again, so the new shard
+    and the rest of the shard never overlap or leave a gap. A first split
+    is abandoned if the new shard already exists, so a shard number that
+    was handed out twice can't replace the input of a running shard.
+
+    Args:
+      spec: mapreduce specification as MapreduceSpec.
+      shard_state: the model.ShardState of the shard.
+      input_reader: the input reader of the shard.
+      split_control: the split command as model.MapreduceControl.
+
+    Returns:
+      the input reader the shard continues with.
+    """
+    slice_id = self.slice_id()
+    shard_number = split_control.shard_number
+    reader_class = spec.mapper.input_reader_class()
+    new_shard = model.ShardState.create_new(spec.mapreduce_id, shard_number,
+                                            shard_state.stage)
+    if split_control.split_state:
+      split_state = simplejson.loads(split_control.split_state)
+      if split_state["slice_id"] != slice_id:
+        # The split was made by an earlier slice, which already scheduled
+        # this one with the remaining input.
+        return input_reader
+      input_reader = reader_class.from_json(split_state["input_reader"])
+      new_reader = reader_class.from_json(split_state["new_input_reader"])
+    else:
+      if model.ShardState.get_by_shard_id(new_shard.shard_id):
+        logging.warning("Not splitting shard %d of job '%s', shard %d "
+                        "already exists", shard_state.shard_number,
+                        shard_state.mapreduce_id, shard_number)
+        return input_reader
+      new_reader = input_reader.split_remaining()
+      if new_reader is None:
+        logging.debug("Can't split shard %d of job '%s'",
+                      shard_state.shard_number, shard_state.mapreduce_id)
+        return input_reader
+      split_control.split_state = simplejson.dumps({
+          "slice_id": slice_id,
+          "input_reader": input_reader.to_json(),
+          "new_input_reader": new_reader.to_json()})
+      split_control.put(config=util.create_datastore_write_config(spec))
+    logging.info("Moving part of shard %d of job '%s' to shard %d",
+                 shard_state.shard_number, shard_state.mapreduce_id,
+                 shard_number)
+    new_shard.shard_description = str(new_reader)
+    # A retried slice must not reset a shard that is already running.
+    if not model.ShardState.get_by_shard_id(new_shard.shard_id):
+      new_shard.put(config=util.create_datastore_write_config(spec))
+    self.schedule_slice(self.base_path(), spec, new_shard.shard_id, 0,
+                        new_reader)
+    shard_state.shard_description = str(input_reader)
+    return input_reader
+
   def shard_id(self):
     """Get shard unique identifier of this task from request.
 
@@ -315,7 +542,7 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
       mapreduce_spec: mapreduce specification.
       input_reader: remaining input reader to process.
     """
-    MapperWorkerCallbackHandler.schedule_slice(
+    self.schedule_slice(
         self.base_path(), mapreduce_spec, self.shard_id(),
         self.slice_id() + 1, input_reader)
 
@@ -351,7 +578,7 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
     queue_name = os.environ.get("HTTP_X_APPENGINE_QUEUENAME",
                                 queue_name or "default")
 
-    worker_task = taskqueue.Task(url=base_path + "/worker_callback",
+    worker_task = taskqueue.Task(url=base_path + cls._CALLBACK_PATH,
                                  params=task_params,
                                  name=task_name,
                                  eta=eta,
@@ -369,6 +596,35 @@ class MapperWorkerCallbackHandler(base_handler.TaskQueueHandler):
                         task_name, task_params, e.__class__, e)
 
 
+class ReducerWorkerCallbackHandler(MapperWorkerCallbackHandler):
+  """Callback handler for reduce worker task.
+
+  Reduce shards run the reducer handler as mapper over the shuffled map
+  output of their partition, which is read by a shuffler.ShuffleInputReader.
+  The first slices of a reduce shard merge the runs of the partition, until
+  few enough runs are left to merge them while reducing.
+
+  Request Parameters:
+    mapreduce_spec: MapreduceSpec of the reduce stage serialized to json.
+    shard_id: id of the reduce shard.
+    slice_id: id of the slice.
+  """
+
+  _CALLBACK_PATH = "/reduce_callback"
+
+  def prepare_input(self, input_reader):
+    """Merge the runs of the partition until few enough are left.
+
+    Args:
+      input_reader: the shuffler.ShuffleInputReader of the shard.
+
+    Returns:
+      True if the merging is done, False if it must continue in the next
+      slice.
+    """
+    return input_reader.merge(self._start_time + _SLICE_DURATION_SEC)
+
+
 class ControllerCallbackHandler(base_handler.TaskQueueHandler):
   """Supervises mapreduce execution.
 
@@ -376,6 +632,16 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
 
   This task is "continuously" running by adding itself again to taskqueue if
   mapreduce is still active.
+
+  Shard states are only queried and aggregated when a running shard finished
+  or was split, when the job is aborted, and at least every
+  _FULL_AGGREGATION_PERIOD_SEC seconds. In between, a poll only reads the
+  markers that shards set in memcache when they finish or are split, with
+  a single batch get, and the job counters keep their aggregated values.
+  The delay between polls grows
+  while the set of running shards doesn't change. MapreduceState is only
+  written by full aggregations and when the delay changes; the time of the
+  previous poll is passed to the next controller task instead.
   """
 
   def __init__(self, time_function=time.time):
@@ -405,21 +671,54 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
                     spec.mapreduce_id)
       return
 
+    config = util.create_datastore_write_config(spec)
+    processing_rate = int(spec.mapper.params.get(
+        "processing_rate") or model._DEFAULT_PROCESSING_RATE_PER_SEC)
+    period = float(self.request.get("period") or _CONTROLLER_PERIOD_SEC)
+    now = self._time()
+    if self.request.get("poll_time"):
+      poll_time = float(self.request.get("poll_time"))
+    else:
+      poll_time = time.mktime(state.last_poll_time.timetuple())
+
+    if not control and self.poll_progress(state):
+      new_period = min(period * _CONTROLLER_PERIOD_GROWTH,
+                       _MAX_CONTROLLER_PERIOD_SEC)
+      if new_period != period:
+        state.last_poll_time = datetime.datetime.utcfromtimestamp(now)
+        state.put(config=config)
+      self.refill_quotas(poll_time, processing_rate, state.active_shard_ids)
+      ControllerCallbackHandler.reschedule(
+          self.base_path(), spec, self.serial_id() + 1,
+          period=new_period, poll_time=now)
+      return
+
+    # Markers are removed before the query, so shards that change after it
+    # are noticed at the next poll.
+    memcache.delete_multi(
+        [_shard_changed_key(shard_id) for shard_id in state.active_shard_ids],
+        namespace=_PROGRESS_NAMESPACE)
     shard_states = model.ShardState.find_by_mapreduce_id(spec.mapreduce_id)
-    if state.active and len(shard_states) != spec.mapper.shard_count:
+    # Only the shards of the running stage determine the job status.
+    stage_shard_states = [s for s in shard_states if s.stage == state.stage]
+    if state.stage == model.MapreduceState.STAGE_REDUCE:
+      shard_count = spec.reducer_shard_count()
+    else:
+      shard_count = spec.mapper.shard_count
+    if state.active and len(stage_shard_states) < shard_count:
       # Some shards were lost
       logging.error("Incorrect number of shard states: %d vs %d; "
                     "aborting job '%s'",
-                    len(shard_states), spec.mapper.shard_count,
+                    len(stage_shard_states), shard_count,
                     spec.mapreduce_id)
       state.active = False
       state.result_status = model.MapreduceState.RESULT_FAILED
       model.MapreduceControl.abort(spec.mapreduce_id)
 
-    active_shards = [s for s in shard_states if s.active]
-    failed_shards = [s for s in shard_states
+    active_shards = [s for s in stage_shard_states if s.active]
+    failed_shards = [s for s in stage_shard_states
                      if s.result_status == model.ShardState.RESULT_FAILED]
-    aborted_shards = [s for s in shard_states
+    aborted_shards = [s for s in stage_shard_states
                      if s.result_status == model.ShardState.RESULT_ABORTED]
     if state.active:
       state.active = bool(active_shards)
@@ -427,31 +726,50 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
       state.failed_shards = len(failed_shards)
       state.aborted_shards = len(aborted_shards)
 
+    active_shard_ids = [s.shard_id for s in active_shards]
+    if set(active_shard_ids) != set(state.active_shard_ids):
+      period = _CONTROLLER_PERIOD_SEC
+    state.active_shard_ids = active_shard_ids
+    state.aggregation_time = datetime.datetime.utcfromtimestamp(now)
+
+    if (state.active and not failed_shards and not aborted_shards and
+        state.stage == model.MapreduceState.STAGE_MAP and
+        util.parse_bool(spec.mapper.params.get("rebalance_shards", True)) and
+        spec.mapper.input_reader_class().supports_split_remaining()):
+      self.rebalance_shards(spec, state, stage_shard_states, active_shards)
+
     if (not state.active and control and
         control.command == model.MapreduceControl.ABORT):
       # User-initiated abort *after* all shards have completed.
       logging.info("Abort signal received for job '%s'", spec.mapreduce_id)
       state.result_status = model.MapreduceState.RESULT_ABORTED
 
+    if (not state.active and not state.result_status and
+        state.stage == model.MapreduceState.STAGE_MAP and
+        spec.has_reducer() and
+        not [s for s in stage_shard_states
+             if s.result_status != model.ShardState.RESULT_SUCCESS]):
+      self.start_reduce_stage(spec, state, stage_shard_states)
+
     if not state.active:
       state.active_shards = 0
       if not state.result_status:
         # Set final result status derived from shard states.
-        if [s for s in shard_states
+        if [s for s in stage_shard_states
             if s.result_status != model.ShardState.RESULT_SUCCESS]:
           state.result_status = model.MapreduceState.RESULT_FAILED
         else:
           state.result_status = model.MapreduceState.RESULT_SUCCESS
         logging.info("Final result for job '%s' is '%s'",
                      spec.mapreduce_id, state.result_status)
+      if (state.result_status == model.MapreduceState.RESULT_SUCCESS and
+          spec.mapper.output_writer_spec):
+        spec.mapper.output_writer_class().finalize_job(state, shard_states)
 
     # We don't need a transaction here, since we change only statistics data,
     # and we don't care if it gets overwritten/slightly inconsistent.
     self.aggregate_state(state, shard_states)
-    poll_time = state.last_poll_time
-    state.last_poll_time = datetime.datetime.utcfromtimestamp(self._time())
-
-    config = util.create_datastore_write_config(spec)
+    state.last_poll_time = datetime.datetime.utcfromtimestamp(now)
 
     if not state.active:
       # This is the last execution.
@@ -478,11 +796,98 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
     else:
       state.put(config=config)
 
-    processing_rate = int(spec.mapper.params.get(
-        "processing_rate") or model._DEFAULT_PROCESSING_RATE_PER_SEC)
-    self.refill_quotas(poll_time, processing_rate, active_shards)
+    self.refill_quotas(poll_time, processing_rate, state.active_shard_ids)
     ControllerCallbackHandler.reschedule(
-        self.base_path(), spec, self.serial_id() + 1)
+        self.base_path(), spec, self.serial_id() + 1, period=period,
+        poll_time=now)
+
+  def poll_progress(self, state):
+    """Checks if the running shards changed since the last aggregation.
+
+    Args:
+      state: current mapreduce state as MapreduceState.
+
+    Returns:
+      True if the aggregated state is still current, False if all shard
+      states must be aggregated: a running shard finished or was split, or
+      the last aggregation is too old.
+    """
+    if not state.active or not state.aggregation_time:
+      return False
+    aggregation_time = time.mktime(state.aggregation_time.timetuple())
+    if self._time() - aggregation_time >= _FULL_AGGREGATION_PERIOD_SEC:
+      return False
+
+    changed_keys = [_shard_changed_key(shard_id)
+                    for shard_id in state.active_shard_ids]
+    return not memcache.get_multi(changed_keys,
+                                  namespace=_PROGRESS_NAMESPACE)
+
+  def rebalance_shards(self, spec, state, shard_states, active_shards):
+    """Asks running shards to move part of their input to new shards.
+
+    When shards finish early, the remaining input is unevenly spread. For
+    every finished shard, up to the initial number of shards, one of the
+    running shards is asked to split its input, preferring shards that
+    processed the most input, as they are most likely to have a large key
+    range left. The split is done by the shard at the end of its current
+    slice.
+
+    New shard numbers are allocated from state.next_shard_number, as the
+    query of shard states may miss the latest split off shards.
+
+    Args:
+      spec: mapreduce specification as MapreduceSpec.
+      state: current mapreduce state as MapreduceState.
+      shard_states: all shard states of the map stage.
+      active_shards: the shard states of the running map shards.
+    """
+    split_controls = db.get([
+        model.MapreduceControl.get_key_by_shard_id(shard.shard_id)
+        for shard in active_shards])
+    pending = [c for c in split_controls if c]
+    idle_count = spec.mapper.shard_count - len(active_shards) - len(pending)
+    if idle_count <= 0:
+      return
+    next_number = max([spec.mapper.shard_count, state.next_shard_number] +
+                      [shard.shard_number + 1 for shard in shard_states] +
+                      [c.shard_number + 1 for c in pending])
+    max_count = spec.mapper.shard_count * _MAX_SPLIT_FACTOR
+    candidates = [shard for shard, c in zip(active_shards, split_controls)
+                  if not c]
+    candidates.sort(key=lambda x: -x.counters_map.get(
+        context.COUNTER_MAPPER_CALLS))
+    for shard in candidates[:idle_count]:
+      if next_number >= max_count:
+        break
+      model.MapreduceControl.split(shard.shard_id, next_number)
+      next_number += 1
+    state.next_shard_number = next_number
+
+  def start_reduce_stage(self, spec, state, map_shard_states):
+    """Start the reduce stage after all map shards succeeded.
+
+    Args:
+      spec: mapreduce specification as MapreduceSpec.
+      state: current mapreduce state as MapreduceState.
+      map_shard_states: the shard states of all map shards.
+    """
+    logging.info("Starting reduce stage of job '%s'", spec.mapreduce_id)
+    # Map shards that were split off have numbers beyond the initial count.
+    map_shard_count = max([spec.mapper.shard_count, state.next_shard_number] +
+                          [shard.shard_number + 1
+                           for shard in map_shard_states])
+    input_readers = shuffler.ShuffleInputReader.create_readers(
+        spec, map_shard_count)
+    queue_name = os.environ.get("HTTP_X_APPENGINE_QUEUENAME", "default")
+    KickOffJobHandler._schedule_shards(
+        spec.get_reduce_spec(), input_readers, queue_name, self.base_path(),
+        stage=model.MapreduceState.STAGE_REDUCE)
+    state.stage = model.MapreduceState.STAGE_REDUCE
+    state.active = True
+    state.active_shards = len(input_readers)
+    # Reduce shards are found by the aggregation at the next poll.
+    state.aggregation_time = None
 
   def aggregate_state(self, mapreduce_state, shard_states):
     """Update current mapreduce state by aggregating shard states.
@@ -496,38 +901,42 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
 
     for shard_state in shard_states:
       mapreduce_state.counters_map.add_map(shard_state.counters_map)
-      processed_counts.append(shard_state.counters_map.get(
-          context.COUNTER_MAPPER_CALLS))
+      if shard_state.stage == model.MapreduceState.STAGE_MAP:
+        processed_counts.append(shard_state.counters_map.get(
+            context.COUNTER_MAPPER_CALLS))
 
     mapreduce_state.set_processed_counts(processed_counts)
 
   def refill_quotas(self,
                     last_poll_time,
                     processing_rate,
-                    active_shard_states):
+                    active_shard_ids):
     """Refill quotas for all active shards.
 
+    Quota buckets are token buckets holding up to _QUOTA_BURST_SEC seconds
+    of processing. All buckets are refilled with batch memcache calls.
+
     Args:
-      last_poll_time: Datetime with the last time the job state was updated.
+      last_poll_time: Time of the previous poll in seconds since the epoch.
       processing_rate: How many items to process per second overall.
-      active_shard_states: All active shard states, list of ShardState.
+      active_shard_ids: ids of all active shards, list of strings.
     """
-    if not active_shard_states:
+    if not active_shard_ids:
       return
     quota_manager = quota.QuotaManager(memcache.Client())
 
-    current_time = int(self._time())
-    last_poll_time = time.mktime(last_poll_time.timetuple())
+    current_time = self._time()
     total_quota_refill = processing_rate * max(0, current_time - last_poll_time)
+    shard_rate = 1.0 * processing_rate / len(active_shard_ids)
     quota_refill = int(math.ceil(
-        1.0 * total_quota_refill / len(active_shard_states)))
+        1.0 * total_quota_refill / len(active_shard_ids)))
 
     if not quota_refill:
       return
 
-    # TODO(user): use batch memcache API to refill quota in one API call.
-    for shard_state in active_shard_states:
-      quota_manager.put(shard_state.shard_id, quota_refill)
+    quota_manager.put_multi(
+        dict((shard_id, quota_refill) for shard_id in active_shard_ids),
+        capacity=int(math.ceil(shard_rate * _QUOTA_BURST_SEC)))
 
   def serial_id(self):
     """Get serial unique identifier of this task from request.
@@ -554,7 +963,8 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
         mapreduce_spec.mapreduce_id, serial_id)
 
   @staticmethod
-  def controller_parameters(mapreduce_spec, serial_id):
+  def controller_parameters(mapreduce_spec, serial_id,
+                            period=_CONTROLLER_PERIOD_SEC, poll_time=None):
     """Fill in  controller task parameters.
 
     Returned parameters map is to be used as task payload, and it contains
@@ -563,15 +973,23 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
     Args:
       mapreduce_spec: specification of the mapreduce.
       serial_id: id of the invocation as int.
+      period: delay before the invocation in seconds.
+      poll_time: time of the previous poll in seconds since the epoch, or
+        None to use the last poll time of the mapreduce state.
 
     Returns:
       string->string map of parameters to be used as task payload.
     """
-    return {"mapreduce_spec": mapreduce_spec.to_json_str(),
-            "serial_id": str(serial_id)}
+    params = {"mapreduce_spec": mapreduce_spec.to_json_str(),
+              "serial_id": str(serial_id),
+              "period": str(period)}
+    if poll_time is not None:
+      params["poll_time"] = repr(poll_time)
+    return params
 
   @classmethod
-  def reschedule(cls, base_path, mapreduce_spec, serial_id, queue_name=None):
+  def reschedule(cls, base_path, mapreduce_spec, serial_id, queue_name=None,
+                 period=_CONTROLLER_PERIOD_SEC, poll_time=None):
     """Schedule new update status callback task.
 
     Args:
@@ -580,18 +998,20 @@ class ControllerCallbackHandler(base_handler.TaskQueueHandler):
       serial_id: id of the invocation as int.
       queue_name: The queue to schedule this task on. Will use the current
         queue of execution if not supplied.
+      period: delay before the invocation in seconds.
+      poll_time: time of the previous poll in seconds since the epoch.
     """
     task_name = ControllerCallbackHandler.get_task_name(
         mapreduce_spec, serial_id)
     task_params = ControllerCallbackHandler.controller_parameters(
-        mapreduce_spec, serial_id)
+        mapreduce_spec, serial_id, period, poll_time)
     if not queue_name:
       queue_name = os.environ.get("HTTP_X_APPENGINE_QUEUENAME", "default")
 
     controller_callback_task = taskqueue.Task(
         url=base_path + "/controller_callback",
         name=task_name, params=task_params,
-        countdown=_CONTROLLER_PERIOD_SEC)
+        countdown=period)
 
     if not _run_task_hook(mapreduce_spec.get_hooks(),
                           "enqueue_controller_task",
@@ -671,7 +1091,8 @@ class KickOffJobHandler(base_handler.TaskQueueHandler):
     return value
 
   @classmethod
-  def _schedule_shards(cls, spec, input_readers, queue_name, base_path):
+  def _schedule_shards(cls, spec, input_readers, queue_name, base_path,
+                       stage=model.MapreduceState.STAGE_MAP):
     """Prepares shard states and schedules their execution.
 
     Args:
@@ -679,13 +1100,15 @@ class KickOffJobHandler(base_handler.TaskQueueHandler):
       input_readers: list of InputReaders describing shard splits.
       queue_name: The queue to run this job on.
       base_path: The base url path of mapreduce callbacks.
+      stage: the stage of the shards.
     """
     # Note: it's safe to re-attempt this handler because:
     # - shard state has deterministic and unique key.
     # - schedule_slice will fall back gracefully if a task already exists.
     shard_states = []
     for shard_number, input_reader in enumerate(input_readers):
-      shard = model.ShardState.create_new(spec.mapreduce_id, shard_number)
+      shard = model.ShardState.create_new(spec.mapreduce_id, shard_number,
+                                          stage)
       shard.shard_description = str(input_reader)
       shard_states.append(shard)
 
@@ -699,11 +1122,14 @@ class KickOffJobHandler(base_handler.TaskQueueHandler):
             if shard.key() not in existing_shard_keys),
            config=util.create_datastore_write_config(spec))
 
-    for shard_number, input_reader in enumerate(input_readers):
-      shard_id = model.ShardState.shard_id_from_number(
-          spec.mapreduce_id, shard_number)
-      MapperWorkerCallbackHandler.schedule_slice(
-          base_path, spec, shard_id, 0, input_reader, queue_name=queue_name)
+    if stage == model.MapreduceState.STAGE_REDUCE:
+      worker_handler = ReducerWorkerCallbackHandler
+    else:
+      worker_handler = MapperWorkerCallbackHandler
+    for shard, input_reader in zip(shard_states, input_readers):
+      worker_handler.schedule_slice(
+          base_path, spec, shard.shard_id, 0, input_reader,
+          queue_name=queue_name)
 
 
 class StartJobHandler(base_handler.PostJsonHandler):
@@ -715,6 +1141,7 @@ class StartJobHandler(base_handler.PostJsonHandler):
     mapreduce_name = self._get_required_param("name")
     mapper_input_reader_spec = self._get_required_param("mapper_input_reader")
     mapper_handler_spec = self._get_required_param("mapper_handler")
+    mapper_output_writer_spec = self.request.get("mapper_output_writer")
     mapper_params = self._get_params(
         "mapper_params_validator", "mapper_params.")
     params = self._get_params(
@@ -731,7 +1158,8 @@ class StartJobHandler(base_handler.PostJsonHandler):
         mapper_handler_spec,
         mapper_input_reader_spec,
         mapper_params,
-        int(mapper_params.get("shard_count", model._DEFAULT_SHARD_COUNT)))
+        int(mapper_params.get("shard_count", model._DEFAULT_SHARD_COUNT)),
+        mapper_output_writer_spec or None)
 
     mapreduce_id = type(self)._start_map(
         mapreduce_name,
@@ -801,11 +1229,19 @@ class StartJobHandler(base_handler.PostJsonHandler):
                  transactional=False):
     # Check that handler can be instantiated.
     mapper_spec.get_handler()
+    reducer_spec = mapreduce_params.get(model.MapreduceSpec.PARAM_REDUCER)
+    if reducer_spec:
+      util.for_name(reducer_spec)
 
     # Check that reader can be instantiated and is configured correctly
     mapper_input_reader_class = mapper_spec.input_reader_class()
     mapper_input_reader_class.validate(mapper_spec)
 
+    # Check that writer can be instantiated and is configured correctly
+    mapper_output_writer_class = mapper_spec.output_writer_class()
+    if mapper_output_writer_class:
+      mapper_output_writer_class.validate(mapper_spec)
+
     mapreduce_id = model.MapreduceState.new_mapreduce_id()
     mapreduce_spec = model.MapreduceSpec(
         name,
@@ -864,8 +1300,18 @@ class CleanUpJobHandler(base_handler.PostJsonHandler):
     db.delete(model.MapreduceControl.get_key_by_job_id(mapreduce_id))
 
     shards = model.ShardState.find_by_mapreduce_id(mapreduce_id)
+    db.delete([model.MapreduceControl.get_key_by_shard_id(shard.shard_id)
+               for shard in shards])
     db.delete(shards)
 
+    for chunk_class in (model.ShuffleChunk, model.OutputChunk):
+      chunks_query = chunk_class.find_keys_by_mapreduce_id(mapreduce_id)
+      chunk_keys = chunks_query.fetch(500)
+      while chunk_keys:
+        db.delete(chunk_keys)
+        chunks_query.with_cursor(chunks_query.cursor())
+        chunk_keys = chunks_query.fetch(500)
+
     db.delete(model.MapreduceState.get_key_by_job_id(mapreduce_id))
 
     self.json_response["status"] = ("Job %s successfully cleaned up." %
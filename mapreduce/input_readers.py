@@ -122,6 +122,23 @@ class InputReader(JsonMixin):
     """
     raise NotImplementedError("validate() not implemented in %s" % cls)
 
+  @classmethod
+  def supports_split_remaining(cls):
+    """Returns True if split_remaining() can move input to a new reader."""
+    return False
+
+  def split_remaining(self):
+    """Moves part of the remaining input to a new reader.
+
+    Used to rebalance a running mapreduce: the new reader is processed by a
+    new shard.
+
+    Returns:
+      a new InputReader for the moved input, or None if the remaining input
+      can't be split.
+    """
+    return None
+
 
 # TODO(user): Use cursor API as soon as we have it available.
 class DatastoreInputReader(InputReader):
@@ -138,17 +155,36 @@ class DatastoreInputReader(InputReader):
   # Number of entities to fetch at once while doing scanning.
   _BATCH_SIZE = 50
 
+  # Bounds of the adaptive batch size.
+  _MIN_BATCH_SIZE = 10
+  _MAX_BATCH_SIZE = 500
+
+  # The adaptive batch size aims to map a batch in about this many seconds,
+  # which leaves the query for the next batch enough time to complete.
+  _TARGET_BATCH_SEC = 1.0
+
+  # The adaptive batch size keeps batches below this many bytes.
+  _MAX_BATCH_BYTES = 1000 * 1000
+
   # Maximum number of shards we'll create.
   _MAX_SHARD_COUNT = 256
 
   # __scatter__ oversampling factor
   _OVERSAMPLING_FACTOR = 32
 
+  # Number of __scatter__ samples taken to split an ancestor scope. The
+  # samples are taken over the whole kind, so this is larger than the
+  # oversampled count for a whole kind.
+  _ANCESTOR_SAMPLE_SIZE = 1000
+
   # Mapreduce parameters.
   ENTITY_KIND_PARAM = "entity_kind"
   KEYS_ONLY_PARAM = "keys_only"
   BATCH_SIZE_PARAM = "batch_size"
   KEY_RANGE_PARAM = "key_range"
+  ADAPTIVE_BATCH_SIZE_PARAM = "adaptive_batch_size"
+  ANCESTOR_PARAM = "ancestor"
+  FILTERS_PARAM = "filters"
 
   # TODO(user): Add support for arbitrary queries. It's not possible to
   # support them without cursors since right now you can't even serialize query
@@ -168,33 +204,231 @@ class DatastoreInputReader(InputReader):
     # work items.
     self._key_ranges = list(reversed(key_ranges))
     self._batch_size = int(batch_size)
+    # Whether batch_size is adjusted to the entity size and mapping time.
+    self._adaptive_batch_size = False
+    # Equality filters as a list of [property name, value] pairs.
+    self._filters = []
 
   def __iter__(self):
     """Create a generator for model instances for entities.
 
     Iterating through entities moves query range past the consumed entities.
+    The query for the next batch starts after the last key of the current
+    batch, and runs asynchronously while the current batch is mapped.
 
     Yields:
       next model instance.
     """
+    kind_class = util.for_name(self._entity_kind)
+    results = None
     while True:
       if self._current_key_range is None:
         break
 
-      while True:
-        query = self._current_key_range.make_ascending_query(
-            util.for_name(self._entity_kind))
-        results = query.fetch(limit=self._batch_size)
+      if results is None:
+        results = self._run_query(kind_class, self._current_key_range)
+      batch = list(results)
 
-        if not results:
-          self._advance_key_range()
-          break
+      if not batch:
+        self._advance_key_range()
+        results = None
+        continue
 
-        for model_instance in results:
-          key = model_instance.key()
+      # Prefetch the next batch while this one is being mapped.
+      results = self._run_query(kind_class, self._current_key_range,
+                                after_key=batch[-1].key())
 
-          self._current_key_range.advance(key)
-          yield model_instance
+      mapping_time = 0.0
+      for model_instance in batch:
+        key = model_instance.key()
+
+        self._current_key_range.advance(key)
+        start_time = time.time()
+        yield model_instance
+        mapping_time += time.time() - start_time
+      self._adapt_batch_size(batch, mapping_time)
+
+  def _run_query(self, kind_class, k_range, after_key=None):
+    """Starts the query for the next batch of a key range.
+
+    Args:
+      kind_class: the model class of the entity kind.
+      k_range: the key_range.KeyRange to query.
+      after_key: if given, only entities with a greater key are returned.
+
+    Returns:
+      an iterator over the model instances of the batch. The query is sent
+      when the iterator is created; the first call to next waits for it.
+    """
+    query = k_range.make_ascending_query(kind_class)
+    for prop_name, value in self._filters:
+      query.filter("%s =" % prop_name,
+                   self._filter_value(kind_class, prop_name, value))
+    if after_key is not None:
+      query.filter("__key__ >", after_key)
+    return query.run(limit=self._batch_size, batch_size=self._batch_size)
+
+  @staticmethod
+  def _filter_value(kind_class, prop_name, value):
+    """Converts a filter value given as string to the property type.
+
+    Args:
+      kind_class: the model class of the entity kind.
+      prop_name: the name of the filtered property.
+      value: the filter value.
+
+    Returns:
+      the value to filter the property on.
+    """
+    prop = kind_class.properties().get(prop_name)
+    if prop is None or not isinstance(value, basestring):
+      return value
+    if isinstance(prop, db.ReferenceProperty):
+      return db.Key(value)
+    if prop.data_type is bool:
+      return util.parse_bool(value)
+    if prop.data_type in (int, long, float):
+      return prop.data_type(value)
+    return value
+
+  @classmethod
+  def _parse_filters(cls, filters):
+    """Parses the filters parameter.
+
+    Args:
+      filters: either a list of [property name, value] pairs, or a string
+        of comma separated property=value pairs.
+
+    Returns:
+      a list of [property name, value] pairs.
+
+    Raises:
+      BadReaderParamsError: the filters are malformed.
+    """
+    if not filters:
+      return []
+    if isinstance(filters, basestring):
+      filters = [[part.strip() for part in f.split("=", 1)]
+                 for f in filters.split(",")]
+    result = []
+    for f in filters:
+      if len(f) != 2 or not f[0]:
+        raise BadReaderParamsError("Bad filter: %r" % (f,))
+      result.append([f[0], f[1]])
+    return result
+
+  @classmethod
+  def _parse_ancestor(cls, ancestor):
+    """Parses the ancestor parameter.
+
+    Args:
+      ancestor: an encoded db.Key, or an empty value.
+
+    Returns:
+      the ancestor as db.Key, or None if no ancestor was given.
+
+    Raises:
+      BadReaderParamsError: the ancestor is not a valid key.
+    """
+    if not ancestor:
+      return None
+    try:
+      return db.Key(ancestor)
+    except db.BadKeyError, e:
+      raise BadReaderParamsError("Bad ancestor: %s" % e)
+
+  @staticmethod
+  def _ancestor_bounds(ancestor):
+    """Returns the key bounds of an ancestor and all its descendants.
+
+    Descendant keys sort directly after the key of their ancestor, and
+    before the key of the next possible sibling of the ancestor.
+
+    Args:
+      ancestor: the ancestor as db.Key.
+
+    Returns:
+      a (key_start, key_end) tuple. key_start is included in the scope,
+      key_end is not.
+    """
+    if ancestor.id() is not None:
+      next_id_or_name = ancestor.id() + 1
+    else:
+      next_id_or_name = ancestor.name() + u"\x00"
+    parent = ancestor.parent()
+    if parent is not None:
+      key_end = db.Key.from_path(ancestor.kind(), next_id_or_name,
+                                 parent=parent)
+    else:
+      key_end = db.Key.from_path(ancestor.kind(), next_id_or_name,
+                                 namespace=ancestor.namespace(),
+                                 _app=ancestor.app())
+    return ancestor, key_end
+
+  def _adapt_batch_size(self, batch, mapping_time):
+    """Adjusts the batch size to the observed entity size and mapping time.
+
+    The batch size moves halfway towards the size that maps in about
+    _TARGET_BATCH_SEC and stays below _MAX_BATCH_BYTES.
+
+    Args:
+      batch: the list of model instances that was just mapped.
+      mapping_time: the seconds spent mapping the batch as float.
+    """
+    if not self._adaptive_batch_size:
+      return
+    entity_size = max(1, len(db.model_to_protobuf(batch[0]).Encode()))
+    target = self._MAX_BATCH_BYTES / entity_size
+    if mapping_time > 0:
+      target = min(target,
+                   int(self._TARGET_BATCH_SEC * len(batch) / mapping_time))
+    target = max(self._MIN_BATCH_SIZE, min(self._MAX_BATCH_SIZE, target))
+    self._batch_size = (self._batch_size + target) / 2
+
+  @classmethod
+  def supports_split_remaining(cls):
+    """Returns True if split_remaining() can move input to a new reader."""
+    return True
+
+  def split_remaining(self):
+    """Moves part of the remaining input to a new reader.
+
+    If more than one key range is left, the later half of the key ranges is
+    moved. Otherwise the current key range is split in two with
+    KeyRange.split_range, and the upper half is moved. An open ended key
+    range is not split, as its end can only be guessed, and keys past a
+    guessed end would be dropped from the job.
+
+    Returns:
+      a new reader of the same class for the moved key ranges, or None if
+      the remaining input can't be split.
+    """
+    if len(self._key_ranges) > 1:
+      # The key ranges are a stack, the later ranges come first.
+      count = len(self._key_ranges) / 2
+      moved = self._key_ranges[:count]
+      self._key_ranges = self._key_ranges[count:]
+      return self._reader_for_key_ranges(list(reversed(moved)))
+
+    k_range = self._current_key_range
+    if (k_range is None or k_range.key_start is None or
+        k_range.key_end is None):
+      # Nothing was read from the range yet, so its start is unknown, or
+      # the range is open ended.
+      return None
+    split_ranges = k_range.split_range()
+    if len(split_ranges) != 2 or split_ranges[1].key_start == k_range.key_start:
+      return None
+    lower, upper = split_ranges
+    lower.direction = upper.direction = key_range.KeyRange.ASC
+    self._key_ranges[-1] = lower
+    return self._reader_for_key_ranges([upper])
+
+  def _reader_for_key_ranges(self, key_ranges):
+    """Returns a copy of this reader that reads the given key ranges."""
+    reader = self.from_json(self.to_json())
+    reader._key_ranges = list(reversed(key_ranges))
+    return reader
 
   @property
   def _current_key_range(self):
@@ -211,14 +445,34 @@ class DatastoreInputReader(InputReader):
   # instead.
   @classmethod
   def _split_input_from_namespace(cls, app, namespace, entity_kind_name,
-                                  shard_count):
-    """Return KeyRange objects. Helper for _split_input_from_params."""
+                                  shard_count, ancestor=None):
+    """Return KeyRange objects. Helper for _split_input_from_params.
+
+    If an ancestor is given, the key ranges only cover the ancestor and its
+    descendants. __scatter__ can't be combined with an ancestor, so the
+    split points are sampled from the whole kind and those outside the
+    ancestor scope are dropped.
+    """
 
     raw_entity_kind = util.get_short_name(entity_kind_name)
 
+    if ancestor is None:
+      key_start, key_end = None, None
+      sample_size = shard_count * cls._OVERSAMPLING_FACTOR
+    else:
+      key_start, key_end = cls._ancestor_bounds(ancestor)
+      sample_size = cls._ANCESTOR_SAMPLE_SIZE
+    scope = key_range.KeyRange(key_start=key_start,
+                               key_end=key_end,
+                               direction=key_range.KeyRange.ASC,
+                               include_start=True,
+                               include_end=ancestor is None,
+                               namespace=namespace,
+                               _app=app)
+
     if shard_count == 1:
       # With one shard we don't need to calculate any splitpoints at all.
-      return [key_range.KeyRange(namespace=namespace, _app=app)]
+      return [scope]
 
     # we use datastore.Query instead of ext.db.Query here, because we can't
     # erase ordering on db.Query once we set it.
@@ -227,11 +481,13 @@ class DatastoreInputReader(InputReader):
                                _app=app,
                                keys_only=True)
     ds_query.Order("__scatter__")
-    random_keys = ds_query.Get(shard_count * cls._OVERSAMPLING_FACTOR)
+    random_keys = ds_query.Get(sample_size)
+    if ancestor is not None:
+      random_keys = [k for k in random_keys if key_start < k < key_end]
     if not random_keys:
       # This might mean that there are no entities with scatter property
       # or there are no entities at all.
-      return [key_range.KeyRange(namespace=namespace, _app=app)]
+      return [scope]
     random_keys.sort()
     # pick shard_count - 1 points to generate shard_count splits
     split_points_count = shard_count - 1
@@ -243,10 +499,10 @@ class DatastoreInputReader(InputReader):
     key_ranges = []
 
     key_ranges.append(key_range.KeyRange(
-        key_start=None,
+        key_start=key_start,
         key_end=random_keys[0],
         direction=key_range.KeyRange.ASC,
-        include_start=False,
+        include_start=key_start is not None,
         include_end=False,
         namespace=namespace))
 
@@ -261,7 +517,7 @@ class DatastoreInputReader(InputReader):
 
     key_ranges.append(key_range.KeyRange(
         key_start=random_keys[-1],
-        key_end=None,
+        key_end=key_end,
         direction=key_range.KeyRange.ASC,
         include_start=True,
         include_end=False,
@@ -273,13 +529,18 @@ class DatastoreInputReader(InputReader):
   def _split_input_from_params(cls, app, namespaces, entity_kind_name,
                                params, shard_count):
     """Return input reader objects. Helper for split_input."""
+    ancestor = cls._parse_ancestor(params.get(cls.ANCESTOR_PARAM))
+    if ancestor is not None:
+      # The ancestor scope lies within the namespace of the ancestor.
+      namespaces = [ancestor.namespace()]
     key_ranges = []  # KeyRanges for all namespaces
     for namespace in namespaces:
       key_ranges.extend(
           cls._split_input_from_namespace(app,
                                           namespace,
                                           entity_kind_name,
-                                          shard_count))
+                                          shard_count,
+                                          ancestor))
 
     # Divide the KeyRanges into shard_count shards. The KeyRanges for different
     # namespaces might be very different in size so the assignment of KeyRanges
@@ -288,8 +549,17 @@ class DatastoreInputReader(InputReader):
     for i, k_range in enumerate(key_ranges):
       shared_ranges[i % shard_count].append(k_range)
     batch_size = int(params.get(cls.BATCH_SIZE_PARAM, cls._BATCH_SIZE))
-    return [cls(entity_kind_name, ranges, batch_size)
-            for ranges in shared_ranges if ranges]
+    readers = [cls(entity_kind_name, ranges, batch_size)
+               for ranges in shared_ranges if ranges]
+    # The batch size only adapts if none was given.
+    adaptive_batch_size = util.parse_bool(
+        params.get(cls.ADAPTIVE_BATCH_SIZE_PARAM,
+                   cls.BATCH_SIZE_PARAM not in params))
+    filters = cls._parse_filters(params.get(cls.FILTERS_PARAM))
+    for reader in readers:
+      reader._adaptive_batch_size = adaptive_batch_size
+      reader._filters = filters
+    return readers
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -311,10 +581,20 @@ class DatastoreInputReader(InputReader):
     entity_kind_name = params[cls.ENTITY_KIND_PARAM]
     # Fail fast if Model cannot be located.
     try:
-      util.for_name(entity_kind_name)
+      kind_class = util.for_name(entity_kind_name)
     except ImportError, e:
       raise BadReaderParamsError("Bad entity kind: %s" % e)
 
+    for prop_name, value in cls._parse_filters(
+        params.get(cls.FILTERS_PARAM)):
+      if prop_name not in kind_class.properties():
+        raise BadReaderParamsError("Bad filter property: %s" % prop_name)
+      try:
+        cls._filter_value(kind_class, prop_name, value)
+      except (ValueError, db.BadKeyError), e:
+        raise BadReaderParamsError("Bad filter value for %s: %s" %
+                                   (prop_name, e))
+
   @classmethod
   def _common_validate(cls, mapper_spec):
     """Validates mapper spec and all mapper parameters.
@@ -352,6 +632,7 @@ class DatastoreInputReader(InputReader):
       else:
         raise BadReaderParamsError(
             "Bad namespace list: expected a list of strings")
+    cls._parse_ancestor(params.get(cls.ANCESTOR_PARAM))
 
   @classmethod
   def split_input(cls, mapper_spec):
@@ -375,7 +656,13 @@ class DatastoreInputReader(InputReader):
         input reader will only yield entities in the given namespaces. If
         'namespaces' is not given then the current namespace will be used. May
         also have 'batch_size' in the params to specify the number of entities
-        to process in each batch.
+        to process in each batch. Without 'batch_size', or with
+        'adaptive_batch_size' set, the batch size of DatastoreInputReader
+        objects is adjusted to the observed entity size and mapping time.
+        May have 'ancestor' as an encoded key to only read the ancestor and
+        its descendants. DatastoreInputReader may also have 'filters' as a
+        list of [property, value] pairs or a string of comma separated
+        property=value pairs, to only read entities with these values.
 
     Returns:
       A list of InputReader objects of length <= number_of_shards. These
@@ -401,7 +688,9 @@ class DatastoreInputReader(InputReader):
     """
     json_dict = {self.KEY_RANGE_PARAM: [k.to_json() for k in self._key_ranges],
                  self.ENTITY_KIND_PARAM: self._entity_kind,
-                 self.BATCH_SIZE_PARAM: self._batch_size}
+                 self.BATCH_SIZE_PARAM: self._batch_size,
+                 self.ADAPTIVE_BATCH_SIZE_PARAM: self._adaptive_batch_size,
+                 self.FILTERS_PARAM: self._filters}
     return json_dict
 
   def __str__(self):
@@ -422,6 +711,9 @@ class DatastoreInputReader(InputReader):
         json[cls.ENTITY_KIND_PARAM],
         [key_range.KeyRange.from_json(k) for k in json[cls.KEY_RANGE_PARAM]],
         json[cls.BATCH_SIZE_PARAM])
+    query_range._adaptive_batch_size = json.get(
+        cls.ADAPTIVE_BATCH_SIZE_PARAM, False)
+    query_range._filters = json.get(cls.FILTERS_PARAM, [])
     return query_range
 
 
@@ -465,6 +757,9 @@ class DatastoreKeyInputReader(DatastoreInputReader):
       BadReaderParamsError: required parameters are missing or invalid.
     """
     cls._common_validate(mapper_spec)
+    if mapper_spec.params.get(cls.FILTERS_PARAM):
+      raise BadReaderParamsError("Filters are only supported by "
+                                 "DatastoreInputReader")
 
 
 class DatastoreEntityInputReader(DatastoreInputReader):
@@ -507,6 +802,9 @@ class DatastoreEntityInputReader(DatastoreInputReader):
       BadReaderParamsError: required parameters are missing or invalid.
     """
     cls._common_validate(mapper_spec)
+    if mapper_spec.params.get(cls.FILTERS_PARAM):
+      raise BadReaderParamsError("Filters are only supported by "
+                                 "DatastoreInputReader")
 
 
 class BlobstoreLineInputReader(InputReader):
@@ -1253,6 +1551,15 @@ class NamespaceInputReader(DatastoreKeyInputReader):
     mapper_spec.shard_count = 1
     return super(DatastoreKeyInputReader, cls).split_input(mapper_spec)
 
+  @classmethod
+  def supports_split_remaining(cls):
+    """Namespaces are always read by one shard."""
+    return False
+
+  def split_remaining(self):
+    """Namespaces are always read by one shard."""
+    return None
+
   def __iter__(self):
     for key in DatastoreKeyInputReader.__iter__(self):
       yield metadata.Namespace.key_to_namespace(key)
@@ -57,6 +57,7 @@ def create_handlers_map():
   return [
       # Task queue handlers.
       (r".*/worker_callback", handlers.MapperWorkerCallbackHandler),
+      (r".*/reduce_callback", handlers.ReducerWorkerCallbackHandler),
       (r".*/controller_callback", handlers.ControllerCallbackHandler),
       (r".*/kickoffjob_callback", handlers.KickOffJobHandler),
 
@@ -69,6 +70,9 @@ def create_handlers_map():
       (r".*/command/list_jobs", status.ListJobsHandler),
       (r".*/command/get_job_detail", status.GetJobDetailHandler),
 
+      # Job output downloads
+      (r".*/output", status.OutputHandler),
+
       # UI static files
       (STATIC_RE, status.ResourceHandler),
 
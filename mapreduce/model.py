@@ -27,7 +27,8 @@ serialized to/from json and passed around with other means.
 
 
 __all__ = ["JsonMixin", "JsonProperty", "MapreduceState", "MapperSpec",
-           "MapreduceControl", "MapreduceSpec", "ShardState", "CountersMap"]
+           "MapreduceControl", "MapreduceSpec", "ShardState", "CountersMap",
+           "ShuffleChunk", "OutputChunk"]
 
 import copy
 import datetime
@@ -322,7 +323,8 @@ class MapperSpec(JsonMixin):
       and method called.
   """
 
-  def __init__(self, handler_spec, input_reader_spec, params, shard_count):
+  def __init__(self, handler_spec, input_reader_spec, params, shard_count,
+               output_writer_spec=None):
     """Creates a new MapperSpec.
 
     Args:
@@ -331,6 +333,8 @@ class MapperSpec(JsonMixin):
       input_reader_spec: The class name of the input reader to use.
       params: Dictionary of additional parameters for the mapper.
       shard_count: number of shards to process in parallel.
+      output_writer_spec: The class name of the output writer to use, or
+        None if the mapper has no output.
 
     Properties:
       handler_spec: name of handler class/function to use.
@@ -338,10 +342,13 @@ class MapperSpec(JsonMixin):
       handler: cached instance of mapper handler as callable.
       input_reader_spec: The class name of the input reader to use.
       params: Dictionary of additional parameters for the mapper.
+      output_writer_spec: The class name of the output writer to use, or
+        None.
     """
     self.handler_spec = handler_spec
     self.__handler = None
     self.input_reader_spec = input_reader_spec
+    self.output_writer_spec = output_writer_spec
     self.shard_count = shard_count
     self.params = params
 
@@ -374,19 +381,32 @@ class MapperSpec(JsonMixin):
     """
     return util.for_name(self.input_reader_spec)
 
+  def output_writer_class(self):
+    """Get output writer class.
+
+    Returns:
+      output writer class object, or None if the mapper has no output writer.
+    """
+    if not self.output_writer_spec:
+      return None
+    return util.for_name(self.output_writer_spec)
+
   def to_json(self):
     """Serializes this MapperSpec into a json-izable object."""
-    return {
+    result = {
         "mapper_handler_spec": self.handler_spec,
         "mapper_input_reader": self.input_reader_spec,
         "mapper_params": self.params,
         "mapper_shard_count": self.shard_count,
     }
+    if self.output_writer_spec:
+      result["mapper_output_writer"] = self.output_writer_spec
+    return result
 
   def __str__(self):
-    return "MapperSpec(%s, %s, %s, %s)" % (
+    return "MapperSpec(%s, %s, %s, %s, %s)" % (
         self.handler_spec, self.input_reader_spec, self.params,
-        self.shard_count)
+        self.shard_count, self.output_writer_spec)
 
   @classmethod
   def from_json(cls, json):
@@ -394,7 +414,8 @@ class MapperSpec(JsonMixin):
     return cls(json["mapper_handler_spec"],
                json["mapper_input_reader"],
                json["mapper_params"],
-               json["mapper_shard_count"])
+               json["mapper_shard_count"],
+               json.get("mapper_output_writer"))
 
 
 class MapreduceSpec(JsonMixin):
@@ -409,6 +430,16 @@ class MapreduceSpec(JsonMixin):
   PARAM_DONE_CALLBACK = "done_callback"
   # Queue to use to call done callback
   PARAM_DONE_CALLBACK_QUEUE = "done_callback_queue"
+  # Reducer handler specification. Without it the mapreduce only maps.
+  PARAM_REDUCER = "reducer_handler"
+  # Number of reduce shards, which is also the number of partitions of the
+  # map output.
+  PARAM_REDUCER_SHARD_COUNT = "reducer_shard_count"
+  # Set in the specification passed to reduce workers.
+  PARAM_STAGE = "stage"
+
+  # Input reader of the reduce stage.
+  _REDUCE_INPUT_READER = "mapreduce.shuffler.ShuffleInputReader"
 
   def __init__(self,
                name,
@@ -454,6 +485,46 @@ class MapreduceSpec(JsonMixin):
 
     return self.__hooks
 
+  def has_reducer(self):
+    """Returns True if the map output is reduced after the map stage."""
+    return bool(self.params and self.params.get(self.PARAM_REDUCER))
+
+  def reducer_shard_count(self):
+    """Returns the number of reduce shards as int."""
+    return int(self.params.get(self.PARAM_REDUCER_SHARD_COUNT) or
+               _DEFAULT_SHARD_COUNT)
+
+  def is_reduce_stage(self):
+    """Returns True if this is the specification of the reduce workers."""
+    return bool(self.params and
+                self.params.get(self.PARAM_STAGE) == MapreduceState.STAGE_REDUCE)
+
+  def get_reduce_spec(self):
+    """Returns the MapreduceSpec of the reduce workers.
+
+    The reduce workers run the reducer handler as mapper over the shuffled
+    map output, so their specification has a MapperSpec for the reducer.
+    The processing rate of the mapper does not apply to the reducer.
+
+    Returns:
+      a MapreduceSpec for the reduce stage of this mapreduce.
+    """
+    params = dict(self.params)
+    del params[self.PARAM_REDUCER]
+    params[self.PARAM_STAGE] = MapreduceState.STAGE_REDUCE
+    reducer_params = dict(self.mapper.params)
+    reducer_params["enable_quota"] = False
+    reducer_spec = MapperSpec(self.params[self.PARAM_REDUCER],
+                              self._REDUCE_INPUT_READER,
+                              reducer_params,
+                              self.reducer_shard_count(),
+                              self.mapper.output_writer_spec)
+    return MapreduceSpec(self.name,
+                         self.mapreduce_id,
+                         reducer_spec.to_json(),
+                         params,
+                         self.hooks_class_name)
+
   def to_json(self):
     """Serializes all data in this mapreduce spec into json form.
 
@@ -505,6 +576,17 @@ class MapreduceState(db.Model):
     result_status: If not None, the final status of the job.
     active_shards: How many shards are still processing.
     start_time: When the job started.
+    stage: the running stage, STAGE_MAP or STAGE_REDUCE.
+    writer_state: json encoded state of the output writer of the job, set
+      when the output of all shards has been finalized.
+    active_shard_ids: ids of the running shards of the running stage, as of
+      the last time all shard states were aggregated.
+    aggregation_time: last time all shard states were aggregated, or None
+      if they must be aggregated at the next poll.
+    next_shard_number: the number of the next shard that a map shard is
+      split into. Split shards get their numbers from this counter instead
+      of from the shard states found by a query, which may not include the
+      latest shards yet.
   """
 
   RESULT_SUCCESS = "success"
@@ -513,9 +595,15 @@ class MapreduceState(db.Model):
 
   _RESULTS = frozenset([RESULT_SUCCESS, RESULT_FAILED, RESULT_ABORTED])
 
+  STAGE_MAP = "map"
+  STAGE_REDUCE = "reduce"
+
+  _STAGES = frozenset([STAGE_MAP, STAGE_REDUCE])
+
   # Functional properties.
   mapreduce_spec = JsonProperty(MapreduceSpec, indexed=False)
   active = db.BooleanProperty(default=True, indexed=False)
+  stage = db.StringProperty(default=STAGE_MAP, choices=_STAGES, indexed=False)
   last_poll_time = db.DateTimeProperty(required=True)
   counters_map = JsonProperty(CountersMap, default=CountersMap(), indexed=False)
   app_id = db.StringProperty(required=False, indexed=True)
@@ -528,6 +616,10 @@ class MapreduceState(db.Model):
   failed_shards = db.IntegerProperty(default=0, indexed=False)
   aborted_shards = db.IntegerProperty(default=0, indexed=False)
   start_time = db.DateTimeProperty(auto_now_add=True)
+  writer_state = db.TextProperty(default="")
+  active_shard_ids = db.StringListProperty(indexed=False)
+  aggregation_time = db.DateTimeProperty(indexed=False)
+  next_shard_number = db.IntegerProperty(default=0, indexed=False)
 
   @classmethod
   def kind(cls):
@@ -567,8 +659,7 @@ class MapreduceState(db.Model):
     """
     chart = google_chart_api.BarChart(shards_processed)
     if self.mapreduce_spec and shards_processed:
-      chart.bottom.labels = [
-          str(x) for x in xrange(self.mapreduce_spec.mapper.shard_count)]
+      chart.bottom.labels = [str(x) for x in xrange(len(shards_processed))]
       chart.left.labels = ['0', str(max(shards_processed))]
       chart.left.min = 0
     self.chart_url = chart.display.Url(300, 200)
@@ -622,6 +713,12 @@ class ShardState(db.Model):
     update_time: The last time this shard state was updated.
     shard_description: A string description of the work this shard will do.
     last_work_item: A string description of the last work item processed.
+    stage: the stage of the shard, MapreduceState.STAGE_MAP or STAGE_REDUCE.
+    shuffle_runs: names of the sorted runs of map output written by the shard.
+    writer_state: json encoded state of the output writer of the shard, saved
+      after every slice.
+    item_time_sec: moving average of the seconds spent on one handler call,
+      used to end slices before they take too long.
   """
 
   RESULT_SUCCESS = "success"
@@ -634,6 +731,11 @@ class ShardState(db.Model):
   active = db.BooleanProperty(default=True, indexed=False)
   counters_map = JsonProperty(CountersMap, default=CountersMap(), indexed=False)
   result_status = db.StringProperty(choices=_RESULTS, indexed=False)
+  stage = db.StringProperty(default=MapreduceState.STAGE_MAP,
+                            choices=MapreduceState._STAGES, indexed=False)
+  shuffle_runs = db.StringListProperty(indexed=False)
+  writer_state = db.TextProperty(default="")
+  item_time_sec = db.FloatProperty(default=0.0, indexed=False)
 
   # For UI purposes only.
   mapreduce_id = db.StringProperty(required=True)
@@ -671,6 +773,19 @@ class ShardState(db.Model):
     """
     return "%s-%d" % (mapreduce_id, shard_number)
 
+  @classmethod
+  def reduce_shard_id_from_number(cls, mapreduce_id, shard_number):
+    """Get reduce shard id by mapreduce id and shard number.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+      shard_number: reduce shard number to compute id for as int.
+
+    Returns:
+      shard id as string.
+    """
+    return "%s-reduce-%d" % (mapreduce_id, shard_number)
+
   @classmethod
   def get_key_by_shard_id(cls, shard_id):
     """Retrieves the Key for this ShardState.
@@ -708,37 +823,53 @@ class ShardState(db.Model):
     return cls.all().filter("mapreduce_id =", mapreduce_id).fetch(99999)
 
   @classmethod
-  def create_new(cls, mapreduce_id, shard_number):
+  def create_new(cls, mapreduce_id, shard_number,
+                 stage=MapreduceState.STAGE_MAP):
     """Create new shard state.
 
     Args:
       mapreduce_id: unique mapreduce id as string.
       shard_number: shard number for which to create shard state.
+      stage: the stage of the shard.
 
     Returns:
       new instance of ShardState ready to put into datastore.
     """
-    shard_id = cls.shard_id_from_number(mapreduce_id, shard_number)
+    if stage == MapreduceState.STAGE_REDUCE:
+      shard_id = cls.reduce_shard_id_from_number(mapreduce_id, shard_number)
+    else:
+      shard_id = cls.shard_id_from_number(mapreduce_id, shard_number)
     state = cls(key_name=shard_id,
-                mapreduce_id=mapreduce_id)
+                mapreduce_id=mapreduce_id,
+                stage=stage)
     return state
 
 
 class MapreduceControl(db.Model):
   """Datastore entity used to control mapreduce job execution.
 
-  Only one command may be sent to jobs at a time.
+  Only one command may be sent to jobs at a time. Split commands are sent to
+  a single shard, and every shard may have one split command at a time.
 
   Properties:
     command: The command to send to the job.
+    shard_number: For split commands, the number of the shard that takes
+      over part of the input of the split shard.
+    split_state: For split commands, json encoded input readers of both
+      shards after the split, and the slice that made it. Set by the split
+      shard, so a retried slice repeats the same split.
   """
 
   ABORT = "abort"
+  SPLIT = "split"
 
-  _COMMANDS = frozenset([ABORT])
+  _COMMANDS = frozenset([ABORT, SPLIT])
   _KEY_NAME = "command"
+  _SPLIT_KEY_NAME = "split"
 
   command = db.TextProperty(choices=_COMMANDS, required=True)
+  shard_number = db.IntegerProperty(indexed=False)
+  split_state = db.TextProperty(default="")
 
   @classmethod
   def kind(cls):
@@ -766,3 +897,127 @@ class MapreduceControl(db.Model):
     """
     cls(key_name="%s:%s" % (mapreduce_id, cls._KEY_NAME),
         command=cls.ABORT).put()
+
+  @classmethod
+  def get_key_by_shard_id(cls, shard_id):
+    """Retrieves the Key for the split command of a shard.
+
+    Args:
+      shard_id: The shard to fetch the command for.
+
+    Returns:
+      Datastore Key for the split command for the given shard ID.
+    """
+    return db.Key.from_path(cls.kind(),
+                            "%s:%s" % (shard_id, cls._SPLIT_KEY_NAME))
+
+  @classmethod
+  def split(cls, shard_id, shard_number):
+    """Asks a shard to move part of its input to a new shard.
+
+    Args:
+      shard_id: The shard to split. Not verified as a valid shard.
+      shard_number: The number of the new shard as int.
+    """
+    cls(key_name="%s:%s" % (shard_id, cls._SPLIT_KEY_NAME),
+        command=cls.SPLIT,
+        shard_number=shard_number).put()
+
+
+class ShuffleChunk(db.Model):
+  """A chunk of a sorted run of map output.
+
+  The map output of a mapreduce with a reducer is partitioned by key and
+  written in sorted runs, which are merged by the reduce shard of their
+  partition. Every run is stored as a sequence of chunks, with key names
+  that are computed by key_name().
+
+  Properties:
+    mapreduce_id: unique id of the mapreduce.
+    data: zlib compressed pickled list of (key, pickled value) pairs, sorted
+      by key.
+    last: whether this is the last chunk of its run.
+  """
+
+  mapreduce_id = db.StringProperty(required=True)
+  data = db.BlobProperty()
+  last = db.BooleanProperty(default=False, indexed=False)
+
+  @classmethod
+  def kind(cls):
+    """Returns entity kind."""
+    return "_AE_MR_ShuffleChunk"
+
+  @classmethod
+  def key_name(cls, mapreduce_id, partition, run, chunk):
+    """Computes the key name of a chunk.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+      partition: partition of the run as int.
+      run: name of the run as string.
+      chunk: number of the chunk in the run as int.
+
+    Returns:
+      key name as string.
+    """
+    return "%s/%d/%s/%d" % (mapreduce_id, partition, run, chunk)
+
+  @classmethod
+  def find_keys_by_mapreduce_id(cls, mapreduce_id):
+    """Find the keys of all chunks of a mapreduce.
+
+    Args:
+      mapreduce_id: mapreduce id.
+
+    Returns:
+      a query for the keys of all chunks of the mapreduce.
+    """
+    return cls.all(keys_only=True).filter("mapreduce_id =", mapreduce_id)
+
+
+class OutputChunk(db.Model):
+  """A chunk of the output of a shard.
+
+  Output writers buffer the output of a shard and write it as a sequence of
+  chunks, with key names that are computed by key_name(). The chunks of all
+  shards are concatenated when the output is read.
+
+  Properties:
+    mapreduce_id: unique id of the mapreduce.
+    data: the output data as a byte string.
+  """
+
+  mapreduce_id = db.StringProperty(required=True)
+  data = db.BlobProperty()
+
+  @classmethod
+  def kind(cls):
+    """Returns entity kind."""
+    return "_AE_MR_OutputChunk"
+
+  @classmethod
+  def key_name(cls, shard_id, slice_id, chunk):
+    """Computes the key name of a chunk.
+
+    Args:
+      shard_id: id of the shard that wrote the chunk as string.
+      slice_id: id of the slice that wrote the chunk as int.
+      chunk: number of the chunk in the slice as int.
+
+    Returns:
+      key name as string.
+    """
+    return "%s/%d/%d" % (shard_id, slice_id, chunk)
+
+  @classmethod
+  def find_keys_by_mapreduce_id(cls, mapreduce_id):
+    """Find the keys of all chunks of a mapreduce.
+
+    Args:
+      mapreduce_id: mapreduce id.
+
+    Returns:
+      a query for the keys of all chunks of the mapreduce.
+    """
+    return cls.all(keys_only=True).filter("mapreduce_id =", mapreduce_id)
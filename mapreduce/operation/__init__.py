@@ -25,5 +25,6 @@ on recieving from handler function.
 
 import db
 import counters
+import taskqueue
 
-__all__ = ['db', 'counters']
+__all__ = ['db', 'counters', 'taskqueue']
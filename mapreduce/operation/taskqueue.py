@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Tijmen Roberti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Taskqueue-related operations."""
+
+
+
+__all__ = ['Add']
+
+
+class Add(object):
+  """Add task to a queue via taskqueue_pool.
+
+  See mapreduce.context.TaskQueuePool.
+  """
+
+  def __init__(self, task, queue_name="default"):
+    """Constructor.
+
+    Args:
+      task: a taskqueue.Task to add.
+      queue_name: the name of the queue to add the task to.
+    """
+    self.task = task
+    self.queue_name = queue_name
+
+  def __call__(self, context):
+    """Perform operation.
+
+    Args:
+      context: mapreduce context as context.Context.
+    """
+    context.taskqueue_pool.add(self.task, self.queue_name)
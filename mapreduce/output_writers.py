@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Tijmen Roberti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines output writers for MapReduce.
+
+An output writer receives all values yielded by the handler of the last stage
+of a mapreduce that are not operations. Output writers are declared with the
+output_writer attribute of a mapper in mapreduce.yaml.
+"""
+
+
+
+__all__ = ["Error", "BadWriterParamsError", "OutputWriter",
+           "LineOutputWriter", "RecordOutputWriter"]
+
+import struct
+
+from google.appengine.ext import db
+from mapreduce.lib import simplejson
+from mapreduce import model
+
+
+# Size of the output data in one chunk in bytes.
+_CHUNK_SIZE = 512 * 1000
+
+# Number of chunks fetched at once when the output is read.
+_READ_BATCH_SIZE = 4
+
+
+class Error(Exception):
+  """Base-class for exceptions in this module."""
+
+
+class BadWriterParamsError(Error):
+  """The input parameters to a writer were invalid."""
+
+
+class OutputWriter(model.JsonMixin):
+  """Abstract base class for output writers.
+
+  Every shard has its own writer. The writer of a shard is created when its
+  first slice starts, and its state is saved in the ShardState of the shard
+  at the end of every slice, so the next slice can continue it. When all
+  shards of the job succeeded, the output of the shards is combined by
+  finalize_job().
+
+  A retried slice starts with the writer state saved by the previous slice,
+  so writers should make sure the output of a retried slice replaces the
+  output of the failed attempt.
+  """
+
+  # Content type of the output.
+  CONTENT_TYPE = "application/octet-stream"
+
+  # Extension of the file name of the output.
+  FILE_EXTENSION = "dat"
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Validates mapper spec.
+
+    Args:
+      mapper_spec: The MapperSpec for this OutputWriter.
+
+    Raises:
+      BadWriterParamsError: required parameters are missing or invalid.
+    """
+    raise NotImplementedError("validate() not implemented in %s" % cls)
+
+  @classmethod
+  def create(cls, mapreduce_spec, shard_state):
+    """Creates the writer of a shard.
+
+    Args:
+      mapreduce_spec: the model.MapreduceSpec of the stage of the shard.
+      shard_state: the model.ShardState of the shard.
+
+    Returns:
+      an instance of the OutputWriter.
+    """
+    raise NotImplementedError("create() not implemented in %s" % cls)
+
+  @classmethod
+  def for_slice(cls, mapreduce_spec, shard_state, slice_id):
+    """Returns the writer of a shard for one slice.
+
+    The writer is restored from the shard state, or created for the first
+    slice of the shard.
+
+    Args:
+      mapreduce_spec: the model.MapreduceSpec of the stage of the shard.
+      shard_state: the model.ShardState of the shard.
+      slice_id: the id of the slice as int.
+
+    Returns:
+      an instance of the OutputWriter.
+    """
+    if shard_state.writer_state:
+      writer = cls.from_json_str(shard_state.writer_state)
+    else:
+      writer = cls.create(mapreduce_spec, shard_state)
+    writer.begin_slice(shard_state, slice_id)
+    return writer
+
+  def begin_slice(self, shard_state, slice_id):
+    """Prepares the writer to write the output of a slice.
+
+    Args:
+      shard_state: the model.ShardState of the shard.
+      slice_id: the id of the slice as int.
+    """
+    self._shard_state = shard_state
+    self._slice_id = slice_id
+
+  def write(self, data, ctx):
+    """Writes data.
+
+    Args:
+      data: the value yielded by the handler.
+      ctx: current execution context.
+    """
+    raise NotImplementedError("write() not implemented in %s" %
+                              self.__class__)
+
+  def flush(self):
+    """Writes buffered output and saves the writer state in the shard state.
+
+    Called at the end of every slice, before the shard state is put.
+    """
+    self._shard_state.writer_state = self.to_json_str()
+
+  @classmethod
+  def finalize_job(cls, mapreduce_state, shard_states):
+    """Combines the output of all shards after the job succeeded.
+
+    Args:
+      mapreduce_state: the model.MapreduceState of the job. Its writer_state
+        should be set to the state of the combined output.
+      shard_states: the model.ShardState of all shards of the job.
+    """
+    raise NotImplementedError("finalize_job() not implemented in %s" % cls)
+
+  @classmethod
+  def get_output(cls, mapreduce_state):
+    """Reads the combined output of a job.
+
+    Args:
+      mapreduce_state: the model.MapreduceState of a finalized job.
+
+    Yields:
+      the output as a sequence of byte strings.
+    """
+    raise NotImplementedError("get_output() not implemented in %s" % cls)
+
+
+class _ChunkOutputWriter(OutputWriter):
+  """Base class for writers that store output as model.OutputChunk entities.
+
+  The output of a shard is buffered in memory and written in chunks of up to
+  _CHUNK_SIZE bytes, and at the end of every slice. Values that don't fit in
+  the current chunk continue in the next one, so values of any size stay
+  below the datastore entity size limit. Chunk names depend on the
+  shard, the slice and the number of the chunk in the slice, so a retried
+  slice overwrites the chunks of the failed attempt. When the job is
+  finalized, the chunk names of all shards are concatenated in shard order,
+  map shards before reduce shards.
+
+  Subclasses implement _encode() to convert a value to output bytes.
+  """
+
+  MAPREDUCE_ID_PARAM = "mapreduce_id"
+  CHUNKS_PARAM = "chunks"
+
+  def __init__(self, mapreduce_id, chunks=None):
+    """Constructor.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+      chunks: key names of the chunks written by earlier slices.
+    """
+    self._mapreduce_id = mapreduce_id
+    self._chunks = chunks or []
+    self._buffer = []
+    self._size = 0
+    self._slice_chunk = 0
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Validates mapper spec.
+
+    Args:
+      mapper_spec: The MapperSpec for this OutputWriter.
+
+    Raises:
+      BadWriterParamsError: the writer is not the writer of the mapper.
+    """
+    if mapper_spec.output_writer_class() != cls:
+      raise BadWriterParamsError("Output writer class mismatch")
+
+  @classmethod
+  def create(cls, mapreduce_spec, shard_state):
+    """Creates the writer of a shard.
+
+    Args:
+      mapreduce_spec: the model.MapreduceSpec of the stage of the shard.
+      shard_state: the model.ShardState of the shard.
+
+    Returns:
+      an instance of the OutputWriter.
+    """
+    return cls(mapreduce_spec.mapreduce_id)
+
+  def begin_slice(self, shard_state, slice_id):
+    """Prepares the writer to write the output of a slice.
+
+    Args:
+      shard_state: the model.ShardState of the shard.
+      slice_id: the id of the slice as int.
+    """
+    OutputWriter.begin_slice(self, shard_state, slice_id)
+    self._slice_chunk = 0
+
+  def _encode(self, data):
+    """Converts a value yielded by the handler to a byte string."""
+    raise NotImplementedError("_encode() not implemented in %s" %
+                              self.__class__)
+
+  def write(self, data, ctx):
+    """Writes data.
+
+    Args:
+      data: the value yielded by the handler.
+      ctx: current execution context.
+    """
+    data = self._encode(data)
+    self._buffer.append(data)
+    self._size += len(data)
+    while self._size >= _CHUNK_SIZE:
+      self._write_chunk()
+
+  def flush(self):
+    """Writes buffered output and saves the writer state in the shard state."""
+    while self._buffer:
+      self._write_chunk()
+    OutputWriter.flush(self)
+
+  def _write_chunk(self):
+    """Writes up to _CHUNK_SIZE bytes of the buffer as the next chunk."""
+    data = "".join(self._buffer)
+    rest = data[_CHUNK_SIZE:]
+    key_name = model.OutputChunk.key_name(self._shard_state.shard_id,
+                                          self._slice_id,
+                                          self._slice_chunk)
+    model.OutputChunk(key_name=key_name,
+                      mapreduce_id=self._mapreduce_id,
+                      data=data[:_CHUNK_SIZE]).put()
+    if key_name not in self._chunks:
+      self._chunks.append(key_name)
+    self._slice_chunk += 1
+    if rest:
+      self._buffer = [rest]
+    else:
+      self._buffer = []
+    self._size = len(rest)
+
+  @classmethod
+  def finalize_job(cls, mapreduce_state, shard_states):
+    """Concatenates the chunk names of all shards.
+
+    Args:
+      mapreduce_state: the model.MapreduceState of the job.
+      shard_states: the model.ShardState of all shards of the job.
+    """
+    shard_states = sorted(
+        shard_states,
+        key=lambda x: (x.stage != model.MapreduceState.STAGE_MAP,
+                       x.shard_number))
+    chunks = []
+    for shard_state in shard_states:
+      if shard_state.writer_state:
+        chunks.extend(simplejson.loads(
+            shard_state.writer_state)[cls.CHUNKS_PARAM])
+    mapreduce_state.writer_state = simplejson.dumps({cls.CHUNKS_PARAM: chunks})
+
+  @classmethod
+  def get_output(cls, mapreduce_state):
+    """Reads the combined output of a job.
+
+    Args:
+      mapreduce_state: the model.MapreduceState of a finalized job.
+
+    Yields:
+      the data of every chunk, in output order.
+    """
+    chunks = simplejson.loads(mapreduce_state.writer_state)[cls.CHUNKS_PARAM]
+    for i in range(0, len(chunks), _READ_BATCH_SIZE):
+      keys = [db.Key.from_path(model.OutputChunk.kind(), key_name)
+              for key_name in chunks[i:i + _READ_BATCH_SIZE]]
+      for chunk in db.get(keys):
+        if chunk:
+          yield chunk.data
+
+  def to_json(self):
+    """Returns writer state to serialize in json.
+
+    Returns:
+      A json-izable version of the OutputWriter state.
+    """
+    return {self.MAPREDUCE_ID_PARAM: self._mapreduce_id,
+            self.CHUNKS_PARAM: self._chunks}
+
+  @classmethod
+  def from_json(cls, json):
+    """Creates an instance of the OutputWriter for the given json state.
+
+    Args:
+      json: The OutputWriter state as a dict-like object.
+
+    Returns:
+      An instance of the OutputWriter configured using the values of json.
+    """
+    return cls(json[cls.MAPREDUCE_ID_PARAM], json[cls.CHUNKS_PARAM])
+
+
+class LineOutputWriter(_ChunkOutputWriter):
+  """Writes every value as a line of text.
+
+  Strings are written as they are, unicode strings are encoded as utf-8 and
+  other values are converted with str().
+  """
+
+  CONTENT_TYPE = "text/plain; charset=utf-8"
+
+  FILE_EXTENSION = "txt"
+
+  def _encode(self, data):
+    if isinstance(data, unicode):
+      data = data.encode("utf-8")
+    elif not isinstance(data, str):
+      data = str(data)
+    return data + "\n"
+
+
+class RecordOutputWriter(_ChunkOutputWriter):
+  """Writes every value as a length prefixed binary record.
+
+  Every record is written as its length in a 4 byte big-endian unsigned
+  integer, followed by the bytes of the record. Values must be strings;
+  unicode strings are encoded as utf-8. Use read_records() to read the
+  records back.
+  """
+
+  FILE_EXTENSION = "records"
+
+  def _encode(self, data):
+    if isinstance(data, unicode):
+      data = data.encode("utf-8")
+    return struct.pack(">I", len(data)) + data
+
+  @staticmethod
+  def read_records(data):
+    """Yields the records in the output of a RecordOutputWriter.
+
+    Args:
+      data: the output as a byte string.
+
+    Yields:
+      every record as a byte string.
+    """
+    offset = 0
+    while offset < len(data):
+      length, = struct.unpack(">I", data[offset:offset + 4])
+      offset += 4
+      yield data[offset:offset + length]
+      offset += length
@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Simple quota system backed by memcache storage."""
+"""Token bucket quota system backed by memcache storage."""
 
 
 
@@ -34,7 +34,10 @@ class QuotaManager(object):
   best effort only.
 
   Quota is managed by buckets. Each bucket contains a 32-bit int value of
-  available quota. Buckets should be refilled manually with 'put' method.
+  available quota. Buckets should be refilled manually with 'put' method,
+  or with 'put_multi' to refill many buckets at once. Refills may be capped
+  by a capacity, which turns buckets into token buckets: unused quota is
+  saved up for bursts until the bucket is full.
 
   It is safe to use a single bucket from multiple clients simultaneously.
   """
@@ -57,6 +60,30 @@ class QuotaManager(object):
     self.memcache_client.incr(bucket, delta=amount,
                               initial_value=_OFFSET, namespace=_QUOTA_NAMESPACE)
 
+  def put_multi(self, amounts, capacity=None):
+    """Put amounts into several quota buckets at once.
+
+    Args:
+      amounts: map from quota bucket as string to amount to be put into it
+        as int.
+      capacity: if not None, buckets are only filled up to this amount. The
+        capacity is checked before the buckets are refilled, so concurrent
+        refills may exceed it.
+    """
+    if capacity is not None:
+      current = self.memcache_client.get_multi(amounts.keys(),
+                                               namespace=_QUOTA_NAMESPACE)
+      capped_amounts = {}
+      for bucket, amount in amounts.iteritems():
+        available = int(current.get(bucket, _OFFSET)) - _OFFSET
+        amount = min(amount, capacity - available)
+        if amount > 0:
+          capped_amounts[bucket] = amount
+      amounts = capped_amounts
+    if amounts:
+      self.memcache_client.offset_multi(amounts, initial_value=_OFFSET,
+                                        namespace=_QUOTA_NAMESPACE)
+
   def consume(self, bucket, amount, consume_some=False):
     """Consume amount from quota bucket.
 
@@ -113,7 +140,10 @@ class QuotaManager(object):
 class QuotaConsumer(object):
   """Quota consumer wrapper for efficient quota consuming/reclaiming.
 
-  Quota is consumed in batches and put back in dispose() method.
+  Quota is leased from the bucket in batches and put back in dispose()
+  method. The batch size should be sized by the expected throughput of the
+  consumer, so quota is leased every few seconds rather than every few
+  items.
 
   WARNING: Always call the dispose() method if you need to keep quota
   consistent.
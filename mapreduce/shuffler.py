@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Tijmen Roberti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shuffle stage of mapreduce.
+
+The key/value pairs yielded by mapper handlers are collected by a ShufflePool.
+The pool partitions the pairs by key, sorts every partition and writes it as a
+sorted run of model.ShuffleChunk entities.
+
+After the map stage, every reduce shard reads the runs of one partition with a
+ShuffleInputReader. The reader first merges the runs in passes of at most
+_MERGE_FAN_IN runs, until no more than _MERGE_FAN_IN runs are left. Then it
+merges the remaining runs and yields every key with all its values, in key
+order.
+"""
+
+
+
+__all__ = ["ShufflePool", "ShuffleInputReader", "partition"]
+
+import cPickle as pickle
+import heapq
+import time
+import zlib
+
+from google.appengine.ext import db
+from mapreduce import input_readers
+from mapreduce import model
+
+
+# Size of the pickled pairs in one chunk in bytes. Reduce shards keep one
+# chunk of every run they merge in memory.
+_CHUNK_SIZE = 256 * 1000
+
+# Size of the pickled pairs a ShufflePool keeps in memory in bytes. The pool
+# writes its runs when it grows beyond this size.
+_MAX_POOL_SIZE = 4 * 1000 * 1000
+
+# Maximum number of runs that are merged at once.
+_MERGE_FAN_IN = 32
+
+# Number of pairs merged between checks of the merge deadline.
+_MERGE_CHECK_INTERVAL = 100
+
+
+def partition(key, partition_count):
+  """Computes the partition of a key.
+
+  Args:
+    key: the key of a pair. Strings are partitioned by value, other keys by
+      their repr.
+    partition_count: the number of partitions as int.
+
+  Returns:
+    the partition as int.
+  """
+  if not isinstance(key, str):
+    key = repr(key)
+  return zlib.crc32(key) % partition_count
+
+
+def _pair_size(key, value_data):
+  """Estimates the size of a pickled pair in bytes."""
+  if isinstance(key, str):
+    return len(key) + len(value_data)
+  return len(repr(key)) + len(value_data)
+
+
+def _encode_chunk(pairs):
+  """Encodes a list of pairs as chunk data."""
+  return db.Blob(zlib.compress(pickle.dumps(pairs, pickle.HIGHEST_PROTOCOL)))
+
+
+def _decode_chunk(data):
+  """Decodes the chunk data into a list of pairs."""
+  return pickle.loads(zlib.decompress(data))
+
+
+class _RunWriter(object):
+  """Writes a sorted run of pairs as ShuffleChunk entities.
+
+  Properties:
+    chunk: the number of the next chunk to write.
+  """
+
+  def __init__(self, mapreduce_id, partition_number, run, chunk=0):
+    """Constructor.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+      partition_number: partition of the run as int.
+      run: name of the run as string.
+      chunk: the number of the first chunk to write, to continue a run.
+    """
+    self._mapreduce_id = mapreduce_id
+    self._partition = partition_number
+    self._run = run
+    self.chunk = chunk
+    self._pairs = []
+    self._size = 0
+
+  def append(self, key, value_data):
+    """Appends a pair, which must not sort before earlier pairs.
+
+    Args:
+      key: the key of the pair.
+      value_data: the pickled value of the pair.
+    """
+    self._pairs.append((key, value_data))
+    self._size += _pair_size(key, value_data)
+    if self._size >= _CHUNK_SIZE:
+      self._write_chunk(False)
+
+  def flush(self):
+    """Writes the appended pairs, to continue the run later."""
+    if self._pairs:
+      self._write_chunk(False)
+
+  def close(self):
+    """Writes the last chunk of the run."""
+    self._write_chunk(True)
+
+  def _write_chunk(self, last):
+    model.ShuffleChunk(
+        key_name=model.ShuffleChunk.key_name(self._mapreduce_id,
+                                             self._partition,
+                                             self._run,
+                                             self.chunk),
+        mapreduce_id=self._mapreduce_id,
+        data=_encode_chunk(self._pairs),
+        last=last).put()
+    self.chunk += 1
+    self._pairs = []
+    self._size = 0
+
+
+class _RunReader(object):
+  """Reads a sorted run of pairs, one chunk at a time."""
+
+  def __init__(self, mapreduce_id, partition_number, run, chunk, offset,
+               entity=None):
+    """Constructor.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+      partition_number: partition of the run as int.
+      run: name of the run as string.
+      chunk: number of the chunk of the next pair as int.
+      offset: offset of the next pair in the chunk as int.
+      entity: the ShuffleChunk with the given number, if it is already
+        loaded.
+    """
+    self._mapreduce_id = mapreduce_id
+    self._partition = partition_number
+    self._run = run
+    self._chunk = chunk
+    self._offset = offset
+    self._load(entity)
+
+  def chunk_key(self):
+    """Returns the key of the current chunk."""
+    return db.Key.from_path(
+        model.ShuffleChunk.kind(),
+        model.ShuffleChunk.key_name(self._mapreduce_id, self._partition,
+                                    self._run, self._chunk))
+
+  def _load(self, entity=None):
+    """Loads chunks until one with an unread pair, or the last one."""
+    while True:
+      if entity is None:
+        entity = db.get(self.chunk_key())
+      if entity is None:
+        # Runs end with their last chunk, so this is only a safeguard.
+        self._pairs = []
+        self._last = True
+        return
+      self._pairs = _decode_chunk(entity.data)
+      self._last = entity.last
+      if self._offset < len(self._pairs) or self._last:
+        return
+      self._chunk += 1
+      self._offset = 0
+      entity = None
+
+  def done(self):
+    """Returns True if all pairs of the run have been read."""
+    return self._offset >= len(self._pairs)
+
+  def peek_key(self):
+    """Returns the key of the next pair."""
+    return self._pairs[self._offset][0]
+
+  def pop(self):
+    """Returns the next pair as a (key, pickled value) tuple."""
+    pair = self._pairs[self._offset]
+    self._offset += 1
+    if self._offset >= len(self._pairs) and not self._last:
+      self._chunk += 1
+      self._offset = 0
+      self._load()
+    return pair
+
+  def position(self):
+    """Returns the position of the next pair as [run, chunk, offset]."""
+    return [self._run, self._chunk, self._offset]
+
+
+class _MergeReader(object):
+  """Merges sorted runs into a single sorted sequence of pairs.
+
+  Pairs with equal keys are returned in the order of their runs.
+  """
+
+  def __init__(self, mapreduce_id, partition_number, positions):
+    """Constructor.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+      partition_number: partition of the runs as int.
+      positions: list with the position of each run as [run, chunk, offset].
+    """
+    keys = [db.Key.from_path(
+        model.ShuffleChunk.kind(),
+        model.ShuffleChunk.key_name(mapreduce_id, partition_number,
+                                    run, chunk))
+            for run, chunk, _ in positions]
+    # Load the current chunks of all runs in a single call.
+    entities = db.get(keys)
+    self._runs = []
+    self._heap = []
+    for i, (run, chunk, offset) in enumerate(positions):
+      reader = _RunReader(mapreduce_id, partition_number, run, chunk, offset,
+                          entities[i])
+      self._runs.append(reader)
+      if not reader.done():
+        self._heap.append((reader.peek_key(), i))
+    heapq.heapify(self._heap)
+
+  def done(self):
+    """Returns True if all pairs have been read."""
+    return not self._heap
+
+  def peek_key(self):
+    """Returns the key of the next pair."""
+    return self._heap[0][0]
+
+  def pop(self):
+    """Returns the next pair as a (key, pickled value) tuple."""
+    _, i = heapq.heappop(self._heap)
+    reader = self._runs[i]
+    pair = reader.pop()
+    if not reader.done():
+      heapq.heappush(self._heap, (reader.peek_key(), i))
+    return pair
+
+  def positions(self):
+    """Returns the positions of all runs as a list of [run, chunk, offset]."""
+    return [reader.position() for reader in self._runs]
+
+
+class ShufflePool(object):
+  """Collects the key/value pairs yielded by mapper handlers.
+
+  The pairs are kept in memory per partition. When the pool is flushed, or
+  grows beyond _MAX_POOL_SIZE, every partition is sorted and written as a run.
+  The written runs are recorded in the shard state, which the context puts
+  after flushing its pools. Run names only depend on the shard, the slice and
+  the number of earlier flushes in the slice, so a retried slice overwrites
+  the runs of the failed attempt.
+
+  Keys should be strings; unicode keys are encoded as utf-8. Values can be
+  anything that can be pickled.
+  """
+
+  def __init__(self, mapreduce_spec, shard_state, slice_id):
+    """Constructor.
+
+    Args:
+      mapreduce_spec: the model.MapreduceSpec of the mapreduce.
+      shard_state: the model.ShardState of the map shard.
+      slice_id: the id of the slice as int.
+    """
+    self._mapreduce_id = mapreduce_spec.mapreduce_id
+    self._partition_count = mapreduce_spec.reducer_shard_count()
+    self._shard_state = shard_state
+    self._slice_id = slice_id
+    self._flush_count = 0
+    self._partitions = {}
+    self._size = 0
+
+  def append(self, key, value):
+    """Adds a key/value pair.
+
+    Args:
+      key: the key of the pair.
+      value: the value of the pair.
+    """
+    if isinstance(key, unicode):
+      key = key.encode("utf-8")
+    value_data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    self._partitions.setdefault(
+        partition(key, self._partition_count), []).append((key, value_data))
+    self._size += _pair_size(key, value_data)
+    if self._size >= _MAX_POOL_SIZE:
+      self.flush()
+
+  def flush(self):
+    """Writes the collected pairs as one sorted run per partition."""
+    if not self._partitions:
+      return
+    run = "%d-%d-%d" % (self._shard_state.shard_number,
+                        self._slice_id,
+                        self._flush_count)
+    for partition_number, pairs in sorted(self._partitions.iteritems()):
+      pairs.sort()
+      writer = _RunWriter(self._mapreduce_id, partition_number, run)
+      for key, value_data in pairs:
+        writer.append(key, value_data)
+      writer.close()
+      name = ShuffleInputReader.run_name(partition_number, run)
+      if name not in self._shard_state.shuffle_runs:
+        self._shard_state.shuffle_runs.append(name)
+    self._flush_count += 1
+    self._partitions = {}
+    self._size = 0
+
+
+class ShuffleInputReader(input_readers.InputReader):
+  """Reads the shuffled map output of one partition.
+
+  Before iterating, merge() must be called until it returns True. The reader
+  then yields (key, values) tuples in key order, where values is the list of
+  all values of the key.
+  """
+
+  MAPREDUCE_ID_PARAM = "mapreduce_id"
+  PARTITION_PARAM = "partition"
+  MAP_SHARD_COUNT_PARAM = "map_shard_count"
+  RUNS_PARAM = "runs"
+  MERGE_PARAM = "merge"
+  MERGE_COUNT_PARAM = "merge_count"
+  POSITIONS_PARAM = "positions"
+
+  def __init__(self, mapreduce_id, partition_number, map_shard_count,
+               runs=None, merge=None, merge_count=0, positions=None):
+    """Constructor.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+      partition_number: the partition to read as int.
+      map_shard_count: the number of map shards as int.
+      runs: names of the runs left to read, or None if they are not yet
+        known.
+      merge: the state of the merge pass in progress as dict, or None.
+      merge_count: the number of merge passes started so far.
+      positions: positions of the runs in the final pass as a list of
+        [run, chunk, offset], or None if it is not yet started.
+    """
+    self._mapreduce_id = mapreduce_id
+    self._partition = partition_number
+    self._map_shard_count = map_shard_count
+    self._runs = runs
+    self._merge = merge
+    self._merge_count = merge_count
+    self._positions = positions
+
+  @staticmethod
+  def run_name(partition_number, run):
+    """Returns the name under which a map shard records a run."""
+    return "%d/%s" % (partition_number, run)
+
+  @classmethod
+  def create_readers(cls, mapreduce_spec, map_shard_count):
+    """Creates the readers for all partitions of a mapreduce.
+
+    Args:
+      mapreduce_spec: the model.MapreduceSpec of the mapreduce.
+      map_shard_count: the number of map shards, including shards that were
+        split off while the map stage ran.
+
+    Returns:
+      a list with a ShuffleInputReader for every partition.
+    """
+    return [cls(mapreduce_spec.mapreduce_id,
+                partition_number,
+                map_shard_count)
+            for partition_number in range(mapreduce_spec.reducer_shard_count())]
+
+  def _find_runs(self):
+    """Returns the names of all runs of the partition."""
+    shard_keys = [model.ShardState.get_key_by_shard_id(
+        model.ShardState.shard_id_from_number(self._mapreduce_id, number))
+                  for number in range(self._map_shard_count)]
+    prefix = self.run_name(self._partition, "")
+    runs = []
+    for shard_state in db.get(shard_keys):
+      if shard_state:
+        runs.extend(name[len(prefix):] for name in shard_state.shuffle_runs
+                    if name.startswith(prefix))
+    runs.sort()
+    return runs
+
+  def merge(self, deadline):
+    """Merges runs until at most _MERGE_FAN_IN runs are left.
+
+    Every merge pass merges the first _MERGE_FAN_IN runs into a new run,
+    which is added to the end of the runs.
+
+    Args:
+      deadline: the time, as returned by time.time(), after which the merge
+        must be suspended.
+
+    Returns:
+      True if the merging is done, False if it was suspended.
+    """
+    if self._runs is None:
+      self._runs = self._find_runs()
+    while self._merge or len(self._runs) > _MERGE_FAN_IN:
+      if not self._merge:
+        self._merge = {
+            "inputs": [[run, 0, 0] for run in self._runs[:_MERGE_FAN_IN]],
+            "output": "merge-%d" % self._merge_count,
+            "chunk": 0}
+        self._merge_count += 1
+      merger = _MergeReader(self._mapreduce_id, self._partition,
+                            self._merge["inputs"])
+      writer = _RunWriter(self._mapreduce_id, self._partition,
+                          self._merge["output"], self._merge["chunk"])
+      count = 0
+      while not merger.done():
+        writer.append(*merger.pop())
+        count += 1
+        if count % _MERGE_CHECK_INTERVAL == 0 and time.time() > deadline:
+          writer.flush()
+          self._merge["inputs"] = merger.positions()
+          self._merge["chunk"] = writer.chunk
+          return False
+      writer.close()
+      self._runs = (self._runs[len(self._merge["inputs"]):] +
+                    [self._merge["output"]])
+      self._merge = None
+    return True
+
+  def __iter__(self):
+    """Yields all keys of the partition with their values.
+
+    Yields:
+      (key, values) tuples in key order.
+    """
+    if self._runs is None:
+      self._runs = self._find_runs()
+    if self._positions is None:
+      self._positions = [[run, 0, 0] for run in self._runs]
+    merger = _MergeReader(self._mapreduce_id, self._partition,
+                          self._positions)
+    while not merger.done():
+      key = merger.peek_key()
+      values = []
+      while not merger.done() and merger.peek_key() == key:
+        values.append(pickle.loads(merger.pop()[1]))
+      self._positions = merger.positions()
+      yield key, values
+
+  def to_json(self):
+    """Serializes all the data in this reader into json form.
+
+    Returns:
+      all the data in json-compatible map.
+    """
+    return {self.MAPREDUCE_ID_PARAM: self._mapreduce_id,
+            self.PARTITION_PARAM: self._partition,
+            self.MAP_SHARD_COUNT_PARAM: self._map_shard_count,
+            self.RUNS_PARAM: self._runs,
+            self.MERGE_PARAM: self._merge,
+            self.MERGE_COUNT_PARAM: self._merge_count,
+            self.POSITIONS_PARAM: self._positions}
+
+  @classmethod
+  def from_json(cls, json):
+    """Create new ShuffleInputReader from the json, encoded by to_json.
+
+    Args:
+      json: json map representation of ShuffleInputReader.
+
+    Returns:
+      an instance of ShuffleInputReader with all data deserialized from json.
+    """
+    return cls(json[cls.MAPREDUCE_ID_PARAM],
+               json[cls.PARTITION_PARAM],
+               json[cls.MAP_SHARD_COUNT_PARAM],
+               json[cls.RUNS_PARAM],
+               json[cls.MERGE_PARAM],
+               json[cls.MERGE_COUNT_PARAM],
+               json[cls.POSITIONS_PARAM])
+
+  def __str__(self):
+    """Returns the string representation of this reader."""
+    return "partition %d of %s" % (self._partition, self._mapreduce_id)
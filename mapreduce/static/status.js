@@ -262,6 +262,9 @@ function initJobOverview(jobs, cursor) {
       .append($('<td>').text(job.name));
 
     var activity = '' + job.active_shards + ' / ' + job.shards + ' shards';
+    if (job.stage == 'reduce') {
+      activity += ' (reduce)';
+    }
     row.append($('<td>').text(activity))
 
     row.append($('<td>').text(getLocalTimestring(job.start_timestamp_ms)));
@@ -315,7 +318,8 @@ function initJobOverview(jobs, cursor) {
 //////// Launching jobs.
 
 var FIXED_JOB_PARAMS = [
-    'name', 'mapper_input_reader', 'mapper_handler', 'mapper_params_validator'
+    'name', 'mapper_input_reader', 'mapper_handler', 'mapper_output_writer',
+    'mapper_params_validator'
 ];
 
 var EDITABLE_JOB_PARAMS = ['shard_count', 'processing_rate', 'queue_name'];
@@ -542,7 +546,11 @@ function refreshJobDetail(jobId, detail) {
   $.each(detail.shards, function(index, shard) {
     var row = $('<tr>');
 
-    row.append($('<td>').text(shard.shard_number));
+    if (shard.stage == 'reduce') {
+      row.append($('<td>').text('reduce ' + shard.shard_number));
+    } else {
+      row.append($('<td>').text(shard.shard_number));
+    }
 
     // TODO: Style running colgroup for capitalization.
     var status = (shard.active ? 'running' : shard.result_status) || 'unknown';
@@ -586,6 +594,12 @@ function initJobDetail(jobId, detail) {
         return false;
       });
     $('#job-control').append(control);
+    if (detail.has_output) {
+      $('#job-control').append(' ').append(
+        $('<a>')
+          .attr('href', 'output?mapreduce_id=' + jobId)
+          .text('Download Output'));
+    }
   }
 
   refreshJobDetail(jobId, detail);
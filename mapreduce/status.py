@@ -76,6 +76,7 @@ class MapperInfo(validation.Validated):
   ATTRIBUTES = {
     "handler": r".+",
     "input_reader": r".+",
+    "output_writer": validation.Optional(r".+"),
     "params": validation.Optional(validation.Repeated(UserParam)),
     "params_validator": validation.Optional(r".+"),
   }
@@ -101,6 +102,7 @@ class MapReduceYaml(validation.Validated):
   - name: <mapreduce_name>
     mapper:
       - input_reader: google.appengine.ext.mapreduce.DatastoreInputReader
+      - output_writer: mapreduce.output_writers.LineOutputWriter
       - handler: path_to_my.MapperFunction
       - params:
         - name: foo
@@ -116,6 +118,8 @@ class MapReduceYaml(validation.Validated):
       specification.
     input_reader: Full <module_name>.<function_name/class_name> of the
       InputReader sub-class to use for the mapper job.
+    output_writer: Optional full <module_name>.<class_name> of the
+      OutputWriter sub-class that writes the values yielded by the handler.
     params: A list of optional parameter names and optional default values
       that may be supplied or overridden by the user running the job.
     params_validator is full <module_name>.<function_name/class_name> of
@@ -147,6 +151,8 @@ class MapReduceYaml(validation.Validated):
           "mapper_input_reader": config.mapper.input_reader,
           "mapper_handler": config.mapper.handler,
       }
+      if config.mapper.output_writer:
+        out["mapper_output_writer"] = config.mapper.output_writer
       if config.mapper.params_validator:
         out["mapper_params_validator"] = config.mapper.params_validator
       if config.mapper.params:
@@ -333,7 +339,10 @@ class ListJobsHandler(base_handler.GetJsonHandler):
           "chart_url": job.sparkline_url,
           "active_shards": job.active_shards,
           "shards": job.mapreduce_spec.mapper.shard_count,
+          "stage": job.stage,
       }
+      if job.stage == model.MapreduceState.STAGE_REDUCE:
+        out["shards"] = job.mapreduce_spec.reducer_shard_count()
       if job.result_status:
         out["result_status"] = job.result_status
       all_jobs.append(out)
@@ -364,17 +373,21 @@ class GetJobDetailHandler(base_handler.GetJsonHandler):
 
         # Specific to detail page.
         "chart_url": job.chart_url,
+        "stage": job.stage,
+        "has_output": bool(job.writer_state),
     })
     self.json_response["result_status"] = job.result_status
 
     shards_list = model.ShardState.find_by_mapreduce_id(mapreduce_id)
     all_shards = []
-    shards_list.sort(key=lambda x: x.shard_number)
+    shards_list.sort(key=lambda x: (x.stage != model.MapreduceState.STAGE_MAP,
+                                    x.shard_number))
     for shard in shards_list:
       out = {
           "active": shard.active,
           "result_status": shard.result_status,
           "shard_number": shard.shard_number,
+          "stage": shard.stage,
           "shard_id": shard.shard_id,
           "updated_timestamp_ms":
               int(time.mktime(shard.update_time.utctimetuple()) * 1000),
@@ -384,3 +397,27 @@ class GetJobDetailHandler(base_handler.GetJsonHandler):
       out.update(shard.counters_map.to_json())
       all_shards.append(out)
     self.json_response["shards"] = all_shards
+
+
+class OutputHandler(base_handler.BaseHandler):
+  """Serves the combined output of a finished job as a file download.
+
+  The whole output is written in one response, so it is limited by the
+  maximum response size.
+  """
+
+  def get(self):
+    mapreduce_id = self.request.get("mapreduce_id")
+    job = mapreduce_id and model.MapreduceState.get_by_key_name(mapreduce_id)
+    if not job or not job.writer_state:
+      self.response.set_status(404)
+      self.response.out.write("Output not found.")
+      return
+
+    writer_class = job.mapreduce_spec.mapper.output_writer_class()
+    self.response.headers["Content-Type"] = writer_class.CONTENT_TYPE
+    self.response.headers["Content-Disposition"] = (
+        "attachment; filename=%s.%s" % (mapreduce_id,
+                                        writer_class.FILE_EXTENSION))
+    for data in writer_class.get_output(job):
+      self.response.out.write(data)
@@ -117,6 +117,36 @@ def is_generator_function(obj):
                obj.func_code.co_flags & CO_GENERATOR))
 
 
+def batch_handler(handler):
+  """Mark a mapper handler as a batch handler.
+
+  A batch handler is called with a list of consecutive inputs instead of a
+  single input, so that it can batch its own datastore and task queue
+  calls. It may yield operations like any other handler. Use it as a
+  decorator on the handler function or method.
+
+  Args:
+    handler: the mapper handler.
+
+  Returns:
+    the same handler.
+  """
+  handler.mapreduce_batch_handler = True
+  return handler
+
+
+def is_batch_handler(handler):
+  """Return true if the mapper handler was marked with batch_handler.
+
+  Args:
+    handler: the mapper handler.
+
+  Returns:
+    true if the handler expects a list of inputs.
+  """
+  return bool(getattr(handler, "mapreduce_batch_handler", False))
+
+
 def get_short_name(fq_name):
   """Returns the last component of the name."""
   return fq_name.split(".")[-1:][0]
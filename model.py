@@ -16,6 +16,8 @@
 Model classes used in the planner.
 """
 import copy
+import struct
+import zlib
 from google.appengine.ext import db
 import simplejson as json
 import aetycoon
@@ -96,33 +98,283 @@ class User(db.Model):
         return self.identifier()
 
 
-# JsonProperty, by Konstantin, original source at:
-# http://kovshenin.com/archives/app-engine-json-objects-google-datastore/
-#
-# Changed a few things around.
-class JsonProperty(db.TextProperty):
+class _RawValue(object):
+    """
+    Wrapper around a value as it was loaded from the datastore, before
+    it has been decoded by the property that owns it.
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _Snapshot(object):
+    """
+    Records the datastore value from which a property value was
+    decoded. The |changed| flag is set by the tracked containers as
+    soon as the decoded value is mutated.
+    """
+    __slots__ = ['raw', 'value', 'changed']
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.value = None
+        self.changed = False
+
+
+def _mutator(method):
+    """Wraps a container method so that calling it marks a change."""
+    def wrapper(self, *args, **kwargs):
+        self._snapshot.changed = True
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class _TrackedDict(dict):
+    """A dictionary that reports all mutations to a _Snapshot."""
+    __slots__ = ['_snapshot']
+
+    __setitem__ = _mutator(dict.__setitem__)
+    __delitem__ = _mutator(dict.__delitem__)
+    clear = _mutator(dict.clear)
+    pop = _mutator(dict.pop)
+    popitem = _mutator(dict.popitem)
+    update = _mutator(dict.update)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._snapshot.changed = True
+        return dict.setdefault(self, key, default)
+
+
+class _TrackedList(list):
+    """A list that reports all mutations to a _Snapshot."""
+    __slots__ = ['_snapshot']
+
+    __setitem__ = _mutator(list.__setitem__)
+    __delitem__ = _mutator(list.__delitem__)
+    __setslice__ = _mutator(list.__setslice__)
+    __delslice__ = _mutator(list.__delslice__)
+    __iadd__ = _mutator(list.__iadd__)
+    __imul__ = _mutator(list.__imul__)
+    append = _mutator(list.append)
+    extend = _mutator(list.extend)
+    insert = _mutator(list.insert)
+    pop = _mutator(list.pop)
+    remove = _mutator(list.remove)
+    reverse = _mutator(list.reverse)
+    sort = _mutator(list.sort)
+
+
+def _track(value, snapshot):
+    """
+    Returns a copy of |value| in which all dictionaries and lists are
+    replaced by tracked containers that report to |snapshot|.
+    """
+    if isinstance(value, dict):
+        tracked = _TrackedDict((k, _track(v, snapshot))
+                               for k, v in value.iteritems())
+    elif isinstance(value, list):
+        tracked = _TrackedList(_track(v, snapshot) for v in value)
+    else:
+        return value
+    tracked._snapshot = snapshot
+    return tracked
+
+
+class LazyProperty(db.Property):
+    """
+    Base class for properties that decode their datastore value on
+    first access, instead of when the entity is loaded.
+
+    The datastore value is kept after decoding, and all mutations of
+    the decoded dictionaries and lists are tracked. If the value was
+    not accessed, or was neither mutated nor replaced, the value that
+    was loaded from the datastore is written back on put without
+    encoding it again.
+
+    Subclasses must implement encode() and decode(), and can override
+    is_current() to indicate which stored values can be written back
+    as they are.
+    """
     def validate(self, value):
+        if isinstance(value, _RawValue):
+            return value
+        return super(LazyProperty, self).validate(value)
+
+    def _snapshot_attr_name(self):
+        return '_SNAPSHOT' + self._attr_name()
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None:
+            return self
+        value = getattr(model_instance, self._attr_name(), None)
+        if isinstance(value, _RawValue):
+            snapshot = _Snapshot(value.value)
+            value = _track(self.decode(value.value), snapshot)
+            snapshot.value = value
+            setattr(model_instance, self._snapshot_attr_name(), snapshot)
+            setattr(model_instance, self._attr_name(), value)
         return value
 
     def get_value_for_datastore(self, model_instance):
-        result = super(JsonProperty, self).get_value_for_datastore(model_instance)
-        result = json.dumps(result)
-        return db.Text(result)
+        value = getattr(model_instance, self._attr_name(), None)
+        if isinstance(value, _RawValue):
+            if self.is_current(value.value):
+                return value.value
+            value = self.decode(value.value)
+        else:
+            snapshot = getattr(model_instance, self._snapshot_attr_name(),
+                               None)
+            if (snapshot and snapshot.value is value and not snapshot.changed
+                and self.is_current(snapshot.raw)):
+                return snapshot.raw
+        if value is None:
+            return None
+        return self.encode(value)
 
     def make_value_from_datastore(self, value):
-        if value is not None:
-            try:
-                value = json.loads(str(value))
-            except:
-                value = self.default_value()
-        return super(JsonProperty, self).make_value_from_datastore(value)
+        if value is None:
+            return None
+        return _RawValue(value)
 
     def default_value(self):
-        """If possible, copy the value passed in the default= keyword
-        argument.  This prevents mutable objects such as dictionaries
-        from being shared across instances."""
+        """Copies the default value, so mutable defaults are not shared."""
         return copy.copy(self.default)
 
+    def encode(self, value):
+        """Returns the datastore representation of |value|."""
+        raise NotImplementedError()
+
+    def decode(self, value):
+        """Returns the python value of the datastore |value|."""
+        raise NotImplementedError()
+
+    def is_current(self, value):
+        """
+        Returns true if the datastore |value| is already in the
+        encoding that encode() would produce.
+        """
+        return False
+
+
+class AssigneesProperty(LazyProperty):
+    """
+    Compact storage for the derived assignees of a task. The value is
+    a dictionary of assignee records, keyed on the assignee identifier,
+    with the fields id, name, completed and all.
+
+    The records are stored in a single blob: a version byte, the
+    number of records, the packed completed and all counts of each
+    record, followed by the zero-separated identifiers and names.
+
+    Values that were stored as JSON text, the encoding that was
+    previously used for this data, are decoded as well, and are
+    converted to the compact encoding on the next put.
+    """
+    data_type = db.Blob
+
+    _VERSION = '\x01'
+    _HEADER = struct.Struct('<cI')
+
+    def __init__(self, default=None, **kwargs):
+        if default is None:
+            default = {}
+        super(AssigneesProperty, self).__init__(default=default, **kwargs)
+
+    def encode(self, value):
+        identifiers = list(value.iterkeys())
+        names = []
+        counts = []
+        for identifier in identifiers:
+            record = value[identifier]
+            names.append(record.get('name') or u'')
+            counts.append(record.get('completed', 0))
+            counts.append(record.get('all', 0))
+        header = self._HEADER.pack(self._VERSION, len(identifiers))
+        packed_counts = struct.pack('<%dI' % len(counts), *counts)
+        strings = u'\x00'.join(identifiers + names).encode('utf-8')
+        return db.Blob(header + packed_counts + strings)
+
+    def decode(self, value):
+        if not isinstance(value, db.Blob):
+            return self._decode_json(value)
+        version, count = self._HEADER.unpack_from(value)
+        if version != self._VERSION:
+            raise db.BadValueError("Unknown assignees encoding %r" % version)
+        if not count:
+            return {}
+        offset = self._HEADER.size
+        counts = struct.unpack_from('<%dI' % (2 * count), value, offset)
+        offset += 8 * count
+        strings = value[offset:].decode('utf-8').split(u'\x00')
+        assignees = {}
+        for i in xrange(count):
+            identifier = strings[i]
+            assignees[identifier] = {
+                'id': identifier,
+                'name': strings[count + i],
+                'completed': counts[2 * i],
+                'all': counts[2 * i + 1]
+                }
+        return assignees
+
+    def is_current(self, value):
+        return isinstance(value, db.Blob) and value[:1] == self._VERSION
+
+    def _decode_json(self, value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return self.default_value()
+
+
+class DescriptionProperty(LazyProperty):
+    """
+    Text that is stored compressed once it is longer than a threshold.
+    Short values are stored as plain text, exactly like a
+    db.TextProperty would store them, and long values are stored in
+    the zlib compressed UTF-8 encoding of aetycoon's
+    CompressedTextProperty. Values are only decompressed on first
+    access.
+
+    Values that were stored by a db.TextProperty are read as they are,
+    and are compressed on the next put if they exceed the threshold.
+    """
+    data_type = db.Text
+
+    def __init__(self, threshold=1024, level=6, **kwargs):
+        """
+        Args:
+            threshold: The minimum length of values that are compressed.
+            level: The zlib compression level, between 1 and 9.
+        """
+        super(DescriptionProperty, self).__init__(**kwargs)
+        self.threshold = threshold
+        self.level = level
+
+    def validate(self, value):
+        if isinstance(value, basestring) and not isinstance(value, db.Text):
+            value = db.Text(value)
+        elif value is not None and not isinstance(value, (db.Text, _RawValue)):
+            raise db.BadValueError('Property %s must be a string' % self.name)
+        return super(DescriptionProperty, self).validate(value)
+
+    def encode(self, value):
+        if len(value) < self.threshold:
+            return db.Text(value)
+        return db.Blob(zlib.compress(value.encode('utf-8'), self.level))
+
+    def decode(self, value):
+        if isinstance(value, db.Blob):
+            return db.Text(zlib.decompress(value).decode('utf-8'))
+        return value
+
+    def is_current(self, value):
+        return isinstance(value, db.Blob) or len(value) < self.threshold
+
 
 class Task(db.Model):
     """
@@ -158,8 +410,9 @@ class Task(db.Model):
     # FIXED PROPERTIES
     #
     # Description of the task. The first line of the description
-    # is used as the title of the task.
-    description = db.TextProperty(required=True)
+    # is used as the title of the task. Use set_description() to
+    # change the description, so the title is updated as well.
+    description = DescriptionProperty(required=True)
     # Link to a parent task. Tasks that do not have a parent are all
     # considered to be in the 'backlog'.
     parent_task = db.SelfReferenceProperty(default=None,
@@ -220,10 +473,20 @@ class Task(db.Model):
     #     completed by this assignee.
     #  all: an integer describing the total number of atomic subtasks
     #     assigned to this assignee.
-    derived_assignees = JsonProperty(default={})
+    #  name: the name of the assignee, cached for quick descriptions.
+    derived_assignees = AssigneesProperty()
     # Whether or not the task has one or more open tasks. If this
     # task is an open atomic task, then this value is also True.
     derived_has_open_tasks = db.BooleanProperty(default=False)
+    # The title of the task, derived from the first line of the
+    # description whenever the description is set. Stored separately
+    # so tasks can be listed without decompressing the description.
+    # None for tasks that were stored before this property existed.
+    derived_title = db.StringProperty(default=None)
+    # The lower case version of the title, used to find tasks by the
+    # prefix of their title.
+    derived_title_lower = aetycoon.DerivedProperty(
+        lambda self: self.derived_title and self.derived_title.lower())
 
 
     def identifier(self):
@@ -261,14 +524,39 @@ class Task(db.Model):
         """
         return self.parent_key().name()
 
+    # The maximum length of the stored title, in characters
+    MAX_TITLE_LENGTH = 500
+
+    @staticmethod
+    def title_from_description(description):
+        """
+        Returns the title of a task with the given |description|. The
+        title is the first line in the description, without a trailing
+        period, and is truncated to MAX_TITLE_LENGTH characters.
+        """
+        title = description.split('\r\n', 1)[0].split('\n', 1)[0]
+        if title.endswith('.'):
+            title = title[:-1]
+        return title[:Task.MAX_TITLE_LENGTH]
+
+    def set_description(self, description):
+        """
+        Sets the description of the task and updates the stored title.
+        """
+        self.description = description
+        self.derived_title = Task.title_from_description(description)
+
     def title(self):
         """
         Returns the title of the task.
 
-        The title is the first line in the description.
+        The title is the first line in the description. Does not
+        access the description unless the task was stored before the
+        title was stored separately.
         """
-        title = self.description.split('\r\n', 1)[0].split('\n', 1)[0]
-        return title[:-1] if title[-1] == '.' else title
+        if self.derived_title is None:
+            return Task.title_from_description(self.description)
+        return self.derived_title
 
     def description_body(self):
         """
@@ -432,3 +720,68 @@ class TaskIndex(db.Model):
     atomic = db.BooleanProperty(default=False)
     # Mirrors the |derived_has_open_tasks| property of the Task.
     has_open_tasks = db.BooleanProperty(default=False)
+
+
+class DomainStatistics(db.Model):
+    """
+    A shard of the task statistics of a domain, or of a single user
+    in a domain. Only atomic tasks are counted. The statistics are
+    maintained incrementally by the workers that compute the derived
+    properties of tasks.
+
+    The statistics are spread over NUMBER_OF_SHARDS shards to limit
+    write contention. The shards are root entities, so updating them
+    does not contend with the writes in the entity group of the
+    domain.
+
+    The key_name of each shard has the form domain/user/shard, where
+    user is the empty string for the statistics of the entire domain.
+
+    Each update has an identifier, which determines the shard it is
+    applied to. The identifiers of the most recent updates of a shard
+    are stored with it, so an update that is retried after it was
+    applied is skipped.
+    """
+    NUMBER_OF_SHARDS = 10
+    # The number of update identifiers that are kept per shard
+    MAX_APPLIED_UPDATES = 100
+    # The names of all counter properties
+    COUNTERS = ('task_count', 'completed_count', 'open_count',
+                'assigned_count')
+
+    domain = db.StringProperty(required=True)
+    # The user identifier, or None for the domain statistics
+    user = db.StringProperty(default=None)
+    # The number of atomic tasks. For user statistics, only the
+    # tasks assigned to the user are counted.
+    task_count = db.IntegerProperty(default=0, indexed=False)
+    # The number of completed atomic tasks.
+    completed_count = db.IntegerProperty(default=0, indexed=False)
+    # The number of open atomic tasks. Always 0 for user statistics.
+    open_count = db.IntegerProperty(default=0, indexed=False)
+    # The number of atomic tasks that have an assignee.
+    assigned_count = db.IntegerProperty(default=0, indexed=False)
+    # The identifiers of the most recent updates, oldest first.
+    applied_updates = db.StringListProperty(default=[], indexed=False)
+
+    @staticmethod
+    def shard_key_name(domain_identifier, user_identifier, shard):
+        """Returns the key name of a single shard."""
+        return '%s/%s/%d' % (domain_identifier, user_identifier or '', shard)
+
+    @staticmethod
+    def shard_for_update(update_identifier):
+        """Returns the shard to which the update is applied."""
+        return int(update_identifier, 16) % DomainStatistics.NUMBER_OF_SHARDS
+
+    @staticmethod
+    def shard_keys(domain_identifier, user_identifier=None):
+        """
+        Returns a list with the keys of all shards of the statistics
+        of the domain, or of the user in the domain if a
+        |user_identifier| is given.
+        """
+        return [db.Key.from_path('DomainStatistics',
+                                 DomainStatistics.shard_key_name(
+                                     domain_identifier, user_identifier, shard))
+                for shard in range(DomainStatistics.NUMBER_OF_SHARDS)]
@@ -18,6 +18,8 @@ performed in the background. Tasks in the taskqueue sense are called
 'workers', to prevent any confusing with Tasks in the SPS sense.
 """
 import os
+import time
+import uuid
 import logging
 from google.appengine.api import users, datastore
 from google.appengine.api import taskqueue
@@ -26,8 +28,11 @@ from google.appengine.ext import webapp
 from google.appengine.datastore import datastore_rpc
 from google.appengine.ext.webapp.util import run_wsgi_app
 import simplejson as json
+from appengine_utilities.sessions import Session
+from appengine_utilities.cache import Cache
+from appengine_utilities.rotmodel import retry_until, put_multi
 import api
-from model import Domain, Task, TaskIndex, Context, User
+from model import Domain, Task, TaskIndex, Context, User, DomainStatistics
 
 # A test to check if we are on the development sdk, as that one
 # does not support multi entity groups yet.
@@ -67,6 +72,7 @@ class UpdateTaskCompletion(webapp.RequestHandler):
             index = TaskIndex.get_by_key_name(task_identifier, parent=task)
             if not index:
                 index = TaskIndex(parent=task, key_name=task_identifier)
+            statistics_before = task_statistics(task)
             # Get all subtasks. The ancestor queries are strongly
             # consistent, so when propagating upwards through the
             # hierarchy the changes are reflected.
@@ -78,9 +84,9 @@ class UpdateTaskCompletion(webapp.RequestHandler):
                 task.derived_size = 1
                 task.derived_atomic_task_count = 1
                 task.derived_has_open_tasks = task.open()
+                assignees = {}
                 assignee_identifier = task.assignee_identifier()
                 if assignee_identifier:
-                    index.assignees = [assignee_identifier]
                     if not DEV_SERVER:
                         # Uses a multi entity group transaction to get the name
                         # of the assignee. This is cached in the record for
@@ -89,12 +95,17 @@ class UpdateTaskCompletion(webapp.RequestHandler):
                         name = assignee.name if assignee else '<Missing>'
                     else:
                         name = 'temp'
-                    task.derived_assignees[task.assignee_identifier()] = {
-                        'id': task.assignee_identifier(),
+                    assignees[assignee_identifier] = {
+                        'id': assignee_identifier,
                         'name': name,
                         'completed': int(task.is_completed()),
                         'all': 1
                         }
+                # Only replace the assignees if they changed, so the
+                # stored value can be reused when the task is put.
+                if assignees != task.derived_assignees:
+                    task.derived_assignees = assignees
+                index.assignees = list(assignees.iterkeys())
             else:               # composite task
                 task.derived_completed = all(t.is_completed() for t in subtasks)
                 task.derived_size = 1 + sum(t.derived_size for t in subtasks)
@@ -117,13 +128,27 @@ class UpdateTaskCompletion(webapp.RequestHandler):
                                 }
                         assignees[id]['completed'] += record['completed']
                         assignees[id]['all'] += record['all']
-                task.derived_assignees = assignees
+                if assignees != task.derived_assignees:
+                    task.derived_assignees = assignees
                 index.assignees = list(assignees.iterkeys())
-            task.put()
             index.completed = task.is_completed()
             index.has_open_tasks = task.has_open_tasks()
             index.atomic = task.atomic()
-            index.put()
+            put_multi([task, index])
+            # Update the statistics with the changes in this task
+            statistics_after = task_statistics(task)
+            for user_identifier in (set(statistics_before) |
+                                    set(statistics_after)):
+                before = statistics_before.get(user_identifier, {})
+                after = statistics_after.get(user_identifier, {})
+                deltas = dict((counter, after.get(counter, 0) -
+                               before.get(counter, 0))
+                              for counter in DomainStatistics.COUNTERS)
+                if any(deltas.itervalues()):
+                    UpdateDomainStatistics.enqueue(domain_identifier,
+                                                   user_identifier,
+                                                   deltas,
+                                                   transactional=True)
             # Propagate further upwards
             if task.parent_task_identifier():
                 UpdateTaskCompletion.enqueue(domain_identifier,
@@ -136,6 +161,7 @@ class UpdateTaskCompletion(webapp.RequestHandler):
             options = datastore_rpc.TransactionOptions(
                 allow_multiple_entity_groups=True)
             datastore.RunInTransactionOptions(options, txn)
+        api.bump_domain_version(domain_identifier)
 
 
     @staticmethod
@@ -159,14 +185,28 @@ class UpdateTaskCompletion(webapp.RequestHandler):
                              " transaction")
 
         queue = taskqueue.Queue('update-task-hierarchy')
-        task = taskqueue.Task(url='/workers/update-task-completion',
-                              params={ 'task': task_identifier,
-                                       'domain': domain_identifier })
+        task = UpdateTaskCompletion.make_task(domain_identifier,
+                                              task_identifier)
         try:
             queue.add(task, transactional=transactional)
         except taskqueue.TransientError:
             queue.add(task, transactional=transactional)
 
+    @staticmethod
+    def make_task(domain_identifier, task_identifier):
+        """
+        Returns the taskqueue task for a worker on the task with the
+        given identifier, to be added to the 'update-task-hierarchy'
+        queue. Use enqueue() to queue a single worker.
+
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifier: The task identifier string
+        """
+        return taskqueue.Task(url='/workers/update-task-completion',
+                              params={ 'task': task_identifier,
+                                       'domain': domain_identifier })
+
 
 
 class UpdateTaskHierarchy(webapp.RequestHandler):
@@ -212,14 +252,14 @@ class UpdateTaskHierarchy(webapp.RequestHandler):
             if not index:
                 index = TaskIndex(parent=task, key_name=task_identifier)
             index.hierarchy = hierarchy
-            index.put()
             task.derived_level = level
-            task.put()
+            put_multi([index, task])
             return task
 
         task = db.run_in_transaction(txn)
         if not task:
             return
+        api.bump_domain_version(domain_identifier)
 
         # Spawn new tasks to propagate downwards. This is done outside
         # the transaction, as only 5 transactional tasks can be
@@ -255,18 +295,268 @@ class UpdateTaskHierarchy(webapp.RequestHandler):
                              " transaction")
 
         queue = taskqueue.Queue('update-task-hierarchy')
-        task = taskqueue.Task(url='/workers/update-task-hierarchy',
+        task = UpdateTaskHierarchy.make_task(domain_identifier,
+                                             task_identifier)
+        try:
+            queue.add(task, transactional=transactional)
+        except taskqueue.TransientError:
+            queue.add(task, transactional=transactional)
+
+    @staticmethod
+    def make_task(domain_identifier, task_identifier):
+        """
+        Returns the taskqueue task for a worker on the task with the
+        given identifier, to be added to the 'update-task-hierarchy'
+        queue. Use enqueue() to queue a single worker.
+
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifier: The task identifier string
+        """
+        return taskqueue.Task(url='/workers/update-task-hierarchy',
                               params={ 'task': task_identifier,
                                        'domain': domain_identifier })
+
+
+class UpdateDomainStatistics(webapp.RequestHandler):
+    """
+    Adds deltas to the statistics of a domain, or of a single user in
+    a domain. The deltas are added to the shard of the statistics
+    that is selected by the update identifier.
+
+    This post request takes a domain, an optional user identifier, an
+    update identifier and an integer delta for each of the counters
+    in DomainStatistics.COUNTERS. Missing deltas are treated as 0.
+
+    This operation is idempotent. The update identifier is recorded
+    in the shard in the same transaction as the deltas, and updates
+    that were already applied are skipped.
+    """
+    def post(self):
+        domain_identifier = self.request.get('domain')
+        user_identifier = self.request.get('user') or None
+        # Workers that were queued before updates had identifiers
+        # are applied once more if they are retried.
+        update_identifier = self.request.get('update') or uuid.uuid4().hex
+        try:
+            deltas = dict((counter, int(self.request.get(counter, 0)))
+                          for counter in DomainStatistics.COUNTERS)
+            shard = DomainStatistics.shard_for_update(update_identifier)
+        except ValueError:
+            logging.error("Invalid statistics update for domain '%s'",
+                          domain_identifier)
+            return
+
+        key_name = DomainStatistics.shard_key_name(domain_identifier,
+                                                   user_identifier,
+                                                   shard)
+        def txn():
+            statistics = DomainStatistics.get_by_key_name(key_name)
+            if not statistics:
+                statistics = DomainStatistics(key_name=key_name,
+                                              domain=domain_identifier,
+                                              user=user_identifier)
+            if update_identifier in statistics.applied_updates:
+                return
+            for counter, delta in deltas.iteritems():
+                setattr(statistics, counter,
+                        getattr(statistics, counter) + delta)
+            statistics.applied_updates.append(update_identifier)
+            del statistics.applied_updates[
+                :-DomainStatistics.MAX_APPLIED_UPDATES]
+            statistics.put()
+        db.run_in_transaction(txn)
+        api.invalidate_domain_statistics(domain_identifier, user_identifier)
+
+    @staticmethod
+    def enqueue(domain_identifier,
+                user_identifier,
+                deltas,
+                transactional=False):
+        """
+        Queues a new worker to add the deltas to the statistics of a
+        domain. The worker gets a new update identifier, so it must
+        only be queued as part of the transaction that causes the
+        change.
+
+        Args:
+            domain_identifier: The domain identifier string
+            user_identifier: The user identifier string, or None to
+                update the statistics of the entire domain.
+            deltas: A dictionary with the integer delta of each
+                counter in DomainStatistics.COUNTERS.
+            transactional: If set to true, then the task will be added
+                as a transactional task.
+
+        Raises:
+            ValueError: If transactional is set to True and the
+                 function is not called as part of a transaction.
+        """
+        if transactional and not db.is_in_transaction():
+            raise ValueError("Adding a transactional worker requires a"
+                             " transaction")
+
+        queue = taskqueue.Queue('update-domain-statistics')
+        task = UpdateDomainStatistics.make_task(domain_identifier,
+                                                user_identifier,
+                                                deltas,
+                                                uuid.uuid4().hex)
         try:
             queue.add(task, transactional=transactional)
         except taskqueue.TransientError:
             queue.add(task, transactional=transactional)
 
+    @staticmethod
+    def make_task(domain_identifier,
+                  user_identifier,
+                  deltas,
+                  update_identifier):
+        """
+        Returns the taskqueue task for a worker that adds the deltas
+        to the statistics of a domain, to be added to the
+        'update-domain-statistics' queue.
+
+        Args:
+            domain_identifier: The domain identifier string
+            user_identifier: The user identifier string, or None to
+                update the statistics of the entire domain.
+            deltas: A dictionary with the integer delta of each
+                counter in DomainStatistics.COUNTERS.
+            update_identifier: A hexadecimal string that identifies
+                the update. Workers with the same update identifier
+                are only applied once.
+        """
+        params = dict((counter, deltas[counter]) for counter in deltas
+                      if deltas[counter])
+        params['domain'] = domain_identifier
+        params['update'] = update_identifier
+        if user_identifier:
+            params['user'] = user_identifier
+        return taskqueue.Task(url='/workers/update-domain-statistics',
+                              params=params)
+
+
+class CleanExpiredSessions(webapp.RequestHandler):
+    """
+    Deletes expired sessions, session data and cache items from the
+    datastore, so that user requests do not have to. This worker is
+    started by cron, see cron.yaml.
+
+    The sessions are cleaned first, then the items of sessions that
+    still store them as separate entities, and then the cache. Batches
+    are deleted until the time budget of the worker runs out, after
+    which the worker queues itself to continue with the next batch.
+
+    This request takes two optional arguments: the stage to continue
+    with (sessions, session_data or cache) and a cursor within that
+    stage.
+
+    This operation is idempotent.
+    """
+    STAGES = ('sessions', 'session_data', 'cache')
+    # The number of entities queried and deleted per batch
+    BATCH_SIZE = 100
+    # The number of seconds after which the worker queues itself to
+    # continue, well below the request deadline.
+    TIME_BUDGET_SEC = 20
+    # The number of seconds after which a failed batch is not retried,
+    # but the worker fails and is retried by the task queue.
+    RETRY_DEADLINE_SEC = 40
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        stage = self.request.get('stage') or self.STAGES[0]
+        cursor = self.request.get('cursor') or None
+        if stage not in self.STAGES:
+            logging.error("Unknown cleaning stage '%s'", stage)
+            return
+
+        start = time.time()
+        deadline = start + self.RETRY_DEADLINE_SEC
+        while True:
+            if stage == 'sessions':
+                count, cursor = retry_until(deadline,
+                                            Session.delete_expired_sessions,
+                                            batch_size=self.BATCH_SIZE,
+                                            cursor=cursor)
+            elif stage == 'session_data':
+                count, cursor = retry_until(
+                    deadline,
+                    Session.delete_expired_session_data,
+                    batch_size=self.BATCH_SIZE,
+                    cursor=cursor)
+            else:
+                count, cursor = retry_until(deadline, Cache.delete_expired,
+                                            batch_size=self.BATCH_SIZE,
+                                            cursor=cursor)
+            logging.info("Deleted %d expired %s entities", count, stage)
+            if not cursor:
+                index = self.STAGES.index(stage) + 1
+                if index == len(self.STAGES):
+                    return
+                stage = self.STAGES[index]
+            if time.time() - start > self.TIME_BUDGET_SEC:
+                CleanExpiredSessions.enqueue(stage, cursor)
+                return
+
+    @staticmethod
+    def enqueue(stage, cursor=None):
+        """
+        Queues a new worker to continue cleaning.
+
+        Args:
+            stage: The stage to continue with, one of STAGES
+            cursor: The cursor within the stage, or None to start at
+                the beginning of the stage.
+        """
+        params = { 'stage': stage }
+        if cursor:
+            params['cursor'] = cursor
+        task = taskqueue.Task(url='/workers/clean-expired-sessions',
+                              params=params)
+        try:
+            taskqueue.Queue().add(task)
+        except taskqueue.TransientError:
+            taskqueue.Queue().add(task)
+
+
+def task_statistics(task):
+    """
+    Returns the contribution of a task to the domain statistics. Only
+    atomic tasks for which the derived properties have been computed
+    contribute to the statistics.
+
+    Args:
+        task: An instance of the Task model
+
+    Returns:
+        A dictionary that maps a user identifier, or None for the
+        statistics of the entire domain, to a dictionary with the
+        counter values of the task.
+    """
+    if not task.atomic() or task.atomic_task_count() != 1:
+        return {}
+    completed = int(task.is_completed())
+    statistics = {
+        None: { 'task_count': 1,
+                'completed_count': completed,
+                'open_count': int(task.has_open_tasks()),
+                'assigned_count': int(bool(task.derived_assignees)) }
+        }
+    for user_identifier in task.derived_assignees:
+        statistics[user_identifier] = { 'task_count': 1,
+                                        'completed_count': completed,
+                                        'assigned_count': 1 }
+    return statistics
+
 
 mapping = [
     ('/workers/update-task-hierarchy', UpdateTaskHierarchy),
-    ('/workers/update-task-completion', UpdateTaskCompletion)
+    ('/workers/update-task-completion', UpdateTaskCompletion),
+    ('/workers/update-domain-statistics', UpdateDomainStatistics),
+    ('/workers/clean-expired-sessions', CleanExpiredSessions)
     ]
 
 application = webapp.WSGIApplication(mapping)